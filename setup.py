@@ -23,6 +23,7 @@ requires = [
     'pyramid_tm',
     'python-magic',
     'pytz',
+    'requests',
     'setuptools',
     'simplejson',
     'subprocess_middleware',
@@ -35,6 +36,15 @@ if sys.version_info.major == 2:
         'subprocess32',
     ])
 
+asgi_require = [
+    'httpx',
+    'uvicorn',
+]
+
+compression_require = [
+    'brotli',
+]
+
 tests_require = [
     'pytest>=2.4.0',
     'pytest-bdd',
@@ -59,11 +69,17 @@ setup(
     install_requires=requires,
     tests_require=tests_require,
     extras_require={
+        'asgi': asgi_require,
+        'compression': compression_require,
         'test': tests_require,
     },
     entry_points='''
         [console_scripts]
         deploy = encoded.commands.deploy:main
+        regulome-warm-cache = encoded.commands.warm_cache:main
+        regulome-asgi = encoded.asgi:serve
+        regulome-benchmark = encoded.commands.benchmark:main
+        regulome-data-service-standin = encoded.commands.data_service_standin:main
 
         [paste.app_factory]
         main = encoded:main
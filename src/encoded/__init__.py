@@ -86,8 +86,13 @@ def main(global_config, **local_config):
     config.add_renderer(None, json_renderer)
 
     config.include('.renderers')
+    config.include('.stats')
+    config.include('.conditional')
+    config.include('.compression')
 
     config.include('.regulome_search')
+    config.include('.regulome_jobs')
+    config.include('.cache_warmer')
     config.include('.regulome_help')
     config.include('.regulome_notfound')
 
@@ -0,0 +1,666 @@
+""" ASGI entry point for the regulome front-end.
+
+regulome-summary and regulome-search JSON responses are fetched from the
+genomic data service with an async HTTP client so a process can hold
+thousands of lookups in flight. Their bodies are serialized exactly as the
+WSGI app serializes them. Every other request, including anything that
+needs the node HTML renderer, is handed to the WSGI app on a thread pool so
+both entry points return the same bytes.
+
+Serve with ``regulome-asgi production.ini`` or any ASGI server given
+``encoded.asgi:main`` as a factory.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from pyramid.encode import urlencode as pyramid_urlencode
+from pyramid.httpexceptions import (
+    HTTPFound,
+    HTTPSeeOther,
+    HTTPServiceUnavailable,
+)
+from pyramid.settings import asbool
+from urllib.parse import parse_qs
+from webob import (
+    Request,
+    Response,
+)
+import argparse
+import asyncio
+import io
+import json
+import logging
+import re
+import sys
+import time
+
+try:
+    import httpx
+except ImportError:  # Optional, install encoded[asgi]
+    httpx = None
+
+from . import main as wsgi_main
+from .circuit_breaker import (
+    OverloadedError,
+    UpstreamError,
+    UpstreamUnavailable,
+)
+from .json_passthrough import (
+    PassthroughResult,
+    SpooledBody,
+    TopLevelRewriter,
+)
+from .regulome_query import (
+    InvalidRegionsError,
+    invalid_regions_response,
+    normalize_query,
+)
+from .regulome_search import (
+    SEARCH_TITLE,
+    SUMMARY_FIELDS,
+    check_server_error,
+    decode_response,
+    empty_search_response,
+    load_query,
+    prefetch_search,
+    request_query_string,
+    response_fields,
+    response_rewrites,
+    rewrite_response,
+    service_unavailable,
+)
+from .renderers import should_transform
+from .response_cache import value_size
+from .stats import (
+    bind_context,
+    start_timings,
+    stop_timings,
+)
+from .upstream import endpoint as upstream_endpoint
+import humanfriendly
+
+
+log = logging.getLogger(__name__)
+
+ROUTES = [
+    (re.compile(r'^/regulome-summary/?$'), 'regulome-summary', ('GET', 'HEAD', 'POST')),
+    (re.compile(r'^/regulome-search/?$'), 'regulome-search', ('GET', 'HEAD')),
+]
+
+RETRY_STATUS = (502, 503, 504)
+
+
+class Delegate(Exception):
+    """ Raised to hand a request over to the WSGI app.
+    """
+
+
+class AsyncDataService(object):
+    """ Async counterpart of regulome_search.genomic_data_service_fetch.
+
+    It shares the caches and the fan-out configuration of the WSGI app's
+    registry, and coalesces identical in-flight queries per event loop.
+    """
+
+    def __init__(self, registry, executor):
+        settings = registry.settings
+        self.registry = registry
+        self.executor = executor
+        self.upstream = registry['genomic_data_service']
+        self.cache = registry['regulome_cache']
+        self.fanout = registry['regulome_summary_fanout']
+        self.metrics = registry['regulome_metrics']
+        self.cursors = registry['regulome_cursors']
+        self.coalesce_timeout = registry['genomic_data_service_flights'].timeout
+        self.passthrough = asbool(settings.get('regulome_passthrough.enabled', False))
+        self.spool_bytes = humanfriendly.parse_size(
+            settings.get('regulome_passthrough.spool_bytes', '4MB'))
+        connect_timeout, read_timeout = self.upstream.timeout
+        max_connections = int(settings.get('genomic_data_service.async_max_connections', 100))
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            transport=httpx.AsyncHTTPTransport(retries=self.upstream.retries),
+        )
+        self.in_flight = {}
+        self.revalidating = set()
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, bind_context(fn), *args)
+
+    async def _get(self, replica, path):
+        """ GET with the same bounded retries as the WSGI upstream client.
+        """
+        replicas = self.upstream.replicas
+        start = time.monotonic()
+        try:
+            for attempt in range(self.upstream.retries + 1):
+                response = await self.client.get(replica.base_url + path)
+                if response.status_code not in RETRY_STATUS or attempt == self.upstream.retries:
+                    break
+                self.metrics.incr('upstream_retries', endpoint=upstream_endpoint(path))
+                await asyncio.sleep(self.upstream.backoff_factor * (2 ** attempt))
+        except asyncio.CancelledError:
+            replicas.release(replica, True)
+            raise
+        except Exception:
+            replicas.release(replica, False)
+            raise
+        replicas.release(replica, response.status_code < 500, time.monotonic() - start)
+        return response
+
+    async def admit(self):
+        """ Non-blocking counterpart of UpstreamClient.admit.
+        """
+        admission = self.upstream.admission
+        deadline = time.monotonic() + admission.wait
+        while not admission.try_acquire():
+            if time.monotonic() >= deadline:
+                admission.reject()
+                raise OverloadedError('Too many data service requests', admission.wait)
+            await asyncio.sleep(0.005)
+        self.upstream.admitted()
+
+    async def get(self, path):
+        self.upstream.start_health_checks()
+        await self.admit()
+        start = time.monotonic()
+        response = None
+        try:
+            response = await self.dispatch(path)
+            return response
+        except httpx.HTTPError as e:
+            raise UpstreamError('Data service request failed: %s' % e, 1) from e
+        finally:
+            latency = time.monotonic() - start
+            self.upstream.finish(response is not None and response.status_code < 500, latency)
+            if response is None:
+                self.metrics.record_upstream(upstream_endpoint(path), latency)
+            else:
+                self.metrics.record_upstream(
+                    upstream_endpoint(path), latency, response.status_code,
+                    len(response.content))
+
+    async def dispatch(self, path):
+        """ GET from the least loaded replica, hedging like UpstreamClient.
+        """
+        replicas = self.upstream.replicas
+        delay = self.upstream.hedge_delay() if self.upstream.hedge else None
+        primary = replicas.choose()
+        first = asyncio.ensure_future(self._get(primary, path))
+        if delay is None:
+            return await first
+        done, pending = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+        secondary = replicas.choose(exclude=(primary,))
+        if secondary is None:
+            return await first
+        self.upstream.hedges += 1
+        pending = {first, asyncio.ensure_future(self._get(secondary, path))}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return task.result()
+        raise task.exception()
+
+    async def coalesce(self, key, factory):
+        future = self.in_flight.get(key)
+        if future is not None:
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), self.coalesce_timeout)
+            except asyncio.TimeoutError:
+                log.warning('Timed out waiting for in-flight call: %s', key)
+                return await factory()
+
+        future = self.in_flight[key] = asyncio.get_running_loop().create_future()
+        # Followers re-raise the exception, do not warn when there are none.
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        try:
+            result = await factory()
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self.in_flight[key]
+
+    async def fetch(self, request, endpoint, page_title):
+        query_string = request_query_string(request)
+        try:
+            query_string = normalize_query(query_string)
+        except InvalidRegionsError as e:
+            return Response(
+                status=400,
+                content_type='application/json',
+                body=json.dumps(invalid_regions_response(
+                    endpoint, query_string, page_title, e)).encode('utf-8'),
+            )
+
+        response_format = parse_qs(query_string).get('format', [None])
+        if response_format[0] in ['bed', 'tsv']:
+            if asbool(self.registry.settings.get('regulome_download.proxy', False)):
+                raise Delegate()
+            raise HTTPFound(location=self.upstream.url(endpoint, query_string))
+
+        async def load():
+            if endpoint == 'summary' and self.cursors.enabled and self.cursors.split(query_string):
+                return await self.run(
+                    load_query, self.registry, endpoint, query_string, page_title)
+            if endpoint == 'summary':
+                shard_queries = self.fanout.shard_queries(query_string)
+                if shard_queries:
+                    return await self.fetch_sharded(
+                        shard_queries, endpoint, query_string, page_title)
+            return await self.fetch_query(
+                endpoint, query_string, page_title, passthrough=self.passthrough)
+
+        handoff = self.registry['regulome_handoff'].take(self.cache.key(endpoint, query_string))
+        if handoff is not None:
+            try:
+                return await asyncio.wrap_future(handoff)
+            except Exception:
+                log.debug('Prefetched %s query failed', endpoint, exc_info=True)
+        return await self.fetch_or_stale(endpoint, query_string, load)
+
+    async def fetch_or_stale(self, endpoint, query_string, load):
+        """ Async counterpart of regulome_search.fetch_or_stale.
+        """
+        cache_key = self.cache.key(endpoint, query_string)
+        breaker = self.upstream.breaker
+        if breaker.state != breaker.CLOSED:
+            stale = self.cache.get_stale(cache_key)
+            if stale is not None:
+                if breaker.ready():
+                    task = asyncio.ensure_future(load())
+                    self.revalidating.add(task)
+                    task.add_done_callback(self.revalidated)
+                return stale
+        try:
+            return await load()
+        except UpstreamUnavailable as e:
+            stale = self.cache.get_stale(cache_key)
+            if stale is not None:
+                log.info('Serving stale response for %s: %s', cache_key, e)
+                return stale
+            raise service_unavailable(e)
+
+    def revalidated(self, task):
+        self.revalidating.discard(task)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None and not isinstance(error, UpstreamUnavailable):
+            log.error('Revalidating a stale response failed', exc_info=error)
+
+    async def fetch_query(self, endpoint, query_string, page_title, passthrough=False):
+        cache_key = self.cache.key(endpoint, query_string)
+        if self.cache.enabled(endpoint):
+            response = self.cache.get(cache_key)
+            if response is not None:
+                self.metrics.record_cache(endpoint, 'hit')
+                return response
+        path = self.upstream.path(endpoint, query_string)
+        load = self.load_passthrough if passthrough else self.load_response
+        return await self.coalesce(
+            cache_key, lambda: load(cache_key, endpoint, path, page_title))
+
+    async def fetch_sharded(self, shard_queries, endpoint, query_string, page_title):
+        cache_key = self.cache.key(endpoint, query_string)
+        use_cache = self.cache.enabled(endpoint)
+        if use_cache:
+            response = self.cache.get(cache_key)
+            if response is not None:
+                self.metrics.record_cache(endpoint, 'hit')
+                return response
+
+        semaphore = asyncio.Semaphore(self.fanout.concurrency)
+
+        async def fetch_shard(shard):
+            async with semaphore:
+                return await self.fetch_query(endpoint, shard, page_title)
+
+        async def load():
+            responses = await asyncio.gather(*map(fetch_shard, shard_queries))
+            response = self.fanout.merge(responses, query_string, endpoint)
+            if use_cache:
+                self.cache.set(cache_key, response, value_size(response))
+            return response
+
+        return await self.coalesce(cache_key, load)
+
+    async def load_response(self, cache_key, endpoint, path, page_title):
+        use_cache = self.cache.enabled(endpoint)
+        content = await self.run(self.cache.get_shared, cache_key) if use_cache else None
+
+        from_upstream = content is None
+        status_code = 200
+        if use_cache:
+            self.metrics.record_cache(endpoint, 'miss' if from_upstream else 'shared_hit')
+        if from_upstream:
+            upstream_response = await self.get(path)
+            status_code = upstream_response.status_code
+            if status_code != 200:
+                use_cache = False
+            content = upstream_response.content
+
+        response = rewrite_response(decode_response(status_code, content), endpoint, page_title)
+
+        if use_cache:
+            self.cache.set(cache_key, response, value_size(response))
+            if from_upstream:
+                await self.run(self.cache.set_shared, cache_key, content)
+
+        return response
+
+    async def load_passthrough(self, cache_key, endpoint, path, page_title):
+        use_cache = self.cache.enabled(endpoint)
+        content = await self.run(self.cache.get_shared, cache_key) if use_cache else None
+        rewriter = TopLevelRewriter(
+            response_rewrites(endpoint, page_title),
+            SUMMARY_FIELDS if endpoint == 'summary' else (),
+        )
+        body = SpooledBody(self.spool_bytes)
+        original = None
+        if use_cache:
+            self.metrics.record_cache(endpoint, 'miss' if content is None else 'shared_hit')
+        if content is not None:
+            body.write(rewriter.feed(content))
+        else:
+            original = bytearray() if use_cache else None
+            self.upstream.start_health_checks()
+            await self.admit()
+            replicas = self.upstream.replicas
+            replica = replicas.choose()
+            start = time.monotonic()
+            admitted = True
+            ok = False
+            status = size = None
+            try:
+                async with self.client.stream('GET', replica.base_url + path) as upstream_response:
+                    ok = upstream_response.status_code < 500
+                    status = upstream_response.status_code
+                    self.upstream.finish(ok, time.monotonic() - start)
+                    admitted = False
+                    check_server_error(upstream_response)
+                    size = 0
+                    if upstream_response.status_code != 200:
+                        use_cache = False
+                        original = None
+                    async for chunk in upstream_response.aiter_bytes():
+                        size += len(chunk)
+                        if original is not None:
+                            original.extend(chunk)
+                            if len(original) > self.spool_bytes:
+                                original = None
+                        body.write(rewriter.feed(chunk))
+            except httpx.HTTPError as e:
+                raise UpstreamError('Data service request failed: %s' % e, 1) from e
+            finally:
+                replicas.release(replica, ok)
+                latency = time.monotonic() - start
+                if admitted:
+                    self.upstream.finish(False, latency)
+                self.metrics.record_upstream(upstream_endpoint(path), latency, status, size)
+        body.write(rewriter.close())
+        body.finish()
+        result = PassthroughResult(body, rewriter.fields)
+
+        if use_cache and body.in_memory:
+            self.cache.set(cache_key, result, result.size)
+            if original is not None:
+                await self.run(self.cache.set_shared, cache_key, bytes(original))
+
+        return result
+
+
+def environ_from_scope(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body.extend(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return bytes(body)
+
+
+class RegulomeASGI(object):
+    def __init__(self, wsgi_app, threads=16):
+        self.wsgi_app = wsgi_app
+        self.registry = wsgi_app.registry
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='regulome-wsgi')
+        self.data_service = AsyncDataService(self.registry, self.executor)
+        self.conditional = self.registry['conditional_responses']
+        self.compressed = self.registry['compressed_responses']
+        self.views = {
+            'regulome-summary': self.regulome_summary,
+            'regulome-search': self.regulome_search,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        environ = environ_from_scope(scope, await read_body(receive))
+        request = Request(environ)
+        view = self.route(request)
+        if view is None:
+            return await self.call_wsgi(environ, send)
+        timings, token = start_timings()
+        try:
+            response = await self.respond(request, view)
+        except Delegate:
+            environ['wsgi.input'].seek(0)
+            return await self.call_wsgi(environ, send)
+        finally:
+            stop_timings(token)
+        self.registry['regulome_metrics'].observe(
+            'request_seconds', timings.clock() - timings.start,
+            route=request.environ['encoded.route_name'])
+        response.headers['Server-Timing'] = timings.header()
+        await self.send_response(request, response, send)
+
+    async def respond(self, request, view):
+        self.compressed.strip_etag_suffix(request)
+        response = self.conditional.check(request)
+        if response is not None:
+            return self.compressed.finish(request, response)
+        try:
+            response = await view(request)
+        except (HTTPFound, HTTPSeeOther, HTTPServiceUnavailable) as e:
+            response = e
+        response.headers['X-Request-URL'] = request.url
+        response = self.conditional.finish(
+            request, response, request.environ['encoded.route_name'])
+        return self.compressed.finish(request, response)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.data_service.close()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def route(self, request):
+        """ Return the native view for JSON regulome requests or None.
+        """
+        for pattern, name, methods in ROUTES:
+            if pattern.match(request.path_info) and request.method in methods:
+                break
+        else:
+            return None
+        request.environ['encoded.route_name'] = name
+        if request.method in ('GET', 'HEAD'):
+            negotiated = Response(content_type='application/json')
+            if should_transform(request, negotiated):
+                return None
+            request.environ['encoded.vary'] = negotiated.vary
+        return self.views[name]
+
+    def render(self, request, value):
+        if isinstance(value, PassthroughResult):
+            response = value.response()
+        elif isinstance(value, Response):
+            return value
+        else:
+            response = Response(content_type='application/json')
+            response.body = json.dumps(value).encode('utf-8')
+        vary = request.environ.get('encoded.vary')
+        if vary:
+            response.vary = vary
+        return response
+
+    async def regulome_summary(self, request):
+        response = await self.data_service.fetch(request, 'summary', 'RegulomeDB Summary')
+        fields = response_fields(response)
+        if fields is not None and fields['total'] == 1:
+            query = {
+                'regions': fields['query_coordinates'],
+                'genome': fields['assembly']
+            }
+            prefetch_search(self.registry, query)
+            location = request.application_url + '/regulome-search?' + pyramid_urlencode(
+                query, doseq=True)
+            raise HTTPSeeOther(location=location)
+        return self.render(request, response)
+
+    async def regulome_search(self, request):
+        if len(request.params) == 0:
+            return self.render(request, empty_search_response())
+        return self.render(
+            request, await self.data_service.fetch(request, 'search', SEARCH_TITLE))
+
+    async def send_response(self, request, response, send):
+        status = []
+
+        def start_response(status_line, headerlist, exc_info=None):
+            status.append((status_line, headerlist))
+
+        body = response(request.environ, start_response)
+        status_line, headerlist = status[0]
+        await send({
+            'type': 'http.response.start',
+            'status': int(status_line.split(' ', 1)[0]),
+            'headers': [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headerlist
+            ],
+        })
+        try:
+            if request.method != 'HEAD':
+                for chunk in body:
+                    if chunk:
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def call_wsgi(self, environ, send):
+        """ Run the WSGI app on the thread pool, streaming its body.
+        """
+        status = []
+        run = self.data_service.run
+
+        def start_response(status_line, headerlist, exc_info=None):
+            status.append((status_line, headerlist))
+            return lambda data: None
+
+        def call():
+            body = self.wsgi_app(environ, start_response)
+            return body, iter(body)
+
+        body, chunks = await run(call)
+        try:
+            first = await run(next, chunks, None)
+            status_line, headerlist = status[-1]
+            await send({
+                'type': 'http.response.start',
+                'status': int(status_line.split(' ', 1)[0]),
+                'headers': [
+                    (name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headerlist
+                ],
+            })
+            chunk = first
+            while chunk is not None:
+                if chunk and environ['REQUEST_METHOD'] != 'HEAD':
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await run(next, chunks, None)
+        finally:
+            if hasattr(body, 'close'):
+                await run(body.close)
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+def main(global_config, **local_config):
+    """ Return the ASGI application, configured like encoded:main.
+    """
+    if httpx is None:
+        raise ImportError('The ASGI app requires httpx, install encoded[asgi]')
+    settings = dict(global_config)
+    settings.update(local_config)
+    threads = int(settings.get('asgi.threads', 16))
+    return RegulomeASGI(wsgi_main(settings), threads=threads)
+
+
+def serve():
+    import uvicorn
+    from pyramid.paster import get_appsettings
+    parser = argparse.ArgumentParser(description='Serve the regulome front-end over ASGI')
+    parser.add_argument('config_uri', help='path to configfile')
+    parser.add_argument('--app-name', default='app', help='Pyramid app name in configfile')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=6543)
+    args = parser.parse_args()
+    logging.basicConfig()
+    settings = get_appsettings(args.config_uri, args.app_name)
+    uvicorn.run(main({}, **settings), host=args.host, port=args.port)
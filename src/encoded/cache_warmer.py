@@ -0,0 +1,134 @@
+""" Warm the regulome caches with the queries most requested in access logs.
+"""
+from collections import Counter
+from pyramid.events import ApplicationCreated
+from pyramid.settings import aslist
+from urllib.parse import (
+    unquote,
+    urlsplit,
+)
+from webob import Request
+from .regulome_query import (
+    InvalidRegionsError,
+    normalize_query,
+)
+import glob
+import gzip
+import logging
+import re
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+# The request and status of nginx and paste/waitress combined log lines.
+_request = re.compile(r'"GET (?P<target>\S+) HTTP/[\d.]+" (?P<status>\d{3}) ')
+_route = re.compile(r'^/regulome-(?P<endpoint>search|summary)/?$')
+
+
+def includeme(config):
+    if aslist(config.registry.settings.get('regulome_warmer.logs', '')):
+        config.add_subscriber(start_warmer, ApplicationCreated)
+
+
+def parse_log_lines(lines):
+    """ Yield (endpoint, normalized query string) for successful regulome
+    JSON or page requests.
+    """
+    for line in lines:
+        match = _request.search(line)
+        if match is None or match.group('status')[0] not in '23':
+            continue
+        target = urlsplit(match.group('target'))
+        route = _route.match(unquote(target.path))
+        if route is None or not target.query:
+            continue
+        try:
+            query_string = normalize_query(target.query)
+        except (InvalidRegionsError, ValueError):
+            continue
+        if 'format=' in query_string:
+            continue
+        yield route.group('endpoint'), query_string
+
+
+def read_logs(patterns):
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            opener = gzip.open if path.endswith('.gz') else open
+            try:
+                with opener(path, 'rt', errors='replace') as f:
+                    for line in f:
+                        yield line
+            except OSError:
+                log.warning('Could not read access log %s', path, exc_info=True)
+
+
+def top_queries(patterns, top=1000):
+    counts = Counter(parse_log_lines(read_logs(patterns)))
+    return [query for query, count in counts.most_common(top)]
+
+
+def query_path(endpoint, query_string):
+    return '/regulome-%s/?%s&format=json' % (endpoint, query_string)
+
+
+def replay(queries, get, rate=5, budget=None, clock=time.monotonic, sleep=time.sleep):
+    """ Request each query with ``get(path)``, at most ``rate`` per second
+    and stopping after ``budget`` seconds. Returns the number requested.
+    """
+    start = clock()
+    interval = 1.0 / rate if rate else 0
+    done = 0
+    for endpoint, query_string in queries:
+        if budget is not None and clock() - start >= budget:
+            log.info('Cache warming stopped after %d queries, out of time', done)
+            break
+        began = clock()
+        try:
+            status = get(query_path(endpoint, query_string))
+            if status >= 500:
+                log.warning('Warming %s query failed (%d): %s', endpoint, status, query_string)
+        except Exception:
+            log.warning('Warming %s query failed: %s', endpoint, query_string, exc_info=True)
+        done += 1
+        wait = interval - (clock() - began)
+        if wait > 0:
+            sleep(wait)
+    return done
+
+
+def app_getter(app):
+    def get(path):
+        request = Request.blank(path, headers={'Accept': 'application/json'})
+        response = request.get_response(app)
+        if hasattr(response.app_iter, 'close'):
+            response.app_iter.close()
+        return response.status_int
+    return get
+
+
+def warm(app, settings):
+    prefix = 'regulome_warmer.'
+    budget = settings.get(prefix + 'budget', '300')
+    queries = top_queries(
+        aslist(settings[prefix + 'logs']),
+        top=int(settings.get(prefix + 'top', 1000)),
+    )
+    log.info('Warming regulome caches with %d queries', len(queries))
+    done = replay(
+        queries,
+        app_getter(app),
+        rate=float(settings.get(prefix + 'rate', 5)),
+        budget=float(budget) if budget else None,
+    )
+    log.info('Warmed regulome caches with %d queries', done)
+
+
+def start_warmer(event):
+    app = event.object
+    thread = threading.Thread(
+        target=warm, args=(app, app.registry.settings),
+        name='regulome-warmer', daemon=True)
+    thread.start()
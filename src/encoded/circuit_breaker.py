@@ -0,0 +1,214 @@
+""" Protect the front-end from a slow or failing genomic data service.
+"""
+from collections import deque
+import logging
+import math
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class UpstreamUnavailable(Exception):
+    """ The data service was not called or failed, retry after
+    ``retry_after`` seconds.
+    """
+
+    def __init__(self, message, retry_after):
+        super(UpstreamUnavailable, self).__init__(message)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    pass
+
+
+class OverloadedError(UpstreamUnavailable):
+    pass
+
+
+class UpstreamError(UpstreamUnavailable):
+    """ The data service could not be reached, timed out or answered with a
+    server error that is not JSON, such as a proxy's 502 page.
+    """
+
+
+class CircuitBreaker(object):
+    """ Stop calling the data service while it is failing or slow.
+
+    The breaker opens when, over the last ``window`` seconds and at least
+    ``min_requests`` calls, the proportion of failed calls reaches
+    ``error_rate`` or the proportion of calls slower than ``slow_seconds``
+    reaches ``slow_rate``. After ``open_seconds`` a single trial call is let
+    through; the breaker closes if it succeeds in time and reopens otherwise.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, window=30, min_requests=20, error_rate=0.5,
+                 slow_seconds=5, slow_rate=0.5, open_seconds=15,
+                 clock=time.monotonic):
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.calls = deque()
+        self.failures = 0
+        self.slow = 0
+        self.state = self.CLOSED
+        self.opened_at = 0
+        self.trial = False
+        self.trips = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        prefix = 'genomic_data_service.breaker_'
+        return cls(
+            window=float(settings.get(prefix + 'window', 30)),
+            min_requests=int(settings.get(prefix + 'min_requests', 20)),
+            error_rate=float(settings.get(prefix + 'error_rate', 0.5)),
+            slow_seconds=float(settings.get(prefix + 'slow_seconds', 5)),
+            slow_rate=float(settings.get(prefix + 'slow_rate', 0.5)),
+            open_seconds=float(settings.get(prefix + 'open_seconds', 15)),
+        )
+
+    def ready(self):
+        """ Whether a call would currently be let through.
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                return self.clock() >= self.opened_at + self.open_seconds
+            return not self.trial
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self.clock() >= self.opened_at + self.open_seconds:
+                self.state = self.HALF_OPEN
+                self.trial = False
+            if self.state == self.HALF_OPEN and not self.trial:
+                self.trial = True
+                return True
+            self.rejected += 1
+            return False
+
+    def retry_after(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return 0
+            return max(0, self.opened_at + self.open_seconds - self.clock())
+
+    def cancel(self):
+        """ Give back a permit from allow() that was not used.
+        """
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.trial = False
+
+    def record(self, ok, latency):
+        slow = latency >= self.slow_seconds
+        with self.lock:
+            now = self.clock()
+            if self.state != self.CLOSED:
+                # Calls started before the breaker opened are not the trial.
+                started = now - latency
+                if self.state == self.HALF_OPEN and self.trial and started >= self.opened_at:
+                    if ok and not slow:
+                        log.info('Data service circuit closed')
+                        self.state = self.CLOSED
+                        self._reset()
+                    else:
+                        self._open(now)
+                return
+            self.calls.append((now, ok, slow))
+            self.failures += not ok
+            self.slow += slow
+            while self.calls and self.calls[0][0] < now - self.window:
+                _, old_ok, old_slow = self.calls.popleft()
+                self.failures -= not old_ok
+                self.slow -= old_slow
+            count = len(self.calls)
+            if count < self.min_requests:
+                return
+            if self.failures >= count * self.error_rate or self.slow >= count * self.slow_rate:
+                log.warning(
+                    'Data service circuit opened: %d failed and %d slow of %d calls',
+                    self.failures, self.slow, count)
+                self.trips += 1
+                self._open(now)
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.trial = False
+        self._reset()
+
+    def _reset(self):
+        self.calls.clear()
+        self.failures = 0
+        self.slow = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'trips': self.trips,
+                'rejected': self.rejected,
+            }
+
+
+class Admission(object):
+    """ Bound the number of concurrent data service calls.
+
+    A call waits up to ``wait`` seconds for one of ``limit`` slots before it
+    is shed. A limit of 0 admits everything.
+    """
+
+    def __init__(self, limit=0, wait=0.5):
+        self.limit = limit
+        self.wait = wait
+        self.semaphore = threading.BoundedSemaphore(limit) if limit > 0 else None
+        self.lock = threading.Lock()
+        self.shed = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        prefix = 'genomic_data_service.'
+        return cls(
+            limit=int(settings.get(prefix + 'max_concurrent', 0)),
+            wait=float(settings.get(prefix + 'queue_timeout', 0.5)),
+        )
+
+    def try_acquire(self):
+        return self.semaphore is None or self.semaphore.acquire(blocking=False)
+
+    def acquire(self):
+        if self.semaphore is None or self.semaphore.acquire(timeout=self.wait):
+            return True
+        self.reject()
+        return False
+
+    def reject(self):
+        with self.lock:
+            self.shed += 1
+
+    def release(self):
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'shed': self.shed,
+        }
@@ -0,0 +1,194 @@
+"""\
+Benchmark the regulome front-end against a local stand-in data service.
+
+Requests regulome-search and regulome-summary JSON through encoded:main with
+the data service replaced by a stand-in answering after --latency seconds,
+and reports throughput and p50/p95/p99 latency per route:
+
+    %(prog)s --requests 2000 --concurrency 8 --latency 0.02
+
+To use the settings of a configfile (its data service url is replaced):
+
+    %(prog)s development.ini --app-name app
+
+Each request queries different regions so the regulome caches miss, use
+--cached to repeat one query per route instead. With --max-p95 the command
+exits non-zero when any route is slower, for use in CI.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import json
+import logging
+import sys
+import threading
+import time
+from encoded.data_service_standin import (
+    StandInDataService,
+    server_url,
+)
+
+EPILOG = __doc__
+
+logger = logging.getLogger(__name__)
+
+ROUTES = ('search', 'summary')
+
+
+def route_path(route, n, regions):
+    if route == 'search':
+        query = 'regions=rs%d' % n
+    else:
+        query = 'regions=' + '%0D%0A'.join(
+            'rs%d' % i for i in range(n * regions, (n + 1) * regions))
+    return '/regulome-%s/?%s&genome=GRCh38&format=json' % (route, query)
+
+
+def percentile(samples, percentile):
+    """ Nearest-rank percentile of sorted samples.
+    """
+    if not samples:
+        return None
+    rank = max(0, int(round(len(samples) * percentile / 100.0 + 0.5)) - 1)
+    return samples[min(rank, len(samples) - 1)]
+
+
+def run(app, routes, requests, concurrency, regions, cached=False, first=0):
+    """ Make ``requests`` requests per route with ``concurrency`` threads,
+    numbering queries from ``first``. Returns {route: (latencies, errors)}
+    and the elapsed seconds.
+    """
+    from webob import Request
+    jobs = itertools.count()
+    total = requests * len(routes)
+    results = {route: ([], []) for route in routes}
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            n = next(jobs)
+            if n >= total:
+                return
+            route = routes[n % len(routes)]
+            path = route_path(route, 0 if cached else first + n, regions)
+            start = time.perf_counter()
+            response = Request.blank(path, headers={'Accept': 'application/json'}).get_response(app)
+            latency = time.perf_counter() - start
+            with lock:
+                results[route][0].append(latency)
+                if response.status_int >= 400:
+                    results[route][1].append(response.status)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return results, time.perf_counter() - start
+
+
+def summarize(results, elapsed):
+    report = {}
+    for route, (latencies, errors) in results.items():
+        latencies = sorted(latencies)
+        report[route] = {
+            'requests': len(latencies),
+            'errors': len(errors),
+            'throughput': len(latencies) / elapsed if elapsed else None,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+        }
+    return report
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Benchmark the regulome front-end", epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--app-name', help="Pyramid app name in configfile")
+    parser.add_argument('--requests', type=int, default=500,
+        help="Requests per route")
+    parser.add_argument('--warmup', type=int, default=20,
+        help="Unmeasured requests per route first")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--routes', default=','.join(ROUTES),
+        help="Comma separated routes out of: %s" % ', '.join(ROUTES))
+    parser.add_argument('--regions', type=int, default=10,
+        help="Regions per regulome-summary query")
+    parser.add_argument('--cached', action='store_true',
+        help="Repeat one query per route")
+    parser.add_argument('--latency', type=float, default=0.0,
+        help="Stand-in data service latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0,
+        help="Random extra stand-in latency up to this many seconds")
+    parser.add_argument('--payloads',
+        help="Directory of recorded search.json and summary.json responses")
+    parser.add_argument('--variants-per-region', type=int, default=1)
+    parser.add_argument('--variant-bytes', type=int, default=0,
+        help="Padding added to each generated variant")
+    parser.add_argument('--max-p95', type=float,
+        help="Fail when a route's p95 exceeds this many milliseconds")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    parser.add_argument('config_uri', nargs='?', help="path to configfile")
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    routes = tuple(route.strip() for route in args.routes.split(',') if route.strip())
+    unknown = set(routes) - set(ROUTES)
+    if unknown:
+        parser.error('Unknown routes: %s' % ', '.join(sorted(unknown)))
+
+    standin = StandInDataService(
+        payload_dir=args.payloads,
+        latency=args.latency,
+        jitter=args.jitter,
+        variants_per_region=args.variants_per_region,
+        variant_bytes=args.variant_bytes,
+    )
+    server = standin.serve()
+
+    settings = {'pyramid.reload_templates': False}
+    if args.config_uri:
+        from pyramid import paster
+        paster.setup_logging(args.config_uri)
+        settings = dict(paster.get_appsettings(args.config_uri, args.app_name))
+    settings.update({
+        'genomic_data_service_url': server_url(server),
+        'regulome_cache.shared': 'none',
+        'regulome_warmer.logs': '',
+        'renderer.prespawn': 'false',
+    })
+    from encoded import main as app_main
+    app = app_main(settings)
+
+    if args.warmup:
+        run(app, routes, args.warmup, args.concurrency, args.regions, args.cached)
+    results, elapsed = run(
+        app, routes, args.requests, args.concurrency, args.regions, args.cached,
+        first=args.warmup * len(routes))
+    server.shutdown()
+    report = summarize(results, elapsed)
+
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print('%-10s %8s %7s %10s %9s %9s %9s' % (
+            'route', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for route, stats in sorted(report.items()):
+            print('%-10s %8d %7d %10.1f %9.2f %9.2f %9.2f' % (
+                route, stats['requests'], stats['errors'], stats['throughput'],
+                stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000))
+
+    failed = [
+        route for route, stats in sorted(report.items())
+        if stats['errors'] or (
+            args.max_p95 is not None and stats['p95'] * 1000 > args.max_p95)
+    ]
+    if failed:
+        logger.error('Benchmark failed for: %s', ', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""\
+Serve a local stand-in for the genomic data service.
+
+    %(prog)s --port 8001 --latency 0.05 --payloads recorded/
+
+then point genomic_data_service_url at http://127.0.0.1:8001/
+"""
+import logging
+import time
+from encoded.data_service_standin import (
+    StandInDataService,
+    server_url,
+)
+
+EPILOG = __doc__
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Serve a stand-in genomic data service", epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.0,
+        help="Response latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0,
+        help="Random extra latency up to this many seconds")
+    parser.add_argument('--payloads',
+        help="Directory of recorded search.json and summary.json responses")
+    parser.add_argument('--variants-per-region', type=int, default=1)
+    parser.add_argument('--variant-bytes', type=int, default=0,
+        help="Padding added to each generated variant")
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    logging.getLogger('encoded').setLevel(logging.INFO)
+    server = StandInDataService(
+        payload_dir=args.payloads,
+        latency=args.latency,
+        jitter=args.jitter,
+        variants_per_region=args.variants_per_region,
+        variant_bytes=args.variant_bytes,
+    ).serve(args.host, args.port)
+    logger.info('Serving stand-in data service at %s', server_url(server))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
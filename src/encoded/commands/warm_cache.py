@@ -0,0 +1,74 @@
+"""\
+Replay the regulome queries most requested in access logs to warm caches.
+
+To warm the caches of a running server from nginx logs:
+
+    %(prog)s production.ini --url http://localhost:6543 /var/log/nginx/access.log*
+
+Without --url the queries go through an app loaded from the configfile,
+which only warms the shared cache tier.
+
+For the development.ini you must supply the paster app name:
+
+    %(prog)s development.ini --app-name app /var/log/nginx/access.log
+"""
+import logging
+from encoded.cache_warmer import (
+    app_getter,
+    replay,
+    top_queries,
+)
+
+EPILOG = __doc__
+
+logger = logging.getLogger(__name__)
+
+
+def url_getter(base_url):
+    import requests
+    session = requests.Session()
+
+    def get(path):
+        response = session.get(
+            base_url.rstrip('/') + path, headers={'Accept': 'application/json'},
+            allow_redirects=False)
+        return response.status_code
+    return get
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Warm regulome caches from access logs", epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--app-name', help="Pyramid app name in configfile")
+    parser.add_argument('--url', help="Warm a running server instead")
+    parser.add_argument('--top', type=int, default=1000,
+        help="Number of most requested queries to replay")
+    parser.add_argument('--rate', type=float, default=5,
+        help="Queries per second")
+    parser.add_argument('--budget', type=float,
+        help="Stop after this many seconds")
+    parser.add_argument('config_uri', help="path to configfile")
+    parser.add_argument('logs', nargs='+', help="access log files or globs")
+    args = parser.parse_args()
+
+    from pyramid import paster
+    logging.basicConfig()
+    if args.url:
+        paster.setup_logging(args.config_uri)
+        get = url_getter(args.url)
+    else:
+        get = app_getter(paster.get_app(args.config_uri, args.app_name))
+    # Loading app will have configured from config file. Reconfigure here:
+    logging.getLogger('encoded').setLevel(logging.INFO)
+
+    queries = top_queries(args.logs, args.top)
+    logger.info('Replaying %d queries', len(queries))
+    done = replay(queries, get, rate=args.rate, budget=args.budget)
+    logger.info('Replayed %d queries', done)
+
+
+if __name__ == '__main__':
+    main()
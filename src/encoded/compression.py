@@ -0,0 +1,125 @@
+""" Negotiated gzip/brotli compression with a store of compressed bodies.
+
+Compressed bodies are kept by ETag and encoding, so a repeat response with
+the same body is sent precompressed instead of being compressed again. The
+view always runs, so what is served follows the response cache settings.
+Brotli is offered when the ``brotli`` package is installed.
+"""
+from .response_cache import LRUCache
+import gzip
+import humanfriendly
+
+try:
+    import brotli
+except ImportError:  # Optional
+    brotli = None
+
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/html')
+ENCODING_SUFFIXES = ('-br', '-gzip')
+
+
+def includeme(config):
+    config.registry['compressed_responses'] = CompressedResponses.from_settings(
+        config.registry.settings)
+    config.add_tween(
+        '.compression.compression_tween_factory',
+        under='.renderers.normalize_cookie_tween_factory',
+        over='.conditional.conditional_tween_factory',
+    )
+
+
+class CompressedResponses(object):
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, min_size=1024,
+                 max_body=16 * 1024 * 1024, gzip_level=6, brotli_quality=6):
+        self.store = LRUCache(max_bytes)
+        self.min_size = min_size
+        self.max_body = max_body
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.encodings = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+    @classmethod
+    def from_settings(cls, settings):
+        prefix = 'regulome_compression.'
+        return cls(
+            max_bytes=humanfriendly.parse_size(settings.get(prefix + 'max_bytes', '64MB')),
+            min_size=humanfriendly.parse_size(settings.get(prefix + 'min_size', '1KB')),
+            max_body=humanfriendly.parse_size(settings.get(prefix + 'max_body', '16MB')),
+            gzip_level=int(settings.get(prefix + 'gzip_level', 6)),
+            brotli_quality=int(settings.get(prefix + 'brotli_quality', 6)),
+        )
+
+    def encoding(self, request):
+        if 'Accept-Encoding' not in request.headers:
+            return None
+        offers = request.accept_encoding.acceptable_offers(self.encodings)
+        return offers[0][0] if offers else None
+
+    def strip_etag_suffix(self, request):
+        """ Match If-None-Match against the ETag of the uncompressed body.
+        """
+        value = request.headers.get('If-None-Match')
+        if not value:
+            return
+        for suffix in ENCODING_SUFFIXES:
+            if suffix + '"' in value:
+                value = value.replace(suffix + '"', '"')
+                request.environ['encoded.etag_suffix'] = suffix
+        request.headers['If-None-Match'] = value
+
+    def compress(self, body, encoding):
+        if encoding == 'br':
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, self.gzip_level, mtime=0)
+
+    def finish(self, request, response):
+        if response.status_int == 304:
+            suffix = request.environ.get('encoded.etag_suffix')
+            if suffix and response.etag:
+                response.etag = response.etag + suffix
+                add_vary(response, response.vary)
+            return response
+        if response.status_int != 200 or response.content_encoding:
+            return response
+        if response.content_type not in COMPRESSIBLE_TYPES:
+            return response
+        length = response.content_length
+        if length is None or length < self.min_size or length > self.max_body:
+            return response
+        add_vary(response, response.vary)
+        encoding = self.encoding(request)
+        if encoding is None:
+            return response
+        etag = response.etag
+        entry = self.store.get((etag, encoding)) if etag else None
+        if entry is None:
+            entry = (self.compress(response.body, encoding), response.headers['Content-Type'])
+            if etag:
+                self.store.set((etag, encoding), entry, len(entry[0]))
+        response.body = entry[0]
+        response.content_encoding = encoding
+        if etag:
+            response.etag = etag + '-' + encoding
+        return response
+
+    def stats(self):
+        return self.store.stats()
+
+
+def add_vary(response, vary):
+    vary = tuple(vary or ())
+    if 'Accept-Encoding' not in vary:
+        vary += ('Accept-Encoding',)
+    response.vary = vary
+
+
+def compression_tween_factory(handler, registry):
+    compressed = registry['compressed_responses']
+
+    def compression_tween(request):
+        compressed.strip_etag_suffix(request)
+        return compressed.finish(request, handler(request))
+
+    return compression_tween
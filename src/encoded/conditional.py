@@ -0,0 +1,189 @@
+""" Strong ETags, conditional GET and per-route Cache-Control.
+
+Responses carry an ETag hashed from their body. The ETag served for each
+request (path, canonical query and negotiated representation) is
+remembered, so a request whose If-None-Match already matches is answered
+with 304 before the view, and so the data service, is called. The ETag of
+a regulome search or summary is only trusted while the response cache
+still holds the response it was hashed from; once that entry expires or
+is replaced the view runs again. Other validators expire after
+``regulome_etag.ttl`` seconds. Changing ``regulome_etag.release`` with a
+data release invalidates them all.
+"""
+from pyramid.httpexceptions import HTTPNotModified
+from .regulome_query import (
+    InvalidRegionsError,
+    normalize_query,
+)
+from .renderer_pool import StreamedPage
+from .response_cache import (
+    LRUCache,
+    canonical_query_string,
+)
+import hashlib
+import humanfriendly
+
+
+CACHE_CONTROL_PREFIX = 'regulome_cache_control.'
+ETAG_CONTENT_TYPES = ('application/json', 'text/html')
+REGULOME_PATHS = ('/regulome-search', '/regulome-summary')
+
+
+def includeme(config):
+    config.registry['conditional_responses'] = ConditionalResponses.from_settings(
+        config.registry.settings)
+    config.add_tween(
+        '.conditional.conditional_tween_factory',
+        under='.renderers.normalize_cookie_tween_factory',
+        over=('.renderers.page_or_json', '.renderers.debug_page_or_json'),
+    )
+
+
+class ConditionalResponses(object):
+
+    def __init__(self, policies=None, max_bytes=8 * 1024 * 1024, ttl=3600,
+                 release='', max_body=16 * 1024 * 1024):
+        self.policies = policies or {}
+        self.validators = LRUCache(max_bytes, ttl)
+        self.release = release
+        self.max_body = max_body
+        self.response_cache = None
+        self.not_modified = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        prefix = 'regulome_etag.'
+        ttl = settings.get(prefix + 'ttl', '3600')
+        return cls(
+            policies={
+                key[len(CACHE_CONTROL_PREFIX):]: value.strip()
+                for key, value in settings.items()
+                if key.startswith(CACHE_CONTROL_PREFIX)
+            },
+            max_bytes=humanfriendly.parse_size(settings.get(prefix + 'max_bytes', '8MB')),
+            ttl=float(ttl) if ttl else None,
+            release=settings.get(prefix + 'release', ''),
+            max_body=humanfriendly.parse_size(settings.get(prefix + 'max_body', '16MB')),
+        )
+
+    def key(self, request):
+        query_string = request.query_string
+        if request.path_info.rstrip('/') in REGULOME_PATHS:
+            try:
+                query_string = normalize_query(query_string)
+            except (InvalidRegionsError, ValueError):
+                pass
+        else:
+            query_string = canonical_query_string(query_string)
+        return '\n'.join((
+            self.release,
+            request.path_info,
+            query_string,
+            request.GET.get('format', ''),
+            request.headers.get('Accept', ''),
+            'auth' if request.authorization is not None else '',
+        ))
+
+    def source(self, request):
+        """ Return the version of the cached response a regulome request is
+        served from, None if it is not cached, or '' for other requests.
+        """
+        path = request.path_info.rstrip('/')
+        if path not in REGULOME_PATHS:
+            return ''
+        endpoint = path[len('/regulome-'):]
+        if self.response_cache is None or not self.response_cache.enabled(endpoint):
+            return None
+        try:
+            query_string = normalize_query(request.query_string)
+        except (InvalidRegionsError, ValueError):
+            return None
+        return self.response_cache.version(self.response_cache.key(endpoint, query_string))
+
+    def known(self, request):
+        """ Return the (etag, cache control, vary) last served for the
+        request or None.
+        """
+        known = self.validators.get(self.key(request))
+        if known is None:
+            return None
+        source = self.source(request)
+        if source is None or source != known[3]:
+            return None
+        return known[:3]
+
+    def check(self, request):
+        """ Return a 304 response if If-None-Match has the known ETag.
+        """
+        if request.method not in ('GET', 'HEAD') or not request.if_none_match:
+            return None
+        known = self.known(request)
+        if known is None:
+            return None
+        etag, cache_control, vary = known
+        if etag not in request.if_none_match:
+            return None
+        self.not_modified += 1
+        return self.not_modified_response(etag, cache_control, vary)
+
+    def not_modified_response(self, etag, cache_control, vary):
+        response = HTTPNotModified()
+        response.etag = etag
+        if cache_control:
+            response.headers['Cache-Control'] = cache_control
+        if vary:
+            response.vary = vary
+        return response
+
+    def finish(self, request, response, route_name=None):
+        """ Add validators and Cache-Control to a successful GET response,
+        converting it to 304 when If-None-Match matches.
+        """
+        if request.method not in ('GET', 'HEAD') or response.status_int != 200:
+            return response
+        if 'Set-Cookie' in response.headers:
+            return response
+        cache_control = self.policies.get(route_name)
+        if cache_control and 'Cache-Control' not in response.headers:
+            response.headers['Cache-Control'] = cache_control
+        if response.content_type not in ETAG_CONTENT_TYPES:
+            return response
+        if isinstance(response.app_iter, StreamedPage):
+            return response
+        if response.content_length is not None and response.content_length > self.max_body:
+            return response
+        etag = hashlib.sha1(response.body).hexdigest()
+        response.etag = etag
+        vary = response.vary
+        source = self.source(request)
+        if source is not None:
+            self.validators.set(
+                self.key(request),
+                (etag, response.headers.get('Cache-Control'), vary, source),
+                len(etag) + len(request.path_qs) + 256,
+            )
+        if etag in request.if_none_match:
+            self.not_modified += 1
+            return self.not_modified_response(
+                etag, response.headers.get('Cache-Control'), vary)
+        return response
+
+    def stats(self):
+        stats = self.validators.stats()
+        stats['not_modified'] = self.not_modified
+        return stats
+
+
+def conditional_tween_factory(handler, registry):
+    conditional = registry['conditional_responses']
+    conditional.response_cache = registry.get('regulome_cache')
+
+    def conditional_tween(request):
+        response = conditional.check(request)
+        if response is not None:
+            return response
+        response = handler(request)
+        route = getattr(request, 'matched_route', None)
+        return conditional.finish(request, response, route and route.name)
+
+    return conditional_tween
@@ -0,0 +1,225 @@
+""" Local stand-in for the genomic data service.
+
+Serves ``/search/`` and ``/summary/`` from recorded payloads, or payloads
+generated from the query, after a configurable latency, so the regulome
+front-end can be measured without the real data service. A recorded payload
+is a data service JSON response saved as ``search.json`` or
+``summary.json`` in the payload directory; its variants are repeated to one
+per queried region times ``variants_per_region``. ``format=bed`` and
+``tsv`` queries are answered with one line of text per variant.
+
+Setting ``failure`` to an HTTP status answers every request with an HTML
+error page of that status, setting it to ``'disconnect'`` closes
+connections without an answer.
+
+Generated variants lie in the queried regions: ``variants_per_region`` at
+the position of each rsID, and one every ``spacing`` bases of each
+coordinate range. Like the data service, a variant matched by several
+regions is returned once, variants are ordered by chromosome number and
+position, query coordinates are listed in query order and regions that
+are not understood are reported in a notification.
+"""
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
+from urllib.parse import (
+    parse_qs,
+    urlsplit,
+)
+import copy
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+ENDPOINTS = ('search', 'summary')
+
+_rsid = re.compile(r'^rs(\d+)$')
+_coordinate = re.compile(r'^(chr\w+):(\d+)-(\d+)$')
+_range = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+def position_order(position):
+    chrom, start = position
+    number = chrom[3:]
+    return (int(number) if number.isdigit() else float('inf'), chrom, start)
+
+
+class StandInDataService(object):
+
+    def __init__(self, payload_dir=None, latency=0.0, jitter=0.0,
+                 variants_per_region=1, variant_bytes=0, spacing=10):
+        self.latency = latency
+        self.jitter = jitter
+        self.variants_per_region = variants_per_region
+        self.spacing = spacing
+        self.variant_bytes = variant_bytes
+        self.recorded = {}
+        self.requests = 0
+        self.failure = None
+        if payload_dir:
+            for endpoint in ENDPOINTS:
+                path = os.path.join(payload_dir, endpoint + '.json')
+                if os.path.exists(path):
+                    with open(path) as f:
+                        self.recorded[endpoint] = json.load(f)
+
+    def delay(self):
+        return self.latency + random.uniform(0, self.jitter) if self.jitter else self.latency
+
+    def positions(self, regions):
+        """ Ordered unique (chrom, start) of the variants in regions.
+        """
+        positions = set()
+        for region in regions:
+            match = _rsid.match(region)
+            if match:
+                start = int(match.group(1)) * 100
+                positions.update(
+                    ('chr1', start + n) for n in range(self.variants_per_region))
+                continue
+            match = _coordinate.match(region)
+            if match:
+                chrom, start, end = match.group(1), int(match.group(2)), int(match.group(3))
+                first = -(-start // self.spacing) * self.spacing
+                positions.update((chrom, n) for n in range(first, end, self.spacing))
+        return sorted(positions, key=position_order)
+
+    def payload(self, endpoint, query_string):
+        params = parse_qs(query_string)
+        regions = params.get('regions', [''])[0].split()
+        recorded = self.recorded.get(endpoint)
+        if recorded is not None:
+            count = len(regions) * self.variants_per_region
+            response = copy.copy(recorded)
+            samples = recorded.get('variants') or [{}]
+            variants = [samples[n % len(samples)] for n in range(count)]
+        else:
+            response = {
+                '@context': '/terms/',
+                '@type': [endpoint],
+                'assembly': params.get('genome', ['GRCh38'])[0],
+                'format': 'json',
+                'notifications': {},
+                'title': endpoint.title(),
+            }
+            invalid = [
+                region for region in regions
+                if not (_rsid.match(region) or _coordinate.match(region))
+            ]
+            if invalid:
+                response['notifications'] = {
+                    'Failed': 'Invalid region input: ' + ', '.join(invalid),
+                }
+            padding = 'N' * self.variant_bytes
+            variants = [
+                {
+                    'chrom': chrom,
+                    'start': start,
+                    'end': start + 1,
+                    'rsids': (
+                        ['rs%d' % (start // 100)] if chrom == 'chr1' and not start % 100 else []),
+                    'regulome_score': {'ranking': '2b', 'probability': '0.5'},
+                    'padding': padding,
+                }
+                for chrom, start in self.positions(regions)
+            ]
+            count = len(variants)
+        offset = int(params.get('from', ['0'])[0] or 0)
+        limit = params.get('limit', ['all'])[0]
+        if limit != 'all':
+            variants = variants[offset:offset + int(limit)]
+        response.update({
+            '@id': '/%s/?%s' % (endpoint, query_string),
+            'from': offset,
+            'query_coordinates': regions,
+            'total': count,
+            'variants': variants,
+        })
+        return response
+
+    def download(self, endpoint, query_string):
+        """ Return the variants of a format=bed or tsv query as text.
+        """
+        payload = self.payload(endpoint, query_string)
+        return ''.join(
+            '%s\t%d\t%d\t%s\n' % (
+                variant['chrom'], variant['start'], variant['end'],
+                ','.join(variant.get('rsids', [])))
+            for variant in payload['variants']
+        ).encode('utf-8')
+
+    def handle(self, path, headers=None):
+        """ Return (status, headers, body) for a request path. Downloads
+        honour a single ``Range: bytes=first-last`` request header.
+        """
+        self.requests += 1
+        if self.failure is not None:
+            return self.failure, [('Content-Type', 'text/html')], b'<html>Bad gateway</html>'
+        url = urlsplit(path)
+        endpoint = url.path.strip('/')
+        json_type = [('Content-Type', 'application/json')]
+        if endpoint == '':
+            return 200, json_type, b'{}'
+        if endpoint not in ENDPOINTS:
+            return 404, json_type, b'{"status": "error"}'
+        time.sleep(self.delay())
+        if parse_qs(url.query).get('format', ['json'])[0] not in ('bed', 'tsv'):
+            return 200, json_type, json.dumps(self.payload(endpoint, url.query)).encode('utf-8')
+        body = self.download(endpoint, url.query)
+        response_headers = [
+            ('Content-Type', 'text/plain'),
+            ('Content-Disposition', 'attachment; filename="regulome.bed"'),
+            ('Accept-Ranges', 'bytes'),
+        ]
+        match = _range.match((headers or {}).get('Range', ''))
+        if match is None:
+            return 200, response_headers, body
+        first = int(match.group(1))
+        last = min(int(match.group(2) or len(body) - 1), len(body) - 1)
+        response_headers.append(('Content-Range', 'bytes %d-%d/%d' % (first, last, len(body))))
+        return 206, response_headers, body[first:last + 1]
+
+    def serve(self, host='127.0.0.1', port=0):
+        """ Start serving on a background thread and return the server.
+        """
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                if service.failure == 'disconnect':
+                    service.requests += 1
+                    self.close_connection = True
+                    return
+                status, headers, body = service.handle(self.path, self.headers)
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format, *args)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(
+            target=server.serve_forever, name='regulome-standin', daemon=True)
+        thread.start()
+        return server
+
+
+def server_url(server):
+    host, port = server.server_address[:2]
+    return 'http://%s:%d/' % (host, port)
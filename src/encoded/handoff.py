@@ -0,0 +1,73 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+
+class Handoff(object):
+    """ Results started by one request for the request expected to follow.
+
+    ``submit`` runs a function on a small thread pool and keeps its future
+    for ``ttl`` seconds; ``take`` hands the future over once. At most
+    ``max_entries`` futures are kept, the oldest are dropped first.
+    """
+
+    def __init__(self, ttl=10, max_entries=1000, workers=4, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.executor = None
+        self.submitted = 0
+        self.taken = 0
+        if ttl > 0 and max_entries > 0:
+            self.executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='regulome-handoff')
+
+    @classmethod
+    def from_settings(cls, settings):
+        prefix = 'regulome_handoff.'
+        return cls(
+            ttl=float(settings.get(prefix + 'ttl', 10)),
+            max_entries=int(settings.get(prefix + 'max_entries', 1000)),
+            workers=int(settings.get(prefix + 'workers', 4)),
+        )
+
+    @property
+    def enabled(self):
+        return self.executor is not None
+
+    def submit(self, key, fn):
+        if self.executor is None:
+            return None
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                return entry[0]
+            future = self.executor.submit(fn)
+            self.entries[key] = (future, now + self.ttl)
+            self.entries.move_to_end(key)
+            self.submitted += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return future
+
+    def take(self, key):
+        if self.executor is None:
+            return None
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] <= self.clock():
+                return None
+            self.taken += 1
+            return entry[0]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'submitted': self.submitted,
+                'taken': self.taken,
+            }
@@ -0,0 +1,340 @@
+""" Rewrite top level members of a JSON document without decoding it.
+
+Only the top level members being rewritten or captured are decoded, the
+rest of the document is copied through as bytes. Scanning stops as soon as
+every requested member has been seen; the data service emits its keys in
+sorted order so this is normally well before the ``variants`` list.
+
+``NDJSONSplitter`` uses the same scanning to turn a document into NDJSON
+records as it streams in.
+"""
+from pyramid.response import Response
+import json
+import os
+import re
+import tempfile
+
+
+_token = re.compile(rb'["{}\[\],:]')
+_string_end = re.compile(rb'(?:[^"\\]|\\.)*"', re.DOTALL)
+_whitespace = b' \t\r\n'
+
+
+class TopLevelRewriter(object):
+    """ Incremental rewriter for the members of a top level JSON object.
+
+    ``rewrites`` maps member names to functions returning the replacement
+    value, members named in ``capture`` are decoded into ``fields``.
+    """
+
+    def __init__(self, rewrites, capture=()):
+        self.rewrites = rewrites
+        self.capture = frozenset(capture)
+        self.pending = set(rewrites) | self.capture
+        self.fields = {}
+        self.buf = b''
+        self.pos = 0
+        self.emitted = 0
+        self.depth = 0
+        self.expect_key = False
+        self.key = None
+        self.value_start = None
+
+    @property
+    def done(self):
+        return not self.pending
+
+    def feed(self, chunk):
+        if self.done and not self.buf:
+            return chunk
+        self.buf += chunk
+        out = self._scan()
+        self.buf = self.buf[self.emitted:]
+        self.pos -= self.emitted
+        if self.value_start is not None:
+            self.value_start -= self.emitted
+        self.emitted = 0
+        return out
+
+    def close(self):
+        if self.value_start is not None or self.pos < len(self.buf) and not self.done:
+            raise ValueError('Truncated JSON document')
+        out, self.buf = self.buf, b''
+        return out
+
+    def _scan(self):
+        out = []
+        buf = self.buf
+        while not self.done:
+            match = _token.search(buf, self.pos)
+            if match is None:
+                self.pos = len(buf)
+                break
+            index = match.start()
+            char = buf[index:index + 1]
+            if char == b'"':
+                end = _string_end.match(buf, index + 1)
+                if end is None:
+                    self.pos = index
+                    break
+                if self.depth == 1 and self.expect_key:
+                    self.key = json.loads(buf[index:end.end()])
+                    self.expect_key = False
+                self.pos = end.end()
+                continue
+            self.pos = index + 1
+            if char in b'{[':
+                self.depth += 1
+                if self.depth == 1:
+                    self.expect_key = char == b'{'
+            elif char in b'}]':
+                if self.depth == 1 and self.value_start is not None:
+                    out.append(self._finish_value(index))
+                self.depth -= 1
+            elif self.depth != 1:
+                continue
+            elif char == b':':
+                if self.key in self.pending:
+                    out.append(buf[self.emitted:index + 1])
+                    self.emitted = self.value_start = index + 1
+            elif char == b',':
+                if self.value_start is not None:
+                    out.append(self._finish_value(index))
+                self.expect_key = True
+
+        if self.done:
+            out.append(buf[self.emitted:])
+            self.emitted = len(buf)
+        elif self.value_start is None:
+            # Keep an unterminated string so it is scanned whole next time.
+            safe = self.pos if self.pos < len(buf) else len(buf)
+            out.append(buf[self.emitted:safe])
+            self.emitted = safe
+        return b''.join(out)
+
+    def _finish_value(self, end):
+        raw = self.buf[self.value_start:end]
+        stripped = raw.strip(_whitespace)
+        leading = raw[:len(raw) - len(raw.lstrip(_whitespace))]
+        trailing = raw[len(raw.rstrip(_whitespace)):]
+        value = json.loads(stripped)
+        key = self.key
+        if key in self.capture:
+            self.fields[key] = value
+        if key in self.rewrites:
+            value = self.rewrites[key](value)
+            raw = leading + json.dumps(value).encode('utf-8') + trailing
+        self.pending.discard(key)
+        self.value_start = None
+        self.emitted = end
+        return raw
+
+
+class NDJSONSplitter(object):
+    """ Incrementally split a top level JSON object into NDJSON records.
+
+    The members before the ``items`` list make the first record, each
+    element of the list is a record of its own, copied through unless it
+    spans lines, and any members after the list make a last record. Only
+    the element being scanned is buffered.
+    """
+
+    def __init__(self, items='variants', rewrites=None):
+        self.items = items
+        self.rewrites = rewrites or {}
+        self.members = {}
+        self.header_sent = False
+        self.buf = b''
+        self.pos = 0
+        self.depth = 0
+        self.expect_key = False
+        self.key = None
+        self.value_start = None
+        self.in_items = False
+
+    def feed(self, chunk):
+        self.buf += chunk
+        out = self._scan()
+        keep = self.pos if self.value_start is None else self.value_start
+        self.buf = self.buf[keep:]
+        self.pos -= keep
+        if self.value_start is not None:
+            self.value_start -= keep
+        return out
+
+    def close(self):
+        if self.depth or self.buf.strip(_whitespace):
+            raise ValueError('Truncated JSON document')
+        if self.members or not self.header_sent:
+            return self._record(self.members)
+        return b''
+
+    def _record(self, members):
+        self.members = {}
+        self.header_sent = True
+        return json.dumps(members).encode('utf-8') + b'\n'
+
+    def _item(self, end):
+        raw = self.buf[self.value_start:end].strip(_whitespace)
+        self.value_start = end + 1
+        if not raw:
+            return b''
+        if b'\n' in raw or b'\r' in raw:
+            raw = json.dumps(json.loads(raw)).encode('utf-8')
+        return raw + b'\n'
+
+    def _scan(self):
+        out = []
+        buf = self.buf
+        while True:
+            match = _token.search(buf, self.pos)
+            if match is None:
+                self.pos = len(buf)
+                break
+            index = match.start()
+            char = buf[index:index + 1]
+            if char == b'"':
+                end = _string_end.match(buf, index + 1)
+                if end is None:
+                    self.pos = index
+                    break
+                if self.depth == 1 and self.expect_key:
+                    self.key = json.loads(buf[index:end.end()])
+                    self.expect_key = False
+                self.pos = end.end()
+                continue
+            self.pos = index + 1
+            if char in b'{[':
+                self.depth += 1
+                if self.depth == 1:
+                    self.expect_key = char == b'{'
+                elif (self.depth == 2 and char == b'[' and self.key == self.items and
+                        self.value_start is not None):
+                    out.append(self._record(self.members))
+                    self.in_items = True
+                    self.value_start = index + 1
+            elif char in b'}]':
+                if self.in_items and self.depth == 2:
+                    out.append(self._item(index))
+                    self.in_items = False
+                    self.value_start = None
+                elif self.depth == 1 and self.value_start is not None:
+                    self._member(index)
+                self.depth -= 1
+            elif self.in_items and self.depth == 2 and char == b',':
+                out.append(self._item(index))
+            elif self.depth != 1:
+                continue
+            elif char == b':':
+                self.value_start = index + 1
+            elif char == b',':
+                if self.value_start is not None:
+                    self._member(index)
+                self.expect_key = True
+        return b''.join(out)
+
+    def _member(self, end):
+        value = json.loads(self.buf[self.value_start:end])
+        if self.key in self.rewrites:
+            value = self.rewrites[self.key](value)
+        self.members[self.key] = value
+        self.value_start = None
+
+
+class SpooledBody(object):
+    """ Body kept in memory up to ``max_size`` bytes, then in a temporary
+    file. Iterating reads the file with positional reads so several
+    responses can stream the same body concurrently.
+    """
+
+    def __init__(self, max_size, chunk_size=1 << 16):
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.file = None
+        self.size = 0
+
+    def write(self, data):
+        if not data:
+            return
+        self.size += len(data)
+        if self.file is None:
+            self.buffer.extend(data)
+            if len(self.buffer) > self.max_size:
+                self.file = tempfile.TemporaryFile()
+                self.file.write(self.buffer)
+                self.buffer = None
+        else:
+            self.file.write(data)
+
+    def finish(self):
+        if self.file is not None:
+            self.file.flush()
+        else:
+            self.buffer = bytes(self.buffer)
+
+    @property
+    def in_memory(self):
+        return self.file is None
+
+    def getvalue(self):
+        return self.buffer
+
+    def __iter__(self):
+        if self.file is None:
+            yield self.buffer
+            return
+        fd = self.file.fileno()
+        offset = 0
+        while offset < self.size:
+            chunk = os.pread(fd, min(self.chunk_size, self.size - offset), offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+
+
+class PassthroughResult(object):
+    """ A rewritten JSON body together with the captured top level fields.
+    """
+
+    def __init__(self, body, fields):
+        self.body = body
+        self.fields = fields
+
+    @property
+    def size(self):
+        return self.body.size
+
+    def response(self):
+        return JSONPassthroughResponse(self)
+
+
+class JSONPassthroughResponse(Response):
+    def __init__(self, result):
+        super(JSONPassthroughResponse, self).__init__(
+            content_type='application/json',
+            app_iter=iter(result.body),
+        )
+        self.content_length = result.size
+        self.fields = result.fields
+
+
+def rewrite_stream(chunks, rewrites, capture=(), spool_bytes=1 << 20, keep_bytes=0):
+    """ Rewrite a stream of JSON chunks into a PassthroughResult.
+
+    Returns the result and, if the original document was no larger than
+    ``keep_bytes``, its bytes (otherwise None).
+    """
+    rewriter = TopLevelRewriter(rewrites, capture)
+    body = SpooledBody(spool_bytes)
+    original = bytearray() if keep_bytes else None
+    for chunk in chunks:
+        if original is not None:
+            original.extend(chunk)
+            if len(original) > keep_bytes:
+                original = None
+        body.write(rewriter.feed(chunk))
+    body.write(rewriter.close())
+    body.finish()
+    return PassthroughResult(body, rewriter.fields), original
@@ -0,0 +1,135 @@
+""" Serve later pages of a regulome-summary from one upstream query.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from pyramid.settings import asbool
+from urllib.parse import (
+    parse_qsl,
+    urlencode,
+)
+from .response_cache import (
+    LRUCache,
+    canonical_query_string,
+)
+import hashlib
+import humanfriendly
+import logging
+import threading
+
+
+log = logging.getLogger(__name__)
+
+PAGE_PARAMS = ('cursor', 'from', 'limit')
+
+
+class CursorCache(object):
+    """ Full result sets of paged summary queries, keyed by cursor id.
+
+    When a page of a query with more than one page is fetched the whole
+    result set (``limit=all``) is loaded in the background, if it has no
+    more than ``max_variants`` variants, and kept for ``ttl`` seconds within
+    ``max_bytes``. Later pages of the same query are sliced from it. The
+    cursor id is derived from the query without its paging parameters so
+    clients paging with from/limit alone find it too.
+
+    Loading a result set is an extra upstream query, so cursors are only
+    enabled by ``regulome_cursor.enabled``.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, ttl=600, max_variants=100000,
+                 workers=2):
+        self.lru = LRUCache(max_bytes, ttl)
+        self.max_variants = max_variants
+        self.lock = threading.Lock()
+        self.loading = {}
+        self.executor = None
+        if max_bytes > 0:
+            self.executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='regulome-cursor')
+
+    @classmethod
+    def from_settings(cls, settings):
+        prefix = 'regulome_cursor.'
+        max_bytes = 0
+        if asbool(settings.get(prefix + 'enabled', False)):
+            max_bytes = humanfriendly.parse_size(settings.get(prefix + 'max_bytes', '256MB'))
+        return cls(
+            max_bytes=max_bytes,
+            ttl=float(settings.get(prefix + 'ttl', 600)),
+            max_variants=int(settings.get(prefix + 'max_variants', 100000)),
+            workers=int(settings.get(prefix + 'workers', 2)),
+        )
+
+    @property
+    def enabled(self):
+        return self.executor is not None
+
+    def split(self, query_string):
+        """ Return (page query string, full query string, offset, limit)
+        for a paged query, without any ``cursor`` parameter.
+
+        Queries without an explicit numeric limit are not paged here as the
+        data service's default page size is not known.
+        """
+        params = [
+            (key, value)
+            for key, value in parse_qsl(query_string, keep_blank_values=True)
+            if key != 'cursor'
+        ]
+        values = dict(params)
+        limit = values.get('limit', '')
+        offset = values.get('from', '0') or '0'
+        if not limit.isdigit() or not offset.isdigit():
+            return None
+        full = [(key, value) for key, value in params if key not in PAGE_PARAMS]
+        full.append(('limit', 'all'))
+        full.sort(key=lambda item: item[0])
+        return urlencode(params), urlencode(full), int(offset), int(limit)
+
+    def cursor_id(self, full_query_string):
+        key = canonical_query_string(full_query_string)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+    def get(self, cursor_id):
+        """ Return the full result set if it is loaded. While it is still
+        loading the caller fetches its page upstream rather than wait.
+        """
+        return self.lru.get(cursor_id)
+
+    def open(self, cursor_id, total, load):
+        """ Load the full result set in the background unless it is
+        already loaded, being loaded or too large.
+        """
+        if total > self.max_variants:
+            return
+        with self.lock:
+            if cursor_id in self.loading or cursor_id in self.lru:
+                return
+            future = self.loading[cursor_id] = self.executor.submit(
+                self._load, cursor_id, load)
+        return future
+
+    def _load(self, cursor_id, load):
+        try:
+            response, size = load()
+            if response is not None:
+                self.lru.set(cursor_id, response, size)
+            return response
+        finally:
+            with self.lock:
+                del self.loading[cursor_id]
+
+    def page(self, response, query_string, cursor_id, offset, limit):
+        page = dict(response)
+        page.update({
+            '@id': '/regulome-summary/?' + query_string,
+            'cursor': cursor_id,
+            'from': offset,
+            'variants': response['variants'][offset:offset + limit],
+        })
+        return page
+
+    def stats(self):
+        stats = self.lru.stats()
+        with self.lock:
+            stats['loading'] = len(self.loading)
+        return stats
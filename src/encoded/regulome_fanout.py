@@ -0,0 +1,169 @@
+""" Split large regulome-summary queries into concurrently fetched shards.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import (
+    parse_qsl,
+    urlencode,
+)
+from .regulome_query import (
+    REGION_SEPARATOR,
+    chrom_sort_key,
+    parse_region,
+)
+from .stats import bind_context
+
+
+def variant_sort_key(variant):
+    return (
+        chrom_sort_key(variant.get('chrom', '')),
+        variant.get('start', 0),
+        variant.get('end', 0),
+    )
+
+
+def disjoint_regions(regions):
+    """ Whether no variant can match two of the normalized regions: all are
+    rsIDs, or all are coordinates and none overlap.
+    """
+    parsed = [parse_region(region) for region in regions]
+    if None in parsed:
+        return False
+    keys = sorted(sort_key for sort_key, region in parsed)
+    if any(key[0] != keys[0][0] for key in keys):
+        return False
+    if keys[0][0] == 1:
+        return True
+    for previous, key in zip(keys, keys[1:]):
+        if previous[2] == key[2] and key[3] <= previous[4]:
+            return False
+    return True
+
+
+class SummaryFanout(object):
+    """ Fetch regulome-summary region lists larger than ``shard_size`` as
+    several upstream queries and merge the results.
+
+    Shards are requested from offset 0 with a limit covering the requested
+    page so the merged page is the same as the data service would return for
+    the whole list. The data service lists query coordinates in query order
+    and variants by chromosome number and position; shards are consecutive
+    runs of the normalized regions, so the merge concatenates the former and
+    sorts the latter. A variant matched by regions in two shards is merged
+    once; as the total can then only be counted when no shard is truncated,
+    paged queries are sharded only when no variant can match two regions.
+    Queries with invalid regions are not sharded, the data service reports
+    those in a single notification.
+    """
+
+    def __init__(self, shard_size=0, concurrency=4):
+        self.shard_size = shard_size
+        self.concurrency = concurrency
+        self.executor = None
+        if shard_size > 0:
+            self.executor = ThreadPoolExecutor(
+                max_workers=concurrency, thread_name_prefix='regulome-shard')
+
+    @classmethod
+    def from_settings(cls, settings):
+        prefix = 'regulome_summary.'
+        return cls(
+            shard_size=int(settings.get(prefix + 'shard_size', 500)),
+            concurrency=int(settings.get(prefix + 'shard_concurrency', 4)),
+        )
+
+    def shard_queries(self, query_string):
+        """ Return the query strings to fetch or None when not sharding.
+        """
+        if not self.shard_size:
+            return None
+        params = parse_qsl(query_string, keep_blank_values=True)
+        values = dict(params)
+        regions = values.get('regions', '').split(REGION_SEPARATOR)
+        if len(regions) <= self.shard_size:
+            return None
+        offset = int(values.get('from', 0) or 0)
+        limit = values.get('limit')
+        if offset and not limit:
+            # The page size is the data service default, which we do not know.
+            return None
+        if any(parse_region(region) is None for region in regions):
+            return None
+        if limit != 'all' and not disjoint_regions(regions):
+            return None
+        base = [(key, value) for key, value in params if key not in ('regions', 'from', 'limit')]
+        base.append(('from', '0'))
+        if limit and limit != 'all':
+            base.append(('limit', str(offset + int(limit))))
+        elif limit:
+            base.append(('limit', limit))
+        queries = []
+        for start in range(0, len(regions), self.shard_size):
+            shard = REGION_SEPARATOR.join(regions[start:start + self.shard_size])
+            queries.append(urlencode(sorted(base + [('regions', shard)])))
+        return queries
+
+    def fetch(self, queries, fetch_shard):
+        return list(self.executor.map(bind_context(fetch_shard), queries))
+
+    def fetch_iter(self, queries, fetch_shard):
+        """ Yield the responses in query order as they arrive, fetching at
+        most ``concurrency`` queries ahead so they are not all held at once.
+        """
+        fetch_shard = bind_context(fetch_shard)
+        pending = deque()
+        try:
+            for query in queries:
+                pending.append(self.executor.submit(fetch_shard, query))
+                if len(pending) > self.concurrency:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def merge(self, responses, query_string, endpoint):
+        values = dict(parse_qsl(query_string, keep_blank_values=True))
+        offset = int(values.get('from', 0) or 0)
+        limit = values.get('limit')
+        if limit == 'all':
+            page_size = None
+        elif limit:
+            page_size = int(limit)
+        else:
+            truncated = [
+                len(response['variants']) for response in responses
+                if len(response['variants']) < response['total']
+            ]
+            page_size = max(truncated) if truncated else None
+
+        unique = {}
+        for response in responses:
+            for variant in response['variants']:
+                unique.setdefault(variant_sort_key(variant), variant)
+        variants = [unique[key] for key in sorted(unique)]
+        if all(len(response['variants']) >= response['total'] for response in responses):
+            total = len(variants)
+        else:
+            total = sum(response['total'] for response in responses)
+        end = None if page_size is None else offset + page_size
+        notifications = {}
+        for response in responses:
+            notifications.update(response.get('notifications') or {})
+        query_coordinates = [
+            coordinate
+            for response in responses
+            for coordinate in response.get('query_coordinates', [])
+        ]
+
+        merged = dict(responses[0])
+        merged.update({
+            '@id': '/regulome-' + endpoint + '/?' + query_string,
+            'from': offset,
+            'notifications': notifications,
+            'query_coordinates': query_coordinates,
+            'total': total,
+            'variants': variants[offset:end],
+        })
+        return merged
@@ -0,0 +1,315 @@
+""" Bulk regulome-summary queries run as background jobs.
+
+A job is submitted with the same parameters as a regulome-summary POST,
+polled for its status and progress, and its variants downloaded as gzipped
+newline delimited JSON once done. Job status and results are kept in a
+spool directory shared by every worker process on the host. Jobs left
+queued or running by a worker process that is gone, for instance after a
+restart, are marked failed when the app starts.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from pyramid.httpexceptions import (
+    HTTPAccepted,
+    HTTPBadRequest,
+    HTTPNotFound,
+    HTTPRequestEntityTooLarge,
+    HTTPServiceUnavailable,
+)
+from pyramid.response import FileResponse
+from pyramid.view import view_config
+from urllib.parse import (
+    parse_qsl,
+    urlencode,
+)
+from .circuit_breaker import (
+    Admission,
+    CircuitBreaker,
+)
+from .regulome_fanout import (
+    SummaryFanout,
+    variant_sort_key,
+)
+from .regulome_query import (
+    REGION_SEPARATOR,
+    InvalidRegionsError,
+    normalize_query,
+)
+from .regulome_search import request_query_string
+import copy
+import datetime
+import gzip
+import json
+import logging
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+_job_id = re.compile(r'^[0-9a-f]{32}$')
+
+# Tells this process's jobs from those of an earlier process given the same pid.
+WORKER_TOKEN = secrets.token_hex(8)
+
+
+def includeme(config):
+    config.add_route('regulome-jobs', '/regulome-jobs{slash:/?}')
+    config.add_route('regulome-job', '/regulome-jobs/{job_id}{slash:/?}')
+    config.add_route('regulome-job-result', '/regulome-jobs/{job_id}/result')
+    jobs = config.registry['regulome_jobs'] = JobQueue.from_settings(
+        config.registry.settings, config.registry['genomic_data_service'])
+    jobs.fail_orphaned()
+    config.scan(__name__)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobQueue(object):
+    """ Run bulk summary jobs on a bounded local worker pool.
+
+    At most ``workers`` jobs run at once, each split into queries of
+    ``chunk_size`` regions. The chunks of all jobs share ``concurrency``
+    upstream calls, admitted by a limit and a circuit breaker of their own
+    rather than the interactive ones, so batch work neither crowds out nor
+    trips the breaker for interactive requests, and an open interactive
+    breaker does not fail jobs. Chunks are written and counted as they
+    arrive; variants matched by regions in several chunks are written once.
+    Job files older than ``ttl`` seconds are removed.
+    """
+
+    def __init__(self, client, spool_dir, workers=2, concurrency=4,
+                 chunk_size=1000, max_regions=1000000, max_queued=100, ttl=86400,
+                 breaker=None):
+        self.client = client
+        self.spool_dir = spool_dir
+        self.max_regions = max_regions
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self.fanout = SummaryFanout(chunk_size, concurrency)
+        self.admission = Admission(concurrency, wait=client.timeout[1])
+        self.breaker = breaker or CircuitBreaker()
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='regulome-job')
+        self.lock = threading.Lock()
+        self.queued = 0
+        os.makedirs(spool_dir, exist_ok=True)
+
+    @classmethod
+    def from_settings(cls, settings, client):
+        prefix = 'regulome_jobs.'
+        spool_dir = settings.get(prefix + 'spool_dir') or os.path.join(
+            tempfile.gettempdir(), 'regulome-jobs')
+        return cls(
+            client,
+            spool_dir,
+            workers=int(settings.get(prefix + 'workers', 2)),
+            concurrency=int(settings.get(prefix + 'concurrency', 4)),
+            chunk_size=int(settings.get(prefix + 'chunk_size', 1000)),
+            max_regions=int(settings.get(prefix + 'max_regions', 1000000)),
+            max_queued=int(settings.get(prefix + 'max_queued', 100)),
+            ttl=float(settings.get(prefix + 'ttl', 86400)),
+            breaker=CircuitBreaker.from_settings(settings),
+        )
+
+    def path(self, job_id, suffix):
+        return os.path.join(self.spool_dir, job_id + suffix)
+
+    def status(self, job_id):
+        try:
+            with open(self.path(job_id, '.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def result_path(self, job_id):
+        return self.path(job_id, '.ndjson.gz')
+
+    def save(self, job):
+        path = self.path(job['id'], '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(job, f)
+        os.replace(path + '.tmp', path)
+
+    def submit(self, query_string):
+        """ Queue a job for a normalized summary query string.
+        """
+        with self.lock:
+            if self.queued >= self.max_queued:
+                raise JobQueueFull()
+            self.queued += 1
+        self.cleanup()
+        params = [
+            (key, value)
+            for key, value in parse_qsl(query_string, keep_blank_values=True)
+            if key not in ('format', 'from', 'limit')
+        ]
+        params.append(('limit', 'all'))
+        query_string = urlencode(sorted(params, key=lambda item: item[0]))
+        chunks = self.fanout.shard_queries(query_string) or [query_string]
+        job = {
+            'id': secrets.token_hex(16),
+            'status': 'queued',
+            'submitted': datetime.datetime.utcnow().isoformat() + 'Z',
+            'assembly': dict(params).get('genome', 'GRCh38'),
+            'progress': {'done': 0, 'total': len(chunks)},
+            'total': 0,
+            'notifications': {},
+            'worker': [os.getpid(), WORKER_TOKEN],
+        }
+        self.save(job)
+        self.executor.submit(self.run, copy.deepcopy(job), chunks)
+        return job
+
+    def run(self, job, chunks):
+        with self.lock:
+            self.queued -= 1
+        job['status'] = 'running'
+        self.save(job)
+        result_path = self.result_path(job['id'])
+        try:
+            seen = set()
+            with gzip.open(result_path + '.tmp', 'wt') as out:
+                for response in self.fanout.fetch_iter(chunks, self.fetch):
+                    for variant in response['variants']:
+                        key = variant_sort_key(variant)
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                        out.write(json.dumps(variant))
+                        out.write('\n')
+                        job['total'] += 1
+                    job['notifications'].update(response.get('notifications') or {})
+                    job['progress']['done'] += 1
+                    self.save(job)
+            os.replace(result_path + '.tmp', result_path)
+            job['status'] = 'done'
+        except Exception as e:
+            log.exception('Regulome job %s failed', job['id'])
+            job['status'] = 'failed'
+            job['error'] = str(e)
+            if os.path.exists(result_path + '.tmp'):
+                os.remove(result_path + '.tmp')
+        job['finished'] = datetime.datetime.utcnow().isoformat() + 'Z'
+        self.save(job)
+
+    def orphaned(self, job):
+        if job['status'] not in ('queued', 'running'):
+            return False
+        pid, token = job.get('worker') or (None, None)
+        if token == WORKER_TOKEN:
+            return False
+        return pid is None or pid == os.getpid() or not process_alive(pid)
+
+    def fail_orphaned(self):
+        """ Mark jobs whose worker process is gone as failed.
+        """
+        for name in os.listdir(self.spool_dir):
+            if not name.endswith('.json'):
+                continue
+            job = self.status(name[:-len('.json')])
+            if job is None or not self.orphaned(job):
+                continue
+            log.warning(
+                'Regulome job %s was %s in a process that is gone', job['id'], job['status'])
+            job['status'] = 'failed'
+            job['error'] = 'Interrupted by a restart, please resubmit'
+            job['finished'] = datetime.datetime.utcnow().isoformat() + 'Z'
+            self.save(job)
+
+    def fetch(self, query_string):
+        upstream_response = self.client.get(
+            self.client.path('summary', query_string),
+            admission=self.admission, breaker=self.breaker)
+        if upstream_response.status_code != 200:
+            raise RuntimeError(
+                'Data service responded %d' % upstream_response.status_code)
+        return upstream_response.json()
+
+    def cleanup(self):
+        expires = time.time() - self.ttl
+        for name in os.listdir(self.spool_dir):
+            path = os.path.join(self.spool_dir, name)
+            try:
+                if os.stat(path).st_mtime < expires:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+def job_response(request, job):
+    response = {
+        '@id': request.route_path('regulome-job', job_id=job['id'], slash='/'),
+        '@type': ['regulome-job'],
+    }
+    response.update((key, value) for key, value in job.items() if key != 'worker')
+    if job['status'] == 'done':
+        response['result'] = request.route_path('regulome-job-result', job_id=job['id'])
+    return response
+
+
+def get_job(request):
+    job_id = request.matchdict['job_id']
+    job = None
+    if _job_id.match(job_id):
+        job = request.registry['regulome_jobs'].status(job_id)
+    if job is None:
+        raise HTTPNotFound()
+    return job
+
+
+@view_config(route_name='regulome-jobs', request_method='POST')
+def regulome_job_submit(context, request):
+    jobs = request.registry['regulome_jobs']
+    try:
+        query_string = normalize_query(request_query_string(request))
+    except InvalidRegionsError as e:
+        raise HTTPBadRequest('Invalid region input: ' + ', '.join(e.regions))
+    regions = dict(parse_qsl(query_string)).get('regions')
+    if not regions:
+        raise HTTPBadRequest('No regions given')
+    if regions.count(REGION_SEPARATOR) >= jobs.max_regions:
+        raise HTTPRequestEntityTooLarge(
+            'A job is limited to %d regions' % jobs.max_regions)
+    try:
+        job = jobs.submit(query_string)
+    except JobQueueFull:
+        raise HTTPServiceUnavailable(headers={'Retry-After': '60'})
+    request.response.status = HTTPAccepted.code
+    request.response.location = request.route_url(
+        'regulome-job', job_id=job['id'], slash='/')
+    return job_response(request, job)
+
+
+@view_config(route_name='regulome-job', request_method='GET')
+def regulome_job_status(context, request):
+    return job_response(request, get_job(request))
+
+
+@view_config(route_name='regulome-job-result', request_method='GET')
+def regulome_job_result(context, request):
+    job = get_job(request)
+    if job['status'] != 'done':
+        raise HTTPNotFound('Job %s is %s' % (job['id'], job['status']))
+    response = FileResponse(
+        request.registry['regulome_jobs'].result_path(job['id']),
+        request=request,
+        content_type='application/gzip',
+    )
+    response.content_disposition = 'attachment; filename="regulome-%s.ndjson.gz"' % job['id']
+    return response
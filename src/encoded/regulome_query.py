@@ -0,0 +1,164 @@
+""" Normalize regulome region queries before they are sent upstream.
+
+Equivalent queries normalize to the same query string so they share cache
+entries and in-flight upstream calls.
+"""
+from urllib.parse import (
+    parse_qsl,
+    urlencode,
+)
+import re
+
+
+GENOME_ALIASES = {
+    'grch37': 'GRCh37',
+    'hg19': 'GRCh37',
+    'grch38': 'GRCh38',
+    'hg38': 'GRCh38',
+}
+
+REGION_SEPARATOR = '\r\n'
+
+_rsid = re.compile(r'^rs(\d+)$', re.IGNORECASE)
+_coordinate = re.compile(r'^(?:chr)?(\w+):(\d[\d,]*)-(\d[\d,]*)$', re.IGNORECASE)
+_bed = re.compile(r'^(?:chr)?(\w+)\s+(\d+)\s+(\d+)(?:\s.*)?$', re.IGNORECASE)
+_chrom_field = re.compile(r'^chr\w+$', re.IGNORECASE)
+
+
+class InvalidRegionsError(ValueError):
+    def __init__(self, regions, assembly):
+        super(InvalidRegionsError, self).__init__(regions)
+        self.regions = regions
+        self.assembly = assembly
+
+
+def normalize_chrom(chrom):
+    if chrom.lower() in ('x', 'y', 'm', 'mt'):
+        return 'chr' + chrom.upper().replace('MT', 'M')
+    return 'chr' + chrom
+
+
+def chrom_sort_key(chrom):
+    """ Order numbered chromosomes by number, then the others by name.
+    """
+    number = chrom[3:] if chrom.lower().startswith('chr') else chrom
+    return (int(number) if number.isdigit() else float('inf'), chrom)
+
+
+def parse_region(text):
+    """ Return a sort key and normalized form for one region or None.
+    """
+    text = text.strip()
+    match = _rsid.match(text)
+    if match:
+        number = int(match.group(1))
+        return (1, '', number, number), 'rs%d' % number
+    match = _coordinate.match(text) or _bed.match(text)
+    if match is None:
+        return None
+    chrom = normalize_chrom(match.group(1))
+    start, end = (int(match.group(n).replace(',', '')) for n in (2, 3))
+    if start > end:
+        return None
+    return (0,) + chrom_sort_key(chrom) + (start, end), '%s:%d-%d' % (chrom, start, end)
+
+
+def split_regions(values):
+    for value in values:
+        for line in value.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            # BED lines keep their whitespace and extra columns, unless the
+            # line is several BED regions, anything else may list several
+            # regions on one line.
+            if _bed.match(line):
+                for region in split_bed(line):
+                    yield region
+            else:
+                for part in re.split(r'[\s;]+', line):
+                    if part:
+                        yield part
+
+
+def split_bed(line):
+    """ Split a line at every field naming a chromosome after the first
+    three, keeping other extra columns with their region.
+    """
+    fields = line.split()
+    if len(fields) > 3 and _chrom_field.match(fields[3]):
+        rest = ' '.join(fields[3:])
+        return [' '.join(fields[:3])] + (split_bed(rest) if _bed.match(rest) else [rest])
+    return [line]
+
+
+def normalize_regions(values):
+    """ Return (sorted unique regions, invalid regions).
+    """
+    parsed = {}
+    invalid = []
+    for text in split_regions(values):
+        result = parse_region(text)
+        if result is None:
+            if text not in invalid:
+                invalid.append(text)
+        else:
+            sort_key, region = result
+            parsed.setdefault(region, sort_key)
+    regions = sorted(parsed, key=parsed.get)
+    return regions, invalid
+
+
+def normalize_genome(genome):
+    return GENOME_ALIASES.get(genome.strip().lower(), genome.strip())
+
+
+def normalize_query(query_string):
+    """ Return the canonical form of a regulome query string.
+
+    ``regions`` values are parsed, normalized, sorted and deduplicated and
+    the genome is mapped to its canonical assembly name. ``format=json`` is
+    dropped as it is the data service default. Unparseable regions
+    are passed through for the data service to report, unless no region is
+    valid at all in which case InvalidRegionsError is raised.
+    """
+    params = parse_qsl(query_string, keep_blank_values=True)
+    region_values = [value for key, value in params if key == 'regions']
+    params = [
+        (key, value) for key, value in params
+        if key != 'regions' and (key, value) != ('format', 'json')
+    ]
+    params = [
+        (key, normalize_genome(value) if key == 'genome' else value)
+        for key, value in params
+    ]
+    if region_values:
+        regions, invalid = normalize_regions(region_values)
+        if not regions:
+            genome = dict(params).get('genome', 'GRCh38')
+            raise InvalidRegionsError(invalid, genome)
+        params.append(('regions', REGION_SEPARATOR.join(regions + invalid)))
+    params.sort(key=lambda item: item[0])
+    return urlencode(params)
+
+
+def invalid_regions_response(endpoint, query_string, page_title, error):
+    """ Empty result in the shape the data service uses for failed queries,
+    sent with status 400.
+    """
+    message = 'Invalid region input'
+    if error.regions:
+        message += ': ' + ', '.join(error.regions)
+    return {
+        '@context': '/terms/',
+        '@id': ('/regulome-' + endpoint + '/?' + query_string).replace('&format=json', ''),
+        '@type': ['regulome-' + endpoint],
+        'assembly': error.assembly,
+        'format': 'json',
+        'from': 0,
+        'notifications': {'Failed': message},
+        'query_coordinates': [],
+        'title': page_title,
+        'total': 0,
+        'variants': [],
+    }
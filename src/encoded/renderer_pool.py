@@ -0,0 +1,663 @@
+""" A pool of Node server-side renderer processes shared by all threads.
+
+subprocess_middleware keeps one renderer process per thread, so a slow
+render holds up every later request on that thread. Here ``size`` processes
+are spawned up front and a render takes whichever is idle, waiting in a
+queue of at most ``queue_size`` requests for up to ``queue_timeout``
+seconds. A render taking longer than ``timeout`` seconds has its process
+killed. Processes taken out of the pool are shut down on a background
+thread, so in-flight renders never wait on them.
+
+A ``RecyclePolicy`` replaces processes that grew too large, rendered too
+many pages or ran too long. The replacement is spawned and warmed up by
+rendering the last page rendered before the old process leaves the pool,
+which keeps serving until then.
+
+Rendered pages are kept in a ``RenderedPages`` cache keyed on the route,
+the renderer bundle version and the JSON response rendered, so repeat
+renders of the same payload skip Node.
+
+Pages under ``renderer.stream_paths`` are streamed: a ``PageShell`` with the
+doctype and preload links for the stylesheet and app bundle is sent before
+the view runs, so the browser fetches them while the data service is queried
+and the page rendered, and the rendered page follows. The status and
+headers, Server-Timing included, are sent before the view runs, so the
+status is always 200 and the view can no longer set headers.
+"""
+from collections import (
+    Counter,
+    deque,
+)
+from pyramid.httpexceptions import HTTPServiceUnavailable
+from pyramid.response import Response
+from pyramid.settings import (
+    asbool,
+    aslist,
+)
+from pyramid.threadlocal import manager
+from subprocess_middleware.response import (
+    response_from_file,
+    response_to_file,
+)
+from subprocess_middleware.tween import TransformErrorResponse
+from subprocess_middleware.worker import (
+    cleanup,
+    worker_processes,
+)
+from .response_cache import LRUCache
+from .stats import bind_context
+import hashlib
+import html
+import humanfriendly
+import json
+import logging
+import os
+import posixpath
+import re
+import psutil
+import subprocess
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+# Largest JSON response kept to warm up replacement renderers.
+WARMUP_MAX_BYTES = 1024 * 1024
+
+DOCTYPE = b'<!DOCTYPE html>\n'
+# Build assets preloaded by the page shell: (chunk, file name pattern, as).
+SHELL_ASSETS = (
+    ('style', re.compile(r'^\./css/style(\.[0-9a-z]+)?\.css$'), 'style'),
+    ('bundle', re.compile(r'\.js$'), 'script'),
+)
+
+
+class RendererBusy(Exception):
+    """ No renderer became free in time or the queue is full.
+    """
+
+
+class Renderer(object):
+    def __init__(self, args, **kw):
+        self.process = subprocess.Popen(
+            args, close_fds=True,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            **kw
+        )
+        worker_processes.add(self.process)
+        self.started = time.monotonic()
+        self.renders = 0
+        self.timed_out = False
+        self.rss_sampled = self.started
+        self.recycling = False
+        self.replaced = False
+        self.retired = False
+
+    def kill(self):
+        self.timed_out = True
+        self.process.kill()
+
+    def render(self, response_in, Response, timeout=None):
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, self.kill)
+            timer.daemon = True
+            timer.start()
+        try:
+            response_to_file(response_in, self.process.stdin)
+            self.process.stdin.flush()
+            response = response_from_file(Response, self.process.stdout)
+        except (BrokenPipeError, OSError) as e:
+            raise ValueError('renderer exited: %r' % e)
+        finally:
+            if timer is not None:
+                timer.cancel()
+        if response is None:
+            raise ValueError('render timed out' if self.timed_out else 'missing status line')
+        self.renders += 1
+        return response
+
+    def close(self):
+        """ Stop the process and return its error output.
+        """
+        process = self.process
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        cleanup(process, close=False)
+        process.stdout.close()
+        try:
+            errout = process.stderr.read()
+        except ValueError:  # Closed at exit
+            errout = b''
+        process.stderr.close()
+        return errout
+
+
+class RecyclePolicy(object):
+    """ When to replace a renderer process: its RSS, sampled at most every
+    ``rss_interval`` seconds, is over ``rss_limit``, it has rendered
+    ``max_renders`` pages or it is ``max_age`` seconds old. Zero disables a
+    limit. Linux does not enforce RLIMIT_RSS, hence the sampling.
+    """
+
+    def __init__(self, rss_limit=256 * 1024 * 1024, max_renders=0, max_age=0,
+                 rss_interval=10, clock=time.monotonic):
+        self.rss_limit = rss_limit
+        self.max_renders = max_renders
+        self.max_age = max_age
+        self.rss_interval = rss_interval
+        self.clock = clock
+
+    @classmethod
+    def from_settings(cls, settings):
+        prefix = 'renderer.'
+        return cls(
+            rss_limit=humanfriendly.parse_size(settings.get(prefix + 'rss_limit', '256MB')),
+            max_renders=int(settings.get(prefix + 'max_renders', 0)),
+            max_age=float(settings.get(prefix + 'max_age', 0)),
+            rss_interval=float(settings.get(prefix + 'rss_interval', 10)),
+        )
+
+    def reason(self, renderer):
+        """ Return why the renderer should be recycled, or None.
+        """
+        now = self.clock()
+        if self.max_renders and renderer.renders >= self.max_renders:
+            return 'renders'
+        if self.max_age and now - renderer.started >= self.max_age:
+            return 'age'
+        if self.rss_limit and now - renderer.rss_sampled >= self.rss_interval:
+            renderer.rss_sampled = now
+            try:
+                rss = psutil.Process(renderer.process.pid).memory_info().rss
+            except psutil.Error:
+                return None
+            if rss > self.rss_limit:
+                return 'rss'
+        return None
+
+
+class RendererPool(object):
+
+    def __init__(self, args, size=4, queue_size=32, queue_timeout=10, timeout=30,
+                 policy=None, reload=False, Response=Response, **kw):
+        self.args = args
+        self.kw = kw
+        self.size = size
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self.policy = policy
+        self.reload = reload
+        self.Response = Response
+        self.lock = threading.Condition()
+        self.idle = deque()
+        self.live = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.renders = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.spawned = 0
+        self.retired = 0
+        self.recycled = Counter()
+        self.warmup = None
+
+    @classmethod
+    def from_settings(cls, settings, args, **kw):
+        prefix = 'renderer.'
+        timeout = settings.get(prefix + 'timeout', '30')
+        return cls(
+            args,
+            size=int(settings.get(prefix + 'pool_size', 4)),
+            queue_size=int(settings.get(prefix + 'queue_size', 32)),
+            queue_timeout=float(settings.get(prefix + 'queue_timeout', 10)),
+            timeout=float(timeout) if timeout else None,
+            **kw
+        )
+
+    def spawn(self):
+        renderer = Renderer(self.args, **self.kw)
+        with self.lock:
+            self.spawned += 1
+        return renderer
+
+    def start(self):
+        """ Spawn renderers up to the pool size on a background thread.
+        """
+        thread = threading.Thread(target=self.fill, name='renderer-spawn', daemon=True)
+        thread.start()
+
+    def fill(self):
+        while True:
+            with self.lock:
+                if self.live >= self.size:
+                    return
+                self.live += 1
+            try:
+                renderer = self.spawn()
+            except Exception:
+                log.exception('Could not start a renderer')
+                with self.lock:
+                    self.live -= 1
+                    self.lock.notify()
+                return
+            with self.lock:
+                self.idle.append(renderer)
+                self.lock.notify()
+
+    def acquire(self):
+        with self.lock:
+            if not self.idle and self.live >= self.size:
+                self.wait_for_renderer()
+            if self.idle:
+                return self.idle.popleft()
+            self.live += 1
+        try:
+            return self.spawn()
+        except Exception:
+            with self.lock:
+                self.live -= 1
+                self.lock.notify()
+            raise
+
+    def wait_for_renderer(self):
+        """ Queue until a renderer is idle or can be spawned. Call holding
+        the lock.
+        """
+        if self.waiting >= self.queue_size:
+            self.rejected += 1
+            raise RendererBusy('Too many pages waiting to be rendered')
+        deadline = time.monotonic() + self.queue_timeout
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            while not self.idle and self.live >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise RendererBusy('Timed out waiting for a renderer')
+                self.lock.wait(remaining)
+        finally:
+            self.waiting -= 1
+
+    def release(self, renderer, ok=True):
+        if not ok:
+            reason = 'timeout' if renderer.timed_out else 'error'
+        elif self.reload:
+            reason = 'reload'
+        elif renderer.recycling or self.policy is None:
+            reason = None
+        else:
+            reason = self.policy.reason(renderer)
+        with self.lock:
+            if renderer.replaced or reason in ('timeout', 'error', 'reload'):
+                renderer.retired = True
+                self.live -= 1
+                self.retired += 1
+                if reason:
+                    self.recycled[reason] += 1
+                self.lock.notify()
+            else:
+                self.idle.append(renderer)
+                self.lock.notify()
+                if reason is None:
+                    return
+                self.recycled[reason] += 1
+                renderer.recycling = True
+                log.info('Recycling renderer %d (%s)', renderer.process.pid, reason)
+        if ok and reason and renderer.recycling:
+            # A renderer failing while its replacement is being warmed up
+            # is retired at once, the replacement then finds it retired.
+            target, args = self.replace, (renderer,)
+        else:
+            target, args = self.retire, (renderer, ok)
+        thread = threading.Thread(
+            target=target, args=args, name='renderer-retire', daemon=True)
+        thread.start()
+
+    def replace(self, renderer):
+        """ Swap in a new process for a recycled one, which keeps serving
+        until the new one is ready.
+        """
+        try:
+            replacement = self.spawn()
+        except Exception:
+            log.exception('Could not start a renderer')
+            renderer.recycling = False
+            return
+        if self.warmup is not None:
+            status, headerlist, body = self.warmup
+            try:
+                replacement.render(
+                    self.Response(status=status, headerlist=headerlist, body=body),
+                    self.Response, self.timeout)
+            except ValueError:
+                log.warning('Replacement renderer failed to warm up', exc_info=True)
+                replacement.close()
+                renderer.recycling = False
+                return
+            replacement.renders = 0
+        with self.lock:
+            renderer.replaced = True
+            surplus = renderer.retired and self.live >= self.size
+            if not surplus:
+                self.idle.append(replacement)
+                self.live += 1
+            idle = renderer in self.idle
+            if idle:
+                self.idle.remove(renderer)
+                renderer.retired = True
+                self.live -= 1
+                self.retired += 1
+            self.lock.notify()
+        if surplus:
+            replacement.close()
+        if idle:
+            renderer.close()
+
+    def retire(self, renderer, ok):
+        errout = renderer.close()
+        if errout and not ok:
+            log.warning('Renderer exited:\n%s', errout.decode('utf-8', 'replace'))
+        if not renderer.replaced:
+            self.fill()
+
+    def __call__(self, response_in, timing=None):
+        """ Render response_in. When given a dict, ``timing`` is filled with
+        the seconds spent waiting for a renderer and rendering.
+        """
+        length = response_in.content_length
+        if response_in.status_int == 200 and length is not None and length <= WARMUP_MAX_BYTES:
+            self.warmup = (response_in.status, list(response_in.headerlist), response_in.body)
+        for attempt in (1, 2):
+            start = time.monotonic()
+            renderer = self.acquire()
+            acquired = time.monotonic()
+            if timing is not None:
+                timing['queue'] = timing.get('queue', 0) + acquired - start
+            try:
+                response_out = renderer.render(response_in, self.Response, self.timeout)
+                if timing is not None:
+                    timing['render'] = time.monotonic() - acquired
+            except ValueError as e:
+                self.release(renderer, False)
+                if renderer.timed_out:
+                    with self.lock:
+                        self.timeouts += 1
+                    raise
+                if attempt == 1:
+                    log.warning('Retrying render: %r', e)
+                    continue
+                raise
+            except Exception:
+                self.release(renderer, False)
+                raise
+            with self.lock:
+                self.renders += 1
+            self.release(renderer)
+            return response_out
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'live': self.live,
+                'idle': len(self.idle),
+                'busy': self.live - len(self.idle),
+                'waiting': self.waiting,
+                'max_waiting': self.max_waiting,
+                'renders': self.renders,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'spawned': self.spawned,
+                'retired': self.retired,
+                'recycled': dict(self.recycled),
+            }
+
+
+class RenderedPages(object):
+    """ LRU cache of rendered pages. The bundle's mtime and size are part
+    of the key, and the cache is cleared when they change.
+    """
+
+    def __init__(self, bundle, max_bytes=64 * 1024 * 1024):
+        self.bundle = bundle
+        self.store = LRUCache(max_bytes)
+        self.version = None
+
+    @classmethod
+    def from_settings(cls, settings, bundle):
+        return cls(
+            bundle,
+            max_bytes=humanfriendly.parse_size(settings.get('renderer.cache_max_bytes', '64MB')),
+        )
+
+    @property
+    def enabled(self):
+        return self.store.max_bytes > 0
+
+    def bundle_version(self):
+        try:
+            stat = os.stat(self.bundle)
+        except OSError:
+            return None
+        version = '%d-%d' % (stat.st_mtime_ns, stat.st_size)
+        if version != self.version:
+            if self.version is not None:
+                log.info('Renderer bundle changed, clearing rendered pages')
+                self.store.clear()
+            self.version = version
+        return version
+
+    def key(self, route_name, response_in):
+        """ Return the cache key for rendering a response, or None when it
+        must not be cached.
+        """
+        if response_in.status_int != 200 or 'Set-Cookie' in response_in.headers:
+            return None
+        version = self.bundle_version()
+        if version is None:
+            return None
+        digest = hashlib.sha1()
+        for part in (route_name or '', version, response_in.status):
+            digest.update(part.encode('utf-8') + b'\0')
+        for name, value in sorted(response_in.headerlist):
+            digest.update(('%s: %s\n' % (name, value)).encode('utf-8'))
+        digest.update(response_in.body)
+        return digest.hexdigest()
+
+    def get(self, key, Response):
+        entry = self.store.get(key)
+        if entry is None:
+            return None
+        status, headerlist, body = entry
+        return Response(status=status, headerlist=list(headerlist), body=body)
+
+    def set(self, key, response_out):
+        if response_out.status_int != 200:
+            return
+        body = response_out.body
+        self.store.set(
+            key, (response_out.status, tuple(response_out.headerlist), body), len(body) + 512)
+
+    def stats(self):
+        stats = self.store.stats()
+        stats['version'] = self.version
+        return stats
+
+
+class PageShell(object):
+    """ The start of a streamed page, preloading the build assets named in
+    the webpack build stats. Rebuilt when the stats file changes.
+    """
+
+    def __init__(self, stats_path, public_path='/static/build/'):
+        self.stats_path = stats_path
+        self.public_path = public_path
+        self.lock = threading.Lock()
+        self.version = None
+        self.shell = None
+
+    def get(self):
+        """ Return the shell, or None before the assets are built.
+        """
+        try:
+            stat = os.stat(self.stats_path)
+        except OSError:
+            return None
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            if version != self.version:
+                try:
+                    self.shell = self.build()
+                except ValueError as e:
+                    log.warning('Unreadable build stats %s: %r', self.stats_path, e)
+                    self.shell = None
+                self.version = version
+            return self.shell
+
+    def build(self):
+        with open(self.stats_path) as f:
+            chunks = json.load(f).get('assetsByChunkName', {})
+        links = []
+        for chunk, pattern, kind in SHELL_ASSETS:
+            files = chunks.get(chunk) or []
+            if isinstance(files, str):
+                files = [files]
+            for name in files:
+                if pattern.search(name):
+                    href = self.public_path + posixpath.normpath(name)
+                    links.append('<link rel="preload" href="%s" as="%s">' % (
+                        html.escape(href), kind))
+        if not links:
+            return None
+        return DOCTYPE + ''.join(links).encode('utf-8') + b'\n'
+
+
+def page_body(response):
+    """ What follows the shell for the response of a streamed page.
+    """
+    if 300 <= response.status_int < 400 and response.location:
+        return ('<meta http-equiv="refresh" content="0; url=%s">\n' % html.escape(
+            response.location)).encode('utf-8')
+    if response.content_type != 'text/html':
+        return ('<html><body><p>%s</p></body></html>\n' % html.escape(
+            response.status)).encode('utf-8')
+    body = response.body
+    if body[:len(DOCTYPE)].upper() == DOCTYPE.upper():
+        body = body[len(DOCTYPE):]
+    return body
+
+
+class StreamedPage(object):
+    """ app_iter sending the shell, then the page once the view and the
+    renderer are done.
+    """
+
+    def __init__(self, shell, render, request):
+        self.shell = shell
+        self.render = bind_context(render)
+        self.request = request
+
+    def __iter__(self):
+        yield self.shell
+        request = self.request
+        manager.push({'request': request, 'registry': request.registry})
+        try:
+            body = page_body(self.render(request))
+        except Exception:
+            log.exception('Error rendering streamed page %s', request.path_qs)
+            body = page_body(HTTPServiceUnavailable())
+        finally:
+            manager.pop()
+        yield body
+
+
+class RendererPoolTween(object):
+    """ SubprocessTween counterpart rendering with a RendererPool.
+    """
+
+    def __init__(self, should_transform=None, after_transform=None,
+                 transform_error=TransformErrorResponse, Response=Response,
+                 should_stream=None, build_stats=None, **kw):
+        self.should_transform = should_transform
+        self.after_transform = after_transform
+        self.should_stream = should_stream
+        self.build_stats = build_stats
+        self.transform_error = transform_error
+        self.Response = Response
+        self.kw = kw
+
+    def __call__(self, handler, registry):
+        settings = registry.settings
+        pool = registry['renderer_pool'] = RendererPool.from_settings(
+            settings,
+            policy=RecyclePolicy.from_settings(settings),
+            reload=settings['pyramid.reload_templates'],
+            Response=self.Response,
+            **self.kw
+        )
+        if asbool(settings.get('renderer.prespawn', True)):
+            pool.start()
+        pages = None
+        if not settings['pyramid.reload_templates']:
+            pages = registry['rendered_pages'] = RenderedPages.from_settings(
+                settings, self.kw['args'][-1])
+            if not pages.enabled:
+                pages = None
+        shell = None
+        stream_paths = tuple(aslist(settings.get('renderer.stream_paths', '')))
+        if stream_paths and self.should_stream and self.build_stats:
+            shell = PageShell(self.build_stats)
+        should_transform = self.should_transform
+        should_stream = self.should_stream
+        after_transform = self.after_transform
+        transform_error = self.transform_error
+
+        def renderer_pool_tween(request):
+            if shell is not None and request.path.startswith(stream_paths) \
+                    and should_stream(request):
+                start = shell.get()
+                if start is not None:
+                    response = self.Response(
+                        app_iter=StreamedPage(start, render_view, request),
+                        content_type='text/html',
+                        charset='utf-8',
+                    )
+                    response.vary = ('Accept', 'Authorization')
+                    return response
+            return render_view(request)
+
+        def render_view(request):
+            response = handler(request)
+            if should_transform and not should_transform(request, response):
+                return response
+            key = None
+            request._render_bytes_in = len(response.body)
+            if pages is not None:
+                route = getattr(request, 'matched_route', None)
+                key = pages.key(route and route.name, response)
+                rendered = pages.get(key, self.Response) if key else None
+                if rendered is not None:
+                    request._render_cached = True
+                    after_transform and after_transform(request, rendered)
+                    return rendered
+            request._render_timing = timing = {}
+            try:
+                response = pool(response, timing)
+            except RendererBusy as e:
+                response = HTTPServiceUnavailable(str(e))
+                response.headers['Retry-After'] = '1'
+            except ValueError as e:
+                response = transform_error(e.args[0])
+            else:
+                if key:
+                    pages.set(key, response)
+                after_transform and after_transform(request, response)
+            return response
+
+        return renderer_pool_tween
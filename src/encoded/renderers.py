@@ -20,11 +20,10 @@ from pyramid.traversal import (
     _join_path_tuple,
 )
 
-from subprocess_middleware.tween import SubprocessTween
 from urllib.parse import parse_qs
+from .renderer_pool import RendererPoolTween
 import logging
 import os
-import psutil
 import time
 
 
@@ -175,10 +174,31 @@ def should_transform(request, response):
     if response.content_type != 'application/json':
         return False
 
-    format = request.params.get('format')
-    if format is None:
+    if request.params.get('format') is None:
         original_vary = response.vary or ()
         response.vary = original_vary + ('Accept', 'Authorization')
+
+    if page_format(request) == 'json':
+        return False
+
+    request._transform_start = time.time()
+    return True
+
+
+def should_stream(request):
+    """ Whether to send the page shell before the view runs. Only for pages
+    negotiated or asked for as html, never other formats such as downloads.
+    """
+    if request.method != 'GET':
+        return False
+    if request.params.get('format', 'html').lower() != 'html':
+        return False
+    return page_format(request) == 'html'
+
+
+def page_format(request):
+    format = request.params.get('format')
+    if format is None:
         if request.authorization is not None:
             format = 'json'
         else:
@@ -194,55 +214,48 @@ def should_transform(request, response):
                 format = 'json'
     else:
         format = format.lower()
-        if format not in ('html', 'json'):
+        if format == 'ndjson':
+            # Errors for NDJSON requests are sent as JSON, not as a page.
+            format = 'json'
+        elif format not in ('html', 'json'):
             format = 'html'
-
-    if format == 'json':
-        return False
-
-    request._transform_start = time.time()
-    return True
+    return format
 
 
 def after_transform(request, response):
-    end = time.time()
-    duration = int((end - request._transform_start) * 1e6)
-#    stats = request._stats
-#    stats['render_count'] = stats.get('render_count', 0) + 1
-#    stats['render_time'] = stats.get('render_time', 0) + duration
-#    request._stats_html_attribute = True
-
-
-# Rendering huge pages can make the node process memory usage explode.
-# Ideally we would let the OS handle this with `ulimit` or by calling
-# `resource.setrlimit()` from  a `subprocess.Popen(preexec_fn=...)`.
-# Unfortunately Linux does not enforce RLIMIT_RSS.
-# An alternative would be to use cgroups, but that makes per-process limits
-# tricky to enforce (we would need to create one cgroup per process.)
-# So we just manually check the resource usage after each transform.
-
-rss_limit = 256 * (1024 ** 2)  # MB
-
+    duration = time.time() - request._transform_start
+    route = getattr(request, 'matched_route', None)
+    bytes_out = response.content_length
+    if bytes_out is None:
+        bytes_out = sum(len(chunk) for chunk in response.app_iter)
+    request.registry['regulome_metrics'].record_render(
+        route.name if route is not None else None,
+        duration,
+        getattr(request, '_render_timing', {}),
+        getattr(request, '_render_bytes_in', None),
+        bytes_out,
+        cached=getattr(request, '_render_cached', False),
+    )
 
-def reload_process(process):
-    return psutil.Process(process.pid).memory_info().rss > rss_limit
 
 node_env = os.environ.copy()
 node_env['NODE_PATH'] = ''
 
-page_or_json = SubprocessTween(
+page_or_json = RendererPoolTween(
     should_transform=should_transform,
     after_transform=after_transform,
-    reload_process=reload_process,
+    should_stream=should_stream,
+    build_stats=resource_filename(__name__, 'static/build/stats.json'),
     args=['node', resource_filename(__name__, 'static/build-server/renderer.js')],
     env=node_env,
 )
 
 
-debug_page_or_json = SubprocessTween(
+debug_page_or_json = RendererPoolTween(
     should_transform=should_transform,
     after_transform=after_transform,
-    reload_process=reload_process,
+    should_stream=should_stream,
+    build_stats=resource_filename(__name__, 'static/build/stats.json'),
     args=['node', resource_filename(__name__, 'static/server.js')],
     env=node_env,
 )
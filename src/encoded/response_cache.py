@@ -0,0 +1,213 @@
+from collections import OrderedDict
+from pyramid.settings import aslist
+from urllib.parse import (
+    parse_qsl,
+    urlencode,
+)
+from .shared_cache import shared_cache_from_settings
+import humanfriendly
+import sys
+import threading
+import time
+
+
+def canonical_query_string(query_string, ignore=()):
+    """ Return a stable form of a query string suitable for a cache key.
+
+    Parameters are sorted by name, keeping the relative order of repeated
+    names.
+    """
+    params = [
+        (key, value)
+        for key, value in parse_qsl(query_string, keep_blank_values=True)
+        if key not in ignore
+    ]
+    params.sort(key=lambda item: item[0])
+    return urlencode(params)
+
+
+def value_size(value):
+    """ Return the memory held by a decoded JSON value, in bytes, counting
+    objects shared between its parts, like repeated keys, once.
+    """
+    size = 0
+    seen = set()
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+    return size
+
+
+class LRUCache(object):
+    """ Thread safe LRU cache bounded by the total size of its values.
+
+    The caller supplies the size of each value as it is stored, entries
+    expire ``ttl`` seconds after they were stored. Each stored value gets a
+    new version, telling it from an earlier value stored under its key.
+    """
+
+    def __init__(self, max_bytes, ttl=None, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stores = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, default=None, count=True):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and entry[2] < self.clock():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size):
+        if size > self.max_bytes:
+            return False
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.stores += 1
+            self.entries[key] = (value, size, expires, self.stores)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+        return True
+
+    def version(self, key):
+        """ Return the version of the value stored for key or None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (self.ttl is not None and entry[2] < self.clock()):
+                return None
+            return entry[3]
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            self._remove(key)
+            return entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def _remove(self, key):
+        value, size, expires, version = self.entries.pop(key)
+        self.current_bytes -= size
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class ResponseCache(object):
+    """ Two tier cache of genomic data service responses.
+
+    The in-process tier holds rewritten responses, charged by their
+    ``value_size``, the optional shared tier holds the upstream body bytes
+    so every worker process on a host can reuse them. Stored responses are
+    also kept, for up to ``stale_ttl``, as the last known good answer to
+    serve while the data service is down.
+    """
+
+    def __init__(self, max_bytes, ttl=None, endpoints=('summary', 'search'),
+                 shared=None, stale_max_bytes=0, stale_ttl=None):
+        self.endpoints = frozenset(endpoints)
+        self.lru = LRUCache(max_bytes, ttl)
+        self.shared = shared
+        self.stale = LRUCache(stale_max_bytes, stale_ttl)
+
+    @classmethod
+    def from_settings(cls, settings):
+        prefix = 'regulome_cache.'
+        ttl = settings.get(prefix + 'ttl', '3600')
+        stale_ttl = settings.get(prefix + 'stale_ttl', '86400')
+        return cls(
+            humanfriendly.parse_size(settings.get(prefix + 'max_bytes', '64MB')),
+            ttl=float(ttl) if ttl else None,
+            endpoints=aslist(settings.get(prefix + 'endpoints', 'summary search')),
+            shared=shared_cache_from_settings(settings),
+            stale_max_bytes=humanfriendly.parse_size(
+                settings.get(prefix + 'stale_max_bytes', '32MB')),
+            stale_ttl=float(stale_ttl) if stale_ttl else None,
+        )
+
+    def enabled(self, endpoint):
+        return endpoint in self.endpoints and (
+            self.lru.max_bytes > 0 or self.stale.max_bytes > 0 or self.shared is not None)
+
+    def key(self, endpoint, query_string):
+        return endpoint + '?' + canonical_query_string(query_string)
+
+    def get(self, key):
+        return self.lru.get(key)
+
+    def set(self, key, value, size):
+        self.stale.set(key, value, size)
+        return self.lru.set(key, value, size)
+
+    def version(self, key):
+        """ Return the version of the in-process response for key or None.
+        """
+        return self.lru.version(key)
+
+    def get_stale(self, key):
+        return self.stale.get(key)
+
+    def get_shared(self, key):
+        if self.shared is None:
+            return None
+        return self.shared.get(key)
+
+    def set_shared(self, key, content):
+        if self.shared is not None:
+            self.shared.set(key, content)
+
+    def stats(self):
+        stats = self.lru.stats()
+        stats['stale'] = self.stale.stats()
+        if self.shared is not None:
+            stats['shared'] = self.shared.stats()
+        return stats
@@ -0,0 +1,239 @@
+""" Cache tier shared by every worker process on a host.
+
+Values are opaque bytes. The default backend is a SQLite file, a memcached
+backend speaking the text protocol is also available.
+"""
+from pyramid.settings import aslist
+import hashlib
+import humanfriendly
+import logging
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class SharedCache(object):
+    """ Base class keeping per-process hit and miss counters.
+    """
+
+    def __init__(self):
+        self.counter_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _count(self, name):
+        with self.counter_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, key):
+        try:
+            value = self._get(key)
+        except Exception:
+            log.warning('Shared cache get failed', exc_info=True)
+            self._count('errors')
+            value = None
+        self._count('misses' if value is None else 'hits')
+        return value
+
+    def set(self, key, value):
+        try:
+            self._set(key, value)
+        except Exception:
+            log.warning('Shared cache set failed', exc_info=True)
+            self._count('errors')
+
+    def stats(self):
+        with self.counter_lock:
+            return {
+                'backend': self.backend,
+                'hits': self.hits,
+                'misses': self.misses,
+                'errors': self.errors,
+            }
+
+
+class SQLiteCache(SharedCache):
+    """ SQLite file cache evicting the least recently used entries by size.
+
+    Access times are only refreshed once per ``touch_interval`` seconds to
+    avoid turning every hit into a write.
+    """
+    backend = 'sqlite'
+    touch_interval = 60
+
+    def __init__(self, path, max_bytes, ttl=None, clock=time.time):
+        super(SQLiteCache, self).__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.scope = threading.local()
+        with self.connection as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'key TEXT PRIMARY KEY, value BLOB, size INTEGER, '
+                'expires REAL, accessed REAL)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+
+    @property
+    def connection(self):
+        try:
+            return self.scope.connection
+        except AttributeError:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.scope.connection = conn
+            return conn
+
+    def _get(self, key):
+        now = self.clock()
+        conn = self.connection
+        row = conn.execute(
+            'SELECT value, expires, accessed FROM entries WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires, accessed = row
+        if expires is not None and expires < now:
+            conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            return None
+        if accessed < now - self.touch_interval:
+            conn.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+        return bytes(value)
+
+    def _set(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        now = self.clock()
+        expires = None if self.ttl is None else now + self.ttl
+        conn = self.connection
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                (key, sqlite3.Binary(value), size, expires, now),
+            )
+            self._evict(conn, now)
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _evict(self, conn, now):
+        conn.execute(
+            'DELETE FROM entries WHERE expires IS NOT NULL AND expires < ?', (now,))
+        total, = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        victims = []
+        for key, size in conn.execute('SELECT key, size FROM entries ORDER BY accessed'):
+            victims.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        conn.executemany('DELETE FROM entries WHERE key = ?', victims)
+
+    def stats(self):
+        stats = super(SQLiteCache, self).stats()
+        entries, size = self.connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        stats.update(entries=entries, bytes=size, max_bytes=self.max_bytes)
+        return stats
+
+
+class MemcachedCache(SharedCache):
+    """ Minimal memcached text protocol client.
+
+    Eviction is left to the memcached server (``-m``). Keys are hashed as
+    memcached restricts their length and characters.
+    """
+    backend = 'memcached'
+
+    def __init__(self, server, ttl=None, timeout=1.0):
+        super(MemcachedCache, self).__init__()
+        host, _, port = server.rpartition(':')
+        self.address = (host or '127.0.0.1', int(port or 11211))
+        self.ttl = int(ttl or 0)
+        self.timeout = timeout
+        self.scope = threading.local()
+
+    def _connect(self):
+        try:
+            return self.scope.sock, self.scope.reader
+        except AttributeError:
+            sock = socket.create_connection(self.address, self.timeout)
+            self.scope.sock = sock
+            self.scope.reader = sock.makefile('rb')
+            return sock, self.scope.reader
+
+    def _disconnect(self):
+        sock = getattr(self.scope, 'sock', None)
+        if sock is not None:
+            self.scope.reader.close()
+            sock.close()
+            del self.scope.sock, self.scope.reader
+
+    def _key(self, key):
+        return 'regulome:' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _command(self, fn):
+        try:
+            return fn(*self._connect())
+        except Exception:
+            self._disconnect()
+            raise
+
+    def _get(self, key):
+        def get(sock, reader):
+            sock.sendall(('get %s\r\n' % self._key(key)).encode('ascii'))
+            line = reader.readline()
+            if line == b'END\r\n':
+                return None
+            if not line.startswith(b'VALUE '):
+                raise ValueError('Unexpected memcached response: %r' % line)
+            size = int(line.split()[3])
+            value = reader.read(size + 2)[:size]
+            if reader.readline() != b'END\r\n':
+                raise ValueError('Unterminated memcached response')
+            return value
+        return self._command(get)
+
+    def _set(self, key, value):
+        def set_(sock, reader):
+            header = 'set %s 0 %d %d\r\n' % (self._key(key), self.ttl, len(value))
+            sock.sendall(header.encode('ascii') + value + b'\r\n')
+            line = reader.readline()
+            if line != b'STORED\r\n':
+                raise ValueError('Unexpected memcached response: %r' % line)
+        return self._command(set_)
+
+
+def shared_cache_from_settings(settings):
+    prefix = 'regulome_cache.'
+    backend = settings.get(prefix + 'shared', 'sqlite')
+    ttl = settings.get(prefix + 'ttl', '3600')
+    ttl = float(ttl) if ttl else None
+    if backend in ('', 'none', 'false'):
+        return None
+    if backend == 'sqlite':
+        path = settings.get(prefix + 'shared_path') or os.path.join(
+            tempfile.gettempdir(), 'regulome-cache.sqlite')
+        max_bytes = humanfriendly.parse_size(
+            settings.get(prefix + 'shared_max_bytes', '512MB'))
+        return SQLiteCache(path, max_bytes, ttl=ttl)
+    if backend == 'memcached':
+        servers = aslist(settings.get(prefix + 'shared_servers', '127.0.0.1:11211'))
+        return MemcachedCache(servers[0], ttl=ttl)
+    raise ValueError('Unknown regulome_cache.shared backend: %r' % backend)
@@ -0,0 +1,69 @@
+import logging
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """ Coalesce concurrent calls for the same key into one.
+
+    The first caller for a key runs the function, callers arriving while it
+    is in flight wait for and share its result (or exception). A waiter that
+    is not answered within ``timeout`` seconds runs the function itself.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.coalesced = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        timeout = settings.get('genomic_data_service.coalesce_timeout', '30')
+        return cls(timeout=float(timeout) if timeout else None)
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+
+        if leader:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+                raise
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+            return call.result
+
+        if not call.done.wait(self.timeout):
+            log.warning('Timed out waiting for in-flight call: %s', key)
+            return fn()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self):
+        with self.lock:
+            return {
+                'in_flight': len(self.calls),
+                'coalesced': self.coalesced,
+            }
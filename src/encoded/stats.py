@@ -0,0 +1,286 @@
+""" In-process metrics and per-request timings.
+
+``Metrics`` keeps counters and bucketed histograms labelled by name and a
+few label values, cheap enough to update on every request. The timings of
+the request being handled are collected in a ``RequestTimings`` reachable
+through a context variable, so code deep in the upstream client can add to
+them without the request being passed down; wrap functions run on worker
+threads with ``bind_context``.
+"""
+from contextvars import (
+    ContextVar,
+    copy_context,
+)
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.settings import (
+    asbool,
+    aslist,
+)
+from pyramid.view import view_config
+import bisect
+import threading
+import time
+
+
+SECONDS_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = tuple(1024 * 4 ** n for n in range(10))
+
+_timings = ContextVar('encoded_request_timings', default=None)
+
+# Registry entries whose stats() the stats endpoint reports.
+STATS_SOURCES = (
+    'genomic_data_service',
+    'genomic_data_service_flights',
+    'regulome_cache',
+    'regulome_cursors',
+    'regulome_handoff',
+    'conditional_responses',
+    'compressed_responses',
+    'renderer_pool',
+    'rendered_pages',
+)
+
+
+def includeme(config):
+    config.registry['regulome_metrics'] = Metrics()
+    config.add_tween(
+        '.stats.timing_tween_factory',
+        under='.renderers.normalize_cookie_tween_factory',
+        over='.compression.compression_tween_factory',
+    )
+    if asbool(config.registry.settings.get('regulome_stats.enabled', False)):
+        config.add_route('regulome-stats', '/regulome-stats{slash:/?}')
+        config.scan(__name__)
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percentile):
+        """ Upper bound of the bucket holding the percentile, None for an
+        empty histogram or the overflow bucket.
+        """
+        if not self.count:
+            return None
+        rank = self.count * percentile / 100.0
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'buckets': [
+                [bound, count]
+                for bound, count in zip(self.buckets + ('+Inf',), self.counts)
+                if count
+            ],
+        }
+
+
+class Metrics(object):
+    """ Thread safe labelled counters and histograms.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def incr(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def snapshot(self):
+        with self.lock:
+            counters = [
+                dict(labels, name=name, value=value)
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+            histograms = [
+                dict(labels, name=name, **histogram.snapshot())
+                for (name, labels), histogram in sorted(self.histograms.items())
+            ]
+        return {
+            'uptime': time.time() - self.started,
+            'counters': counters,
+            'histograms': histograms,
+        }
+
+    def record_upstream(self, endpoint, latency, status=None, size=None, retries=0):
+        """ Record one logical data service call.
+        """
+        self.observe('upstream_seconds', latency, endpoint=endpoint)
+        self.incr('upstream_responses', endpoint=endpoint, status=str(status or 'error'))
+        if size is not None:
+            self.observe('upstream_bytes', size, buckets=BYTES_BUCKETS, endpoint=endpoint)
+        if retries:
+            self.incr('upstream_retries', retries, endpoint=endpoint)
+        timings = current_timings()
+        if timings is not None:
+            timings.add('upstream', latency, endpoint)
+
+    def record_cache(self, endpoint, result):
+        self.incr('regulome_cache', endpoint=endpoint, result=result)
+        timings = current_timings()
+        if timings is not None:
+            timings.note('cache', result)
+
+    def record_render(self, route, duration, timing, bytes_in, bytes_out, cached=False):
+        """ Record one server side render of a page. ``timing`` holds the
+        renderer pool's queue and render seconds, empty for a cached page.
+        """
+        timings = current_timings()
+        if cached:
+            self.incr('render_cached', route=route)
+            if timings is not None:
+                timings.note('render', 'cached')
+            return
+        render = timing.get('render', duration)
+        self.observe('render_seconds', render, route=route)
+        if 'queue' in timing:
+            self.observe('render_queue_seconds', timing['queue'], route=route)
+        if bytes_in is not None:
+            self.observe('render_bytes_in', bytes_in, buckets=BYTES_BUCKETS, route=route)
+        self.observe('render_bytes_out', bytes_out, buckets=BYTES_BUCKETS, route=route)
+        if timings is not None:
+            timings.add('render', render, 'in=%s out=%d' % (bytes_in, bytes_out))
+            if 'queue' in timing:
+                timings.add('render_queue', timing['queue'])
+
+
+class RequestTimings(object):
+    """ Durations and notes for the Server-Timing header of one request.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.start = clock()
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.notes = {}
+
+    def add(self, name, duration, description=None):
+        with self.lock:
+            total, count, descriptions = self.spans.get(name, (0, 0, ()))
+            if description and description not in descriptions:
+                descriptions += (description,)
+            self.spans[name] = (total + duration, count + 1, descriptions)
+
+    def note(self, name, value):
+        with self.lock:
+            values = self.notes.setdefault(name, [])
+            if value not in values:
+                values.append(value)
+
+    def header(self):
+        parts = []
+        with self.lock:
+            for name, (total, count, descriptions) in sorted(self.spans.items()):
+                description = ' '.join(descriptions)
+                if count > 1:
+                    description = ('%s x%d' % (description, count)).strip()
+                part = '%s;dur=%.1f' % (name, total * 1000)
+                if description:
+                    part += ';desc="%s"' % description
+                parts.append(part)
+            for name, values in sorted(self.notes.items()):
+                parts.append('%s;desc="%s"' % (name, ' '.join(values)))
+        parts.append('app;dur=%.1f' % ((self.clock() - self.start) * 1000))
+        return ', '.join(parts)
+
+
+def current_timings():
+    return _timings.get()
+
+
+def start_timings():
+    timings = RequestTimings()
+    return timings, _timings.set(timings)
+
+
+def stop_timings(token):
+    _timings.reset(token)
+
+
+def bind_context(fn):
+    """ Return fn bound to a copy of the current context, so calls from
+    worker threads still add to the current request's timings.
+    """
+    context = copy_context()
+
+    def bound(*args):
+        return context.copy().run(fn, *args)
+    return bound
+
+
+def timing_tween_factory(handler, registry):
+    metrics = registry['regulome_metrics']
+
+    def timing_tween(request):
+        timings, token = start_timings()
+        try:
+            response = handler(request)
+        finally:
+            stop_timings(token)
+        route = getattr(request, 'matched_route', None)
+        if route is not None:
+            metrics.observe(
+                'request_seconds', timings.clock() - timings.start, route=route.name)
+        response.headers['Server-Timing'] = timings.header()
+        return response
+
+    return timing_tween
+
+
+def stats_allowed(request):
+    """ Only answer clients on an allowed address that reach the app
+    directly, not through a proxy adding X-Forwarded-For.
+    """
+    allow = aslist(request.registry.settings.get('regulome_stats.allow', '127.0.0.1 ::1'))
+    return request.remote_addr in allow and 'X-Forwarded-For' not in request.headers
+
+
+@view_config(route_name='regulome-stats', request_method='GET')
+def regulome_stats(context, request):
+    if not stats_allowed(request):
+        raise HTTPNotFound()
+    registry = request.registry
+    result = {
+        '@id': '/regulome-stats/',
+        '@type': ['regulome-stats'],
+        'metrics': registry['regulome_metrics'].snapshot(),
+    }
+    for name in STATS_SOURCES:
+        source = registry.get(name)
+        if source is not None:
+            result[name] = source.stats()
+    return result
@@ -0,0 +1,82 @@
+""" Fixtures running the regulome front-end against local stand-ins.
+"""
+import pytest
+
+
+@pytest.fixture
+def start_data_service():
+    """ Start stand-in genomic data services, stopped after the test.
+    """
+    from encoded.data_service_standin import (
+        StandInDataService,
+        server_url,
+    )
+    servers = []
+
+    def start(**kw):
+        standin = StandInDataService(**kw)
+        server = standin.serve()
+        servers.append(server)
+        standin.url = server_url(server)
+        return standin
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def data_service(start_data_service):
+    return start_data_service()
+
+
+@pytest.fixture
+def memcached():
+    """ A memcached stand-in, stopped after the test.
+    """
+    from .memcached_standin import MemcachedStandIn
+    standin = MemcachedStandIn()
+    server = standin.serve()
+    standin.address = '%s:%d' % server.server_address[:2]
+    yield standin
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def app_settings(data_service, tmp_path):
+    return {
+        'genomic_data_service_url': data_service.url,
+        'pyramid.reload_templates': False,
+        'regulome_cache.shared': 'none',
+        'regulome_warmer.logs': '',
+        'regulome_jobs.spool_dir': str(tmp_path / 'jobs'),
+        'renderer.prespawn': 'false',
+    }
+
+
+@pytest.fixture
+def make_app(app_settings):
+    """ Build a TestApp with settings added to app_settings.
+    """
+    from encoded import main
+    from webtest import TestApp
+
+    def make(settings=None):
+        app = main(dict(app_settings, **(settings or {})))
+        return TestApp(app, extra_environ={'HTTP_ACCEPT': 'application/json'})
+
+    return make
+
+
+@pytest.fixture
+def app(app_settings):
+    from encoded import main
+    return main(app_settings)
+
+
+@pytest.fixture
+def testapp(app):
+    from webtest import TestApp
+    return TestApp(app, extra_environ={'HTTP_ACCEPT': 'application/json'})
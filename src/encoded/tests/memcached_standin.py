@@ -0,0 +1,45 @@
+""" In-process server speaking the memcached text protocol get and set
+commands, enough to exercise the memcached shared cache backend.
+"""
+import socketserver
+import threading
+
+
+class MemcachedStandIn(object):
+
+    def __init__(self):
+        self.store = {}
+        self.commands = []
+
+    def serve(self, host='127.0.0.1', port=0):
+        """ Start serving on a background thread and return the server.
+        """
+        store = self.store
+        commands = self.commands
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    parts = line.split()
+                    if not parts:
+                        continue
+                    commands.append(parts[0].decode('ascii'))
+                    if parts[0] == b'get':
+                        value = store.get(parts[1])
+                        if value is not None:
+                            self.wfile.write(b'VALUE %s 0 %d\r\n%s\r\n' % (
+                                parts[1], len(value), value))
+                        self.wfile.write(b'END\r\n')
+                    elif parts[0] == b'set':
+                        size = int(parts[4])
+                        store[parts[1]] = self.rfile.read(size + 2)[:size]
+                        self.wfile.write(b'STORED\r\n')
+                    else:
+                        self.wfile.write(b'ERROR\r\n')
+
+        server = socketserver.ThreadingTCPServer((host, port), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(
+            target=server.serve_forever, name='memcached-standin', daemon=True)
+        thread.start()
+        return server
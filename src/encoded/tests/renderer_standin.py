@@ -0,0 +1,39 @@
+""" Renderer process speaking the subprocess_middleware protocol.
+
+Answers each JSON response with a small HTML page. A body containing
+``crash`` makes it exit, one containing ``slow`` sleeps for ``SLOW``
+seconds first.
+"""
+from subprocess_middleware.response import (
+    response_from_file,
+    response_to_file,
+)
+from webob import Response
+import os
+import sys
+import time
+
+
+def main():
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    while True:
+        response_in = response_from_file(Response, stdin)
+        if response_in is None:
+            return
+        body = response_in.body
+        if b'crash' in body:
+            sys.stderr.write('crashed\n')
+            sys.stderr.flush()
+            os._exit(1)
+        if b'slow' in body:
+            time.sleep(float(os.environ.get('SLOW', '1')))
+        response_out = Response(
+            body=b'<!DOCTYPE html>\n<html>%d %s</html>' % (os.getpid(), body),
+            content_type='text/html',
+        )
+        response_to_file(response_out, stdout)
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import gzip
+import threading
+
+
+LINES = [
+    '1.2.3.4 - - [01/Jan/2024:00:00:00 +0000] "GET %s HTTP/1.1" %s 512 "-" "curl"\n' % item
+    for item in [
+        ('/regulome-search/?regions=rs3&genome=GRCh38', 200),
+        ('/regulome-search/?genome=GRCh38&regions=rs3', 200),
+        ('/regulome-search/?regions=rs3&genome=GRCh38&format=json', 200),
+        ('/regulome-summary/?regions=chr1:100-200&genome=GRCh38', 200),
+        ('/regulome-summary/?regions=chr1:x-y', 200),
+        ('/regulome-search/?regions=rs4', 500),
+        ('/regulome-help/?regions=rs5', 200),
+    ]
+]
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_parse_log_lines():
+    from encoded.cache_warmer import parse_log_lines
+    assert list(parse_log_lines(LINES)) == [
+        ('search', 'genome=GRCh38&regions=rs3'),
+        ('search', 'genome=GRCh38&regions=rs3'),
+        ('search', 'genome=GRCh38&regions=rs3'),
+        ('summary', 'genome=GRCh38&regions=chr1%3A100-200'),
+    ]
+
+
+def test_top_queries(tmp_path):
+    from encoded.cache_warmer import top_queries
+    (tmp_path / 'access.log').write_text(''.join(LINES[3:]))
+    with gzip.open(str(tmp_path / 'access.log.1.gz'), 'wt') as f:
+        f.write(''.join(LINES[:3]))
+    assert top_queries([str(tmp_path / 'access.log*')], top=1) == [
+        ('search', 'genome=GRCh38&regions=rs3'),
+    ]
+    assert top_queries([str(tmp_path / 'missing.log')]) == []
+
+
+def test_replay_rate_and_budget():
+    from encoded.cache_warmer import replay
+    clock = Clock()
+    paths = []
+
+    def get(path):
+        paths.append(path)
+        clock.now += 0.1
+        return 200
+
+    queries = [('search', 'regions=rs%d' % i) for i in range(10)]
+    done = replay(queries, get, rate=2, budget=2, clock=clock, sleep=clock.sleep)
+    assert done == len(paths) == 4
+    assert paths[0] == '/regulome-search/?regions=rs0&format=json'
+
+
+def test_replay_survives_failures():
+    from encoded.cache_warmer import replay
+
+    def get(path):
+        if 'rs1' in path:
+            raise RuntimeError('boom')
+        return 502
+
+    queries = [('search', 'regions=rs%d' % i) for i in range(3)]
+    assert replay(queries, get, rate=0, sleep=None) == 3
+
+
+def test_warmed_queries_served_from_cache(make_app, data_service, tmp_path):
+    (tmp_path / 'access.log').write_text(''.join(LINES))
+    testapp = make_app({'regulome_warmer.logs': str(tmp_path / 'access.log')})
+    for thread in threading.enumerate():
+        if thread.name == 'regulome-warmer':
+            thread.join(10)
+    assert data_service.requests == 2
+    testapp.get('/regulome-search/?regions=rs3&genome=GRCh38')
+    testapp.get('/regulome-summary/?genome=GRCh38&regions=chr1:100-200')
+    assert data_service.requests == 2
@@ -0,0 +1,189 @@
+import pytest
+import threading
+import time
+
+
+SEARCH = '/regulome-search/?regions=rs3&genome=GRCh38&format=json'
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_breaker_opens_on_error_rate():
+    from encoded.circuit_breaker import CircuitBreaker
+    clock = Clock()
+    breaker = CircuitBreaker(min_requests=4, error_rate=0.5, open_seconds=10, clock=clock)
+    for ok in (True, True, False):
+        breaker.record(ok, 0.1)
+    assert breaker.state == breaker.CLOSED
+    breaker.record(False, 0.1)
+    assert breaker.state == breaker.OPEN
+    assert not breaker.allow()
+    assert breaker.retry_after() == 10
+    assert breaker.stats() == {'state': 'open', 'trips': 1, 'rejected': 1}
+
+
+def test_breaker_opens_on_slow_calls():
+    from encoded.circuit_breaker import CircuitBreaker
+    breaker = CircuitBreaker(min_requests=2, slow_seconds=1, slow_rate=0.5, clock=Clock())
+    breaker.record(True, 2)
+    breaker.record(True, 2)
+    assert breaker.state == breaker.OPEN
+
+
+def test_breaker_trial_call():
+    from encoded.circuit_breaker import CircuitBreaker
+    clock = Clock()
+    breaker = CircuitBreaker(min_requests=1, open_seconds=10, clock=clock)
+    breaker.record(False, 0.1)
+    clock.now += 10
+    assert breaker.ready()
+    assert breaker.allow()
+    assert breaker.state == breaker.HALF_OPEN
+    assert not breaker.allow()
+    breaker.record(False, 0.1)
+    assert breaker.state == breaker.OPEN
+    clock.now += 10
+    assert breaker.allow()
+    breaker.record(True, 0.1)
+    assert breaker.state == breaker.CLOSED
+
+
+def test_breaker_ignores_calls_started_before_opening():
+    from encoded.circuit_breaker import CircuitBreaker
+    clock = Clock()
+    breaker = CircuitBreaker(min_requests=1, open_seconds=10, clock=clock)
+    breaker.record(False, 0.1)
+    clock.now += 10
+    breaker.allow()
+    breaker.record(True, 20)
+    assert breaker.state == breaker.HALF_OPEN
+
+
+def test_admission_sheds_over_limit():
+    from encoded.circuit_breaker import Admission
+    admission = Admission(limit=1, wait=0.01)
+    assert admission.acquire()
+    assert not admission.acquire()
+    admission.release()
+    assert admission.acquire()
+    assert admission.stats() == {'limit': 1, 'shed': 1}
+
+
+def test_upstream_connection_error_is_upstream_error():
+    from encoded.circuit_breaker import UpstreamError
+    from encoded.upstream import UpstreamClient
+    from .test_upstream import closed_port_url
+    client = UpstreamClient(closed_port_url(), retries=0)
+    with pytest.raises(UpstreamError) as excinfo:
+        client.get(client.path('search', 'regions=rs1'))
+    assert excinfo.value.retry_after == 1
+
+
+def test_upstream_timeout_is_upstream_error(start_data_service):
+    from encoded.circuit_breaker import UpstreamError
+    from encoded.upstream import UpstreamClient
+    data_service = start_data_service(latency=1)
+    client = UpstreamClient(data_service.url, retries=0, read_timeout=0.1)
+    with pytest.raises(UpstreamError):
+        client.get(client.path('search', 'regions=rs1'))
+
+
+@pytest.fixture
+def failing_app(make_app):
+    # Without the fresh tier every query reaches the data service.
+    return make_app({
+        'regulome_cache.max_bytes': '0',
+        'genomic_data_service.retries': '0',
+    })
+
+
+def test_unreachable_data_service_is_unavailable(make_app):
+    from .test_upstream import closed_port_url
+    testapp = make_app({
+        'genomic_data_service_url': closed_port_url(),
+        'genomic_data_service.retries': '0',
+    })
+    response = testapp.get(SEARCH, status=503)
+    assert response.headers['Retry-After'] == '1'
+
+
+@pytest.mark.parametrize('failure', ['disconnect', 502])
+def test_failing_data_service_serves_stale(failing_app, data_service, failure):
+    response = failing_app.get(SEARCH).json
+    data_service.failure = failure
+    assert failing_app.get(SEARCH).json == response
+    failing_app.get(SEARCH.replace('rs3', 'rs4'), status=503)
+
+
+def test_open_breaker_serves_stale_without_calling(make_app, data_service):
+    testapp = make_app({
+        'regulome_cache.max_bytes': '0',
+        'genomic_data_service.retries': '0',
+        'genomic_data_service.breaker_min_requests': '2',
+        'genomic_data_service.breaker_open_seconds': '60',
+    })
+    response = testapp.get(SEARCH).json
+    data_service.failure = 502
+    testapp.get(SEARCH.replace('rs3', 'rs4'), status=503)
+    testapp.get(SEARCH.replace('rs3', 'rs5'), status=503)
+    breaker = testapp.app.registry['genomic_data_service'].breaker
+    assert breaker.state == breaker.OPEN
+    requests = data_service.requests
+    assert testapp.get(SEARCH).json == response
+    response = testapp.get(SEARCH.replace('rs3', 'rs6'), status=503)
+    assert int(response.headers['Retry-After']) > 50
+    assert data_service.requests == requests
+
+
+def test_admission_limit_sheds_requests(make_app, start_data_service):
+    data_service = start_data_service(latency=0.5)
+    testapp = make_app({
+        'genomic_data_service_url': data_service.url,
+        'genomic_data_service.max_concurrent': '1',
+        'genomic_data_service.queue_timeout': '0.05',
+    })
+    statuses = []
+
+    def get(n):
+        response = testapp.get(SEARCH.replace('rs3', 'rs%d' % n), expect_errors=True)
+        statuses.append(response.status_int)
+
+    threads = [threading.Thread(target=get, args=(n,)) for n in range(3)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join()
+    assert sorted(statuses) == [200, 503, 503]
+    assert testapp.app.registry['genomic_data_service'].admission.stats()['shed'] == 2
+
+
+def test_asgi_serves_stale_and_unavailable(app_settings, data_service):
+    import asyncio
+    import httpx
+    from encoded.asgi import main
+
+    async def requests():
+        app = main({}, **dict(
+            app_settings, **{
+                'regulome_cache.max_bytes': '0',
+                'genomic_data_service.retries': '0',
+            }))
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://localhost') as client:
+            fresh = await client.get(SEARCH)
+            data_service.failure = 'disconnect'
+            stale = await client.get(SEARCH)
+            unavailable = await client.get(SEARCH.replace('rs3', 'rs4'))
+            return fresh, stale, unavailable
+
+    fresh, stale, unavailable = asyncio.run(requests())
+    assert stale.json() == fresh.json()
+    assert unavailable.status_code == 503
+    assert unavailable.headers['Retry-After'] == '1'
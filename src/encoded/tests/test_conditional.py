@@ -0,0 +1,137 @@
+import gzip
+import pytest
+from webob import Request
+
+
+SUMMARY = '/regulome-summary/?regions=rs1%0D%0Ars2%0D%0Ars3&genome=GRCh38&format=json'
+
+
+@pytest.fixture
+def large_variants(data_service):
+    data_service.variant_bytes = 2048
+
+
+def get(testapp, url, **headers):
+    # TestApp decodes gzip bodies, so call the WSGI app directly.
+    headers.setdefault('Accept', 'application/json')
+    return Request.blank(url, headers=headers).get_response(testapp.app)
+
+
+def test_json_etag_and_not_modified(testapp, large_variants, data_service):
+    response = get(testapp, SUMMARY)
+    assert response.status_int == 200
+    assert response.etag
+    response = get(testapp, SUMMARY, **{'If-None-Match': '"%s"' % response.etag})
+    assert response.status_int == 304
+    assert response.body == b''
+    assert data_service.requests == 1
+
+
+def test_etag_expires_with_cached_response(testapp, data_service):
+    etag = get(testapp, SUMMARY).etag
+    testapp.app.registry['regulome_cache'].lru.clear()
+    data_service.variant_bytes = 100
+    response = get(testapp, SUMMARY, **{'If-None-Match': '"%s"' % etag})
+    assert response.status_int == 200
+    assert response.etag != etag
+    assert data_service.requests == 2
+
+
+def test_unchanged_response_revalidated_after_cache_expiry(testapp, data_service):
+    etag = get(testapp, SUMMARY).etag
+    testapp.app.registry['regulome_cache'].lru.clear()
+    response = get(testapp, SUMMARY, **{'If-None-Match': '"%s"' % etag})
+    assert response.status_int == 304
+    assert data_service.requests == 2
+
+
+def test_uncached_endpoint_runs_view(make_app, data_service):
+    testapp = make_app({'regulome_cache.endpoints': 'search'})
+    etag = get(testapp, SUMMARY).etag
+    response = get(testapp, SUMMARY, **{'If-None-Match': '"%s"' % etag})
+    assert response.status_int == 304
+    assert data_service.requests == 2
+
+
+def test_json_compressed(testapp, large_variants):
+    plain = get(testapp, SUMMARY)
+    response = get(testapp, SUMMARY, **{'Accept-Encoding': 'gzip'})
+    assert response.content_encoding == 'gzip'
+    assert response.etag == plain.etag + '-gzip'
+    assert 'Accept-Encoding' in response.vary
+    assert gzip.decompress(response.body) == plain.body
+    assert len(response.body) < len(plain.body)
+    response = get(testapp, SUMMARY, **{
+        'Accept-Encoding': 'gzip',
+        'If-None-Match': '"%s"' % response.etag,
+    })
+    assert response.status_int == 304
+
+
+def test_compressed_repeat_runs_view(make_app, large_variants, data_service):
+    testapp = make_app({'regulome_cache.endpoints': 'search'})
+    store = testapp.app.registry['compressed_responses'].store
+    first = get(testapp, SUMMARY, **{'Accept-Encoding': 'gzip'})
+    repeat = get(testapp, SUMMARY, **{'Accept-Encoding': 'gzip'})
+    assert data_service.requests == 2
+    assert repeat.body == first.body
+    assert store.stats()['hits'] == 1
+    data_service.variant_bytes = 100
+    changed = get(testapp, SUMMARY, **{'Accept-Encoding': 'gzip'})
+    assert changed.etag != first.etag
+    assert len(gzip.decompress(changed.body)) < len(gzip.decompress(first.body))
+
+
+def test_json_not_streamed(make_app, large_variants):
+    testapp = make_app({'renderer.stream_paths': '/regulome-search /regulome-summary'})
+    response = get(testapp, SUMMARY, **{'Accept-Encoding': 'gzip'})
+    assert response.content_encoding == 'gzip'
+    response = get(testapp, SUMMARY, **{
+        'Accept-Encoding': 'gzip',
+        'If-None-Match': '"%s"' % response.etag,
+    })
+    assert response.status_int == 304
+
+
+def test_asgi_json_etag_and_compression(app_settings, large_variants):
+    import asyncio
+    import httpx
+    from encoded.asgi import main
+
+    async def requests():
+        app = main({}, **app_settings)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://localhost') as client:
+            response = await client.get(SUMMARY, headers={'Accept-Encoding': 'gzip'})
+            revalidated = await client.get(SUMMARY, headers={
+                'Accept-Encoding': 'gzip',
+                'If-None-Match': response.headers['ETag'],
+            })
+            return response, revalidated
+
+    response, revalidated = asyncio.run(requests())
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'].endswith('-gzip"')
+    assert revalidated.status_code == 304
+
+
+def test_asgi_json_etag(app_settings, data_service):
+    import asyncio
+    import httpx
+    from encoded.asgi import main
+
+    async def requests():
+        app = main({}, **app_settings)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://localhost') as client:
+            response = await client.get(SUMMARY)
+            revalidated = await client.get(SUMMARY, headers={
+                'If-None-Match': response.headers['ETag'],
+            })
+            return response, revalidated
+
+    response, revalidated = asyncio.run(requests())
+    assert response.status_code == 200
+    assert revalidated.status_code == 304
+    assert revalidated.headers['ETag'] == response.headers['ETag']
+    assert data_service.requests == 1
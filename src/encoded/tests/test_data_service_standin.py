@@ -0,0 +1,55 @@
+import json
+
+
+def test_standin_generates_variants_in_regions(data_service):
+    payload = data_service.payload('summary', 'regions=chr2:95-130&genome=GRCh38')
+    assert payload['total'] == 3
+    assert [(v['chrom'], v['start']) for v in payload['variants']] == [
+        ('chr2', 100), ('chr2', 110), ('chr2', 120)]
+
+
+def test_standin_counts_shared_variants_once(data_service):
+    regions = 'chr1:100-200%0D%0Achr1:150-250%0D%0Ars1'
+    payload = data_service.payload('summary', 'regions=' + regions)
+    assert payload['total'] == 15
+    starts = [variant['start'] for variant in payload['variants']]
+    assert starts == sorted(set(starts))
+
+
+def test_standin_pages(data_service):
+    payload = data_service.payload('summary', 'regions=chr1:0-100&from=2&limit=3')
+    assert payload['total'] == 10
+    assert [variant['start'] for variant in payload['variants']] == [20, 30, 40]
+
+
+def test_standin_replays_recorded_payload(start_data_service, tmp_path):
+    recorded = {'@id': '/search/', 'variants': [{'chrom': 'chr9', 'start': 5}], 'extra': 1}
+    (tmp_path / 'search.json').write_text(json.dumps(recorded))
+    standin = start_data_service(payload_dir=str(tmp_path), variants_per_region=2)
+    payload = standin.payload('search', 'regions=rs1%0D%0Ars2')
+    assert payload['extra'] == 1
+    assert payload['total'] == 4
+    assert payload['variants'] == recorded['variants'] * 4
+
+
+def test_standin_serves_over_http(data_service):
+    import requests
+    response = requests.get(data_service.url + 'search/?regions=rs7&genome=GRCh38')
+    assert response.status_code == 200
+    assert response.json()['variants'][0]['rsids'] == ['rs7']
+    assert requests.get(data_service.url + 'other/').status_code == 404
+    assert data_service.requests == 2
+
+
+def test_benchmark_reports_routes(app):
+    from encoded.commands.benchmark import (
+        run,
+        summarize,
+    )
+    results, elapsed = run(app, ('search', 'summary'), 10, 2, 3)
+    report = summarize(results, elapsed)
+    assert sorted(report) == ['search', 'summary']
+    for stats in report.values():
+        assert stats['requests'] == 10
+        assert stats['errors'] == 0
+        assert 0 < stats['p50'] <= stats['p95'] <= stats['p99']
@@ -0,0 +1,44 @@
+import pytest
+
+
+DOWNLOAD = '/regulome-summary/?regions=chr1:100-200&genome=GRCh38&format=bed'
+
+
+@pytest.fixture
+def proxy(make_app):
+    return make_app({'regulome_download.proxy': 'true'})
+
+
+def test_download_redirects_without_proxy(testapp, data_service):
+    response = testapp.get(DOWNLOAD, status=302)
+    assert response.location.startswith(data_service.url + 'summary/?')
+    assert data_service.requests == 0
+
+
+def test_download_proxied(proxy, data_service):
+    response = proxy.get(DOWNLOAD, status=200)
+    expected = data_service.download('summary', 'regions=chr1:100-200&format=bed')
+    assert response.body == expected
+    assert response.body.startswith(b'chr1\t100\t101\trs1\n')
+    assert response.content_type == 'text/plain'
+    assert response.headers['Content-Disposition'] == 'attachment; filename="regulome.bed"'
+    assert data_service.url.rstrip('/') not in str(response.headers)
+
+
+def test_download_range_passed_through(proxy):
+    full = proxy.get(DOWNLOAD).body
+    response = proxy.get(DOWNLOAD, headers={'Range': 'bytes=5-14'}, status=206)
+    assert response.body == full[5:15]
+    assert response.headers['Content-Range'] == 'bytes 5-14/%d' % len(full)
+    assert response.headers['Accept-Ranges'] == 'bytes'
+
+
+
+
+def test_download_proxy_streams(proxy):
+    from encoded.regulome_search import UpstreamBody
+    from webob import Request
+    response = Request.blank(DOWNLOAD).get_response(proxy.app)
+    assert isinstance(response.app_iter, UpstreamBody)
+    assert b''.join(response.app_iter).startswith(b'chr1\t100\t')
+    response.app_iter.close()
@@ -0,0 +1,62 @@
+from concurrent.futures import Future
+
+
+def test_handoff_taken_once():
+    from encoded.handoff import Handoff
+    handoff = Handoff()
+    future = handoff.submit('key', lambda: 1)
+    assert handoff.submit('key', lambda: 2) is future
+    assert handoff.take('key').result() == 1
+    assert handoff.take('key') is None
+    assert handoff.stats() == {'entries': 0, 'submitted': 1, 'taken': 1}
+
+
+def test_handoff_expires():
+    from encoded.handoff import Handoff
+    now = [0]
+    handoff = Handoff(ttl=5, clock=lambda: now[0])
+    handoff.submit('key', lambda: 1)
+    now[0] = 6
+    assert handoff.take('key') is None
+
+
+def test_handoff_drops_oldest():
+    from encoded.handoff import Handoff
+    handoff = Handoff(max_entries=2)
+    for key in 'abc':
+        handoff.submit(key, lambda: key)
+    assert handoff.take('a') is None
+    assert isinstance(handoff.take('c'), Future)
+
+
+def test_handoff_disabled():
+    from encoded.handoff import Handoff
+    handoff = Handoff(ttl=0)
+    assert not handoff.enabled
+    assert handoff.submit('key', lambda: 1) is None
+    assert handoff.take('key') is None
+
+
+def test_single_hit_summary_hands_search_over(make_app, data_service):
+    testapp = make_app({
+        'regulome_cache.max_bytes': '0',
+        'regulome_cache.stale_max_bytes': '0',
+    })
+    response = testapp.get(
+        '/regulome-summary/?regions=rs3&genome=GRCh38&format=json', status=303)
+    assert response.location == 'http://localhost/regulome-search?regions=rs3&genome=GRCh38'
+    search = testapp.get(response.location + '&format=json').json
+    handoff = testapp.app.registry['regulome_handoff']
+    assert handoff.stats()['taken'] == 1
+    assert search['@type'] == ['regulome-search']
+    assert search['total'] == 1
+    assert data_service.requests == 2
+
+
+def test_handoff_disabled_by_setting(make_app, data_service):
+    testapp = make_app({'regulome_handoff.ttl': '0'})
+    response = testapp.get(
+        '/regulome-summary/?regions=rs3&genome=GRCh38&format=json', status=303)
+    testapp.get(response.location + '&format=json')
+    assert testapp.app.registry['regulome_handoff'].stats()['submitted'] == 0
+    assert data_service.requests == 2
@@ -0,0 +1,82 @@
+import json
+import pytest
+
+
+DOCUMENT = {
+    '@id': '/summary/?regions=rs1&format=json',
+    '@type': ['summary'],
+    'assembly': 'GRCh38',
+    'notifications': {'note': 'a "quoted", [bracketed] {value}'},
+    'title': 'Summary',
+    'total': 2,
+    'variants': [{'chrom': 'chr1', 'start': 1, 'tags': ['a,b', '}']}] * 2,
+}
+
+
+def rewrites():
+    from encoded.regulome_search import response_rewrites
+    return response_rewrites('summary', 'RegulomeDB Summary')
+
+
+def rewritten():
+    from encoded.regulome_search import rewrite_response
+    return rewrite_response(json.loads(json.dumps(DOCUMENT)), 'summary', 'RegulomeDB Summary')
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1 << 16])
+def test_rewrite_stream_matches_decoded_rewrite(chunk_size):
+    from encoded.json_passthrough import rewrite_stream
+    content = json.dumps(DOCUMENT, indent=1).encode('utf-8')
+    chunks = [content[n:n + chunk_size] for n in range(0, len(content), chunk_size)]
+    result, original = rewrite_stream(
+        chunks, rewrites(), capture=('total', 'assembly'), keep_bytes=len(content))
+    assert json.loads(result.body.getvalue()) == rewritten()
+    assert result.fields == {'total': 2, 'assembly': 'GRCh38'}
+    assert bytes(original) == content
+
+
+def test_rewrite_stream_copies_unrewritten_bytes():
+    from encoded.json_passthrough import rewrite_stream
+    content = json.dumps(DOCUMENT, indent=1).encode('utf-8')
+    result, original = rewrite_stream([content], rewrites())
+    variants = content[content.index(b'"variants"'):]
+    assert result.body.getvalue().endswith(variants)
+    assert original is None
+
+
+def test_rewrite_stream_spools_large_bodies():
+    from encoded.json_passthrough import rewrite_stream
+    content = json.dumps(DOCUMENT).encode('utf-8')
+    result, original = rewrite_stream([content], rewrites(), spool_bytes=64, keep_bytes=64)
+    assert not result.body.in_memory
+    assert original is None
+    assert json.loads(b''.join(result.body)) == rewritten()
+    assert result.size == len(b''.join(result.body))
+
+
+def test_rewrite_stream_rejects_truncated_document():
+    from encoded.json_passthrough import rewrite_stream
+    content = json.dumps(DOCUMENT).encode('utf-8')
+    with pytest.raises(ValueError):
+        rewrite_stream([content[:30]], rewrites())
+
+
+@pytest.mark.parametrize('url', [
+    '/regulome-search/?regions=rs3&genome=GRCh38&format=json',
+    '/regulome-summary/?regions=chr1:100-200%0D%0Ars4&genome=GRCh38&format=json',
+])
+@pytest.mark.parametrize('spool_bytes', ['4MB', '100'])
+def test_passthrough_matches_decoded_response(make_app, url, spool_bytes):
+    passthrough = make_app({
+        'regulome_passthrough.enabled': 'true',
+        'regulome_passthrough.spool_bytes': spool_bytes,
+    })
+    decoded = make_app()
+    assert passthrough.get(url).json == decoded.get(url).json
+
+
+def test_passthrough_summary_redirects_single_hit(make_app):
+    passthrough = make_app({'regulome_passthrough.enabled': 'true'})
+    response = passthrough.get(
+        '/regulome-summary/?regions=rs3&genome=GRCh38&format=json', status=303)
+    assert '/regulome-search?' in response.location
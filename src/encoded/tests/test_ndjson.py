@@ -0,0 +1,87 @@
+import json
+import pytest
+
+
+DOCUMENT = {
+    '@id': '/search/?regions=rs1&format=json',
+    'assembly': 'GRCh38',
+    'notifications': {'note': 'a "quoted", [bracketed] {value}'},
+    'variants': [
+        {'chrom': 'chr1', 'start': 1, 'tags': ['a,b', '}']},
+        {'chrom': 'chr1', 'start': 2, 'nested': {'list': [1, [2]]}},
+    ],
+    'total': 2,
+}
+
+
+def split(content, chunk_size, **kw):
+    from encoded.json_passthrough import NDJSONSplitter
+    splitter = NDJSONSplitter(**kw)
+    out = b''.join(
+        splitter.feed(content[n:n + chunk_size])
+        for n in range(0, len(content), chunk_size)
+    )
+    return out + splitter.close()
+
+
+@pytest.mark.parametrize('indent', [None, 1])
+@pytest.mark.parametrize('chunk_size', [1, 5, 1 << 16])
+def test_splitter_records(indent, chunk_size):
+    content = json.dumps(DOCUMENT, indent=indent).encode('utf-8')
+    lines = split(content, chunk_size).split(b'\n')
+    assert lines[-1] == b''
+    records = [json.loads(line) for line in lines[:-1]]
+    assert records == [
+        {key: DOCUMENT[key] for key in ('@id', 'assembly', 'notifications')},
+        DOCUMENT['variants'][0],
+        DOCUMENT['variants'][1],
+        {'total': 2},
+    ]
+
+
+def test_splitter_rewrites_members():
+    content = json.dumps(DOCUMENT).encode('utf-8')
+    records = split(content, 3, rewrites={'assembly': str.lower, 'total': lambda v: v + 1})
+    records = [json.loads(line) for line in records.splitlines()]
+    assert records[0]['assembly'] == 'grch38'
+    assert records[-1] == {'total': 3}
+
+
+def test_splitter_without_items():
+    records = split(b'{"total": 0, "variants": []}', 4)
+    assert [json.loads(line) for line in records.splitlines()] == [{'total': 0}]
+    assert split(b'{"total": 0}', 4) == b'{"total": 0}\n'
+
+
+def test_splitter_truncated():
+    with pytest.raises(ValueError):
+        split(b'{"total": 2, "variants": [{"chrom": "chr1"}', 4)
+
+
+def test_ndjson_matches_json(testapp):
+    url = '/regulome-summary/?regions=chr1:100-200%0D%0Achr2:100-200&genome=GRCh38&limit=all'
+    expected = testapp.get(url + '&format=json').json
+    res = testapp.get(url + '&format=ndjson')
+    assert res.content_type == 'application/x-ndjson'
+    records = [json.loads(line) for line in res.body.splitlines()]
+    variants = [record for record in records if 'chrom' in record]
+    assert variants == expected['variants']
+    fields = {}
+    for record in records:
+        if 'chrom' not in record:
+            fields.update(record)
+    expected.pop('variants')
+    expected['format'] = 'ndjson'
+    expected['@id'] = expected['@id'].replace('format=json', 'format=ndjson')
+    assert fields == expected
+
+
+def test_ndjson_upstream_error(testapp, data_service):
+    data_service.failure = 400
+    res = testapp.get('/regulome-search/?regions=rs3&format=ndjson', status=400)
+    assert res.content_type == 'application/json'
+
+
+def test_ndjson_invalid_regions(testapp):
+    res = testapp.get('/regulome-search/?regions=chr1:x-y&format=ndjson', status=400)
+    assert res.json['notifications'] == {'Failed': 'Invalid region input: chr1:x-y'}
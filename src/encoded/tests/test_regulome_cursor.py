@@ -0,0 +1,74 @@
+import threading
+import time
+
+
+PAGE = '/regulome-summary/?regions=chr1:0-200&genome=GRCh38&format=json&from=%d&limit=5'
+
+
+def test_split_paged_query():
+    from encoded.regulome_cursor import CursorCache
+    cursors = CursorCache()
+    assert cursors.split('regions=rs1&from=5&limit=5&cursor=abc') == (
+        'regions=rs1&from=5&limit=5', 'limit=all&regions=rs1', 5, 5)
+    assert cursors.split('regions=rs1&from=5') is None
+    assert cursors.split('regions=rs1&limit=all') is None
+
+
+def test_cursor_id_ignores_paging():
+    from encoded.regulome_cursor import CursorCache
+    cursors = CursorCache()
+    first = cursors.split('regions=rs1&genome=GRCh38&from=0&limit=5')[1]
+    later = cursors.split('genome=GRCh38&regions=rs1&from=5&limit=5')[1]
+    assert cursors.cursor_id(first) == cursors.cursor_id(later)
+
+
+def test_get_does_not_wait_for_loading():
+    from encoded.regulome_cursor import CursorCache
+    cursors = CursorCache()
+    release = threading.Event()
+
+    def load():
+        release.wait(5)
+        return {'variants': []}, 1
+
+    future = cursors.open('id', 10, load)
+    start = time.monotonic()
+    assert cursors.get('id') is None
+    assert time.monotonic() - start < 1
+    assert cursors.stats()['loading'] == 1
+    release.set()
+    future.result(5)
+    assert cursors.get('id') == {'variants': []}
+
+
+def test_open_skips_large_result_sets():
+    from encoded.regulome_cursor import CursorCache
+    cursors = CursorCache(max_variants=10)
+    assert cursors.open('id', 11, lambda: ({}, 1)) is None
+
+
+def test_cursors_off_by_default(testapp, data_service):
+    assert not testapp.app.registry['regulome_cursors'].enabled
+    testapp.get(PAGE % 0)
+    testapp.get(PAGE % 5)
+    assert data_service.requests == 2
+
+
+def test_later_pages_sliced_from_cursor(make_app, data_service):
+    testapp = make_app({'regulome_cursor.enabled': 'true'})
+    first = testapp.get(PAGE % 0).json
+    cursors = testapp.app.registry['regulome_cursors']
+    deadline = time.monotonic() + 5
+    while cursors.stats()['entries'] == 0:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert data_service.requests == 2
+
+    later = testapp.get(PAGE % 5).json
+    assert data_service.requests == 2
+    assert later['cursor'] == cursors.cursor_id('genome=GRCh38&limit=all&regions=chr1%3A0-200')
+    del later['cursor']
+    expected = make_app().get(PAGE % 5).json
+    assert later == expected
+    assert [v['start'] for v in later['variants']] == [50, 60, 70, 80, 90]
+    assert first['total'] == later['total'] == 20
@@ -0,0 +1,103 @@
+import pytest
+
+
+def test_disjoint_regions():
+    from encoded.regulome_fanout import disjoint_regions
+    assert disjoint_regions(['rs1', 'rs2'])
+    assert disjoint_regions(['chr1:100-200', 'chr1:201-300', 'chr2:100-200'])
+    assert not disjoint_regions(['chr1:100-200', 'chr1:150-300'])
+    assert not disjoint_regions(['chr1:100-200', 'chr1:200-300'])
+    assert not disjoint_regions(['chr1:100-200', 'rs2'])
+    assert not disjoint_regions(['chr1:100-200', 'bad'])
+
+
+def test_variants_ordered_by_chromosome_number():
+    from encoded.regulome_fanout import variant_sort_key
+    variants = [
+        {'chrom': 'chrX', 'start': 1, 'end': 2},
+        {'chrom': 'chr10', 'start': 1, 'end': 2},
+        {'chrom': 'chr2', 'start': 5, 'end': 6},
+        {'chrom': 'chr2', 'start': 1, 'end': 2},
+    ]
+    ordered = sorted(variants, key=variant_sort_key)
+    assert [(v['chrom'], v['start']) for v in ordered] == [
+        ('chr2', 1), ('chr2', 5), ('chr10', 1), ('chrX', 1)]
+
+
+def test_merge_keeps_query_order():
+    from encoded.regulome_fanout import SummaryFanout
+    fanout = SummaryFanout()
+    shards = [
+        {
+            'query_coordinates': ['chr2:1-10', 'chr10:1-10'],
+            'notifications': {},
+            'total': 2,
+            'variants': [
+                {'chrom': 'chr2', 'start': 5, 'end': 6},
+                {'chrom': 'chr10', 'start': 5, 'end': 6},
+            ],
+        },
+        {
+            'query_coordinates': ['chrX:1-10'],
+            'notifications': {},
+            'total': 1,
+            'variants': [{'chrom': 'chrX', 'start': 5, 'end': 6}],
+        },
+    ]
+    merged = fanout.merge(shards, 'limit=all&regions=x', 'summary')
+    assert merged['query_coordinates'] == ['chr2:1-10', 'chr10:1-10', 'chrX:1-10']
+    assert [v['chrom'] for v in merged['variants']] == ['chr2', 'chr10', 'chrX']
+    assert merged['total'] == 3
+    assert merged['@id'] == '/regulome-summary/?limit=all&regions=x'
+
+
+def test_invalid_regions_are_not_sharded():
+    from encoded.regulome_fanout import SummaryFanout
+    fanout = SummaryFanout(shard_size=1)
+    assert fanout.shard_queries('limit=all&regions=rs1%0D%0Ars2') is not None
+    assert fanout.shard_queries('limit=all&regions=rs1%0D%0Abad') is None
+
+
+@pytest.fixture
+def summaries(make_app):
+    sharded = make_app({'regulome_summary.shard_size': '1'})
+    unsharded = make_app({'regulome_summary.shard_size': '0'})
+
+    def get(query):
+        url = '/regulome-summary/?genome=GRCh38&format=json&' + query
+        return sharded.get(url).json, unsharded.get(url).json
+
+    return get
+
+
+def test_standin_orders_chromosomes_by_number(summaries):
+    sharded, unsharded = summaries('regions=chr10:100-120%0D%0Achr2:100-120&limit=all')
+    assert unsharded['query_coordinates'] == ['chr2:100-120', 'chr10:100-120']
+    assert [v['chrom'] for v in unsharded['variants']] == ['chr2', 'chr2', 'chr10', 'chr10']
+
+
+@pytest.mark.parametrize('query', [
+    'regions=rs1%0D%0Ars2%0D%0Ars3&limit=all',
+    'regions=chrX:100-200%0D%0Achr10:100-200%0D%0Achr2:100-200&limit=all',
+    'regions=chr1:100-200%0D%0Achr1:150-300%0D%0Achr2:100-200&limit=all',
+    'regions=chr10:100-200%0D%0Achr1:300-400%0D%0Achr2:100-200&from=3&limit=15',
+])
+def test_sharded_summary_matches_unsharded(summaries, data_service, query):
+    sharded, unsharded = summaries(query)
+    assert sharded['total'] > 0
+    assert sharded == unsharded
+    assert data_service.requests == 4
+
+
+def test_overlapping_page_is_not_sharded(summaries, data_service):
+    sharded, unsharded = summaries(
+        'regions=chr1:100-200%0D%0Achr1:150-300&from=0&limit=5')
+    assert sharded == unsharded
+    assert data_service.requests == 2
+
+
+def test_invalid_region_notification_matches_unsharded(summaries, data_service):
+    sharded, unsharded = summaries('regions=rs1%0D%0Ars2%0D%0Achr1:x-y&limit=all')
+    assert sharded['notifications'] == {'Failed': 'Invalid region input: chr1:x-y'}
+    assert sharded == unsharded
+    assert data_service.requests == 2
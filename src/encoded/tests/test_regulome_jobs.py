@@ -0,0 +1,82 @@
+import gzip
+import json
+import pytest
+import subprocess
+import sys
+import time
+
+
+REGIONS = 'chr1:100-200\nchr1:150-300\nchr2:100-200'
+
+
+def wait_for_job(testapp, location, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        job = testapp.get(location).json
+        if job['status'] not in ('queued', 'running') or time.monotonic() > deadline:
+            return job
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def jobs_app(make_app):
+    return make_app({'regulome_jobs.chunk_size': '1'})
+
+
+def test_job_result(jobs_app, testapp):
+    res = jobs_app.post('/regulome-jobs/', {'regions': REGIONS, 'genome': 'GRCh38'}, status=202)
+    assert 'worker' not in res.json
+    job = wait_for_job(jobs_app, res.location)
+    assert job['status'] == 'done'
+    assert job['progress'] == {'done': 3, 'total': 3}
+    result = jobs_app.get(job['result'])
+    variants = [json.loads(line) for line in gzip.decompress(result.body).splitlines()]
+    expected = testapp.get(
+        '/regulome-summary/', {'regions': REGIONS, 'genome': 'GRCh38', 'limit': 'all'}).json
+    assert job['total'] == len(variants) == expected['total']
+    key = lambda v: (v['chrom'], v['start'])  # noqa: E731
+    assert sorted(variants, key=key) == sorted(expected['variants'], key=key)
+
+
+def test_jobs_breaker_is_separate(jobs_app, data_service):
+    registry = jobs_app.app.registry
+    jobs = registry['regulome_jobs']
+    client = registry['genomic_data_service']
+    assert jobs.breaker is not client.breaker
+    data_service.failure = 502
+    for _ in range(jobs.breaker.min_requests):
+        res = jobs_app.post('/regulome-jobs/', {'regions': 'chr1:100-200'}, status=202)
+        assert wait_for_job(jobs_app, res.location)['status'] == 'failed'
+    assert jobs.breaker.state == jobs.breaker.OPEN
+    assert client.breaker.state == client.breaker.CLOSED
+
+
+def test_open_interactive_breaker_runs_jobs(jobs_app):
+    client = jobs_app.app.registry['genomic_data_service']
+    for _ in range(client.breaker.min_requests):
+        client.breaker.record(False, 0.1)
+    assert client.breaker.state == client.breaker.OPEN
+    res = jobs_app.post('/regulome-jobs/', {'regions': REGIONS}, status=202)
+    assert wait_for_job(jobs_app, res.location)['status'] == 'done'
+
+
+def test_orphaned_jobs_fail_at_startup(make_app):
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    jobs = make_app().app.registry['regulome_jobs']
+    orphaned = {
+        'id': 'a' * 32, 'status': 'running', 'progress': {'done': 1, 'total': 2},
+        'total': 5, 'notifications': {}, 'worker': [process.pid, 'earlier'],
+    }
+    legacy = dict(orphaned, id='b' * 32, status='queued')
+    del legacy['worker']
+    done = dict(orphaned, id='c' * 32, status='done')
+    for job in (orphaned, legacy, done):
+        jobs.save(job)
+    testapp = make_app()
+    for job_id in ('a' * 32, 'b' * 32):
+        job = testapp.get('/regulome-jobs/%s/' % job_id).json
+        assert job['status'] == 'failed'
+        assert job['error'] == 'Interrupted by a restart, please resubmit'
+        assert 'finished' in job
+    assert testapp.get('/regulome-jobs/%s/' % ('c' * 32)).json['status'] == 'done'
@@ -0,0 +1,47 @@
+def test_normalize_regions():
+    from encoded.regulome_query import normalize_regions
+    regions, invalid = normalize_regions([
+        'rs3 chr1:1,000-2,000\nchrX\t5\t10',
+        'chr1:1000-2000',
+    ])
+    assert regions == ['chr1:1000-2000', 'chrX:5-10', 'rs3']
+    assert invalid == []
+
+
+def test_normalize_regions_needs_digits():
+    from encoded.regulome_query import normalize_regions
+    regions, invalid = normalize_regions(['chr1:,-5', 'chr1:1-,', 'chr1:200-100'])
+    assert regions == []
+    assert invalid == ['chr1:,-5', 'chr1:1-,', 'chr1:200-100']
+
+
+def test_normalize_regions_splits_bed_line():
+    from encoded.regulome_query import normalize_regions
+    regions, invalid = normalize_regions(['chr1 100 200 chr2 300 400'])
+    assert regions == ['chr1:100-200', 'chr2:300-400']
+    assert invalid == []
+    regions, invalid = normalize_regions(['chr1 100 200 chr2 300'])
+    assert regions == ['chr1:100-200']
+    assert invalid == ['chr2 300']
+
+
+def test_bed_name_column_is_kept():
+    from encoded.regulome_query import normalize_regions
+    regions, invalid = normalize_regions(['chr1\t100\t200\tpeak1'])
+    assert regions == ['chr1:100-200']
+    assert invalid == []
+
+
+def test_malformed_regions_bad_request(testapp, data_service):
+    response = testapp.get(
+        '/regulome-search/?regions=chr1:,-5&genome=GRCh38&format=json', status=400)
+    assert response.json['notifications'] == {'Failed': 'Invalid region input: chr1:,-5'}
+    assert data_service.requests == 0
+    testapp.get(
+        '/regulome-summary/?regions=chr1:,-5&genome=GRCh38&format=json', status=400)
+
+
+def test_normalize_query():
+    from encoded.regulome_query import normalize_query
+    assert normalize_query('genome=hg38&regions=rs3+rs1%0D%0Ars3&format=json') == (
+        'genome=GRCh38&regions=rs1%0D%0Ars3')
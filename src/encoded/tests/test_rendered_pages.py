@@ -0,0 +1,91 @@
+import os
+import pytest
+import sys
+from webob import (
+    Request,
+    Response,
+)
+
+
+STANDIN = [sys.executable, os.path.join(os.path.dirname(__file__), 'renderer_standin.py')]
+
+
+def page(body, **kw):
+    return Response(body=body, content_type='application/json', **kw)
+
+
+@pytest.fixture
+def bundle(tmp_path):
+    path = tmp_path / 'renderer.js'
+    path.write_text('// build 1')
+    return path
+
+
+@pytest.fixture
+def pages(bundle):
+    from encoded.renderer_pool import RenderedPages
+    return RenderedPages(str(bundle))
+
+
+def test_key(pages):
+    key = pages.key('regulome-search', page(b'{"total": 1}'))
+    assert key == pages.key('regulome-search', page(b'{"total": 1}'))
+    assert key != pages.key('regulome-search', page(b'{"total": 2}'))
+    assert key != pages.key('regulome-summary', page(b'{"total": 1}'))
+    response = page(b'{"total": 1}')
+    response.headers['X-Request-URL'] = 'http://localhost/regulome-search/?regions=rs1'
+    assert key != pages.key('regulome-search', response)
+
+
+def test_uncacheable(pages, tmp_path):
+    from encoded.renderer_pool import RenderedPages
+    response = page(b'{}')
+    response.set_cookie('session', 'value')
+    assert pages.key('regulome-search', response) is None
+    assert pages.key('regulome-search', page(b'{}', status=404)) is None
+    assert RenderedPages(str(tmp_path / 'missing.js')).key('regulome-search', page(b'{}')) is None
+
+
+def test_get_and_set(pages):
+    key = pages.key('regulome-search', page(b'{}'))
+    assert pages.get(key, Response) is None
+    pages.set(key, Response(body=b'<html></html>', content_type='text/html'))
+    rendered = pages.get(key, Response)
+    assert rendered.body == b'<html></html>'
+    assert rendered.content_type == 'text/html'
+    other = pages.key('regulome-search', page(b'{"error": 1}'))
+    pages.set(other, Response(body=b'failed', status=500))
+    assert pages.get(other, Response) is None
+
+
+def test_bundle_change_clears_pages(pages, bundle):
+    key = pages.key('regulome-search', page(b'{}'))
+    pages.set(key, Response(body=b'<html></html>'))
+    bundle.write_text('// build 2, larger')
+    assert pages.key('regulome-search', page(b'{}')) != key
+    assert pages.stats()['entries'] == 0
+
+
+def test_tween_serves_rendered_pages(bundle):
+    from encoded.renderer_pool import RendererPoolTween
+    from pyramid.registry import Registry
+    registry = Registry()
+    registry.settings = {'pyramid.reload_templates': False, 'renderer.prespawn': 'false'}
+    tween = RendererPoolTween(
+        should_transform=lambda request, response: True,
+        args=STANDIN + [str(bundle)],
+    )
+    bodies = iter([b'{"total": 1}', b'{"total": 1}', b'{"total": 2}'])
+    render = tween(lambda request: page(next(bodies)), registry)
+    pool = registry['renderer_pool']
+    try:
+        first = render(Request.blank('/regulome-search/'))
+        second = render(Request.blank('/regulome-search/'))
+        assert second.body == first.body
+        assert pool.stats()['renders'] == 1
+        render(Request.blank('/regulome-search/'))
+        assert pool.stats()['renders'] == 2
+        assert registry['rendered_pages'].stats()['hits'] == 1
+    finally:
+        while pool.idle:
+            pool.idle.popleft().close()
@@ -0,0 +1,117 @@
+import os
+import sys
+import time
+import pytest
+from webob import Response
+
+
+STANDIN = [sys.executable, os.path.join(os.path.dirname(__file__), 'renderer_standin.py')]
+
+
+def page(body):
+    return Response(body=body, content_type='application/json')
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def make_pool():
+    from encoded.renderer_pool import RendererPool
+    pools = []
+
+    def make(**kw):
+        pool = RendererPool(STANDIN, **kw)
+        pools.append(pool)
+        return pool
+
+    yield make
+    for pool in pools:
+        while pool.idle:
+            pool.idle.popleft().close()
+
+
+def test_render(make_pool):
+    pool = make_pool(size=1)
+    timing = {}
+    response = pool(page(b'{"total": 1}'), timing)
+    assert response.content_type == 'text/html'
+    assert response.body.endswith(b'{"total": 1}</html>')
+    assert set(timing) == {'queue', 'render'}
+    stats = pool.stats()
+    assert stats['renders'] == 1
+    assert stats['idle'] == 1
+
+
+def test_crash_closes_process_and_refills(make_pool):
+    pool = make_pool(size=1)
+    pool(page(b'{}'))
+    process = pool.idle[0].process
+    with pytest.raises(ValueError):
+        pool(page(b'{"crash": true}'))
+    assert process.poll() is not None
+    wait_for(lambda: pool.stats()['idle'] == 1)
+    assert pool.stats()['recycled'] == {'error': 2}
+    assert pool.idle[0].process.poll() is None
+    assert pool(page(b'{}')).status_int == 200
+
+
+def test_failure_while_recycling_closes_process(make_pool):
+    pool = make_pool(size=1)
+    renderer = pool.acquire()
+    renderer.recycling = True
+    pool.release(renderer, ok=False)
+    wait_for(lambda: renderer.process.poll() is not None)
+    wait_for(lambda: pool.stats()['idle'] == 1)
+    assert pool.stats()['live'] == 1
+    assert renderer.retired
+
+
+def test_recycles_after_max_renders(make_pool):
+    from encoded.renderer_pool import RecyclePolicy
+    pool = make_pool(size=1, policy=RecyclePolicy(max_renders=2))
+    pool(page(b'{}'))
+    old = pool.idle[0]
+    pool(page(b'{}'))
+    wait_for(lambda: old.retired)
+    wait_for(lambda: old.process.poll() is not None)
+    assert pool.stats()['recycled'] == {'renders': 1}
+    assert pool.stats()['live'] == 1
+    assert pool.idle[0].process.pid != old.process.pid
+
+
+def test_recycle_policy(make_pool):
+    from encoded.renderer_pool import RecyclePolicy
+    now = [1000.0]
+    pool = make_pool(size=1)
+    renderer = pool.acquire()
+    try:
+        renderer.started = now[0]
+        renderer.rss_sampled = now[0]
+        policy = RecyclePolicy(rss_limit=1, max_age=60, rss_interval=10, clock=lambda: now[0])
+        assert policy.reason(renderer) is None
+        now[0] += 10
+        assert policy.reason(renderer) == 'rss'
+        assert policy.reason(renderer) is None
+        now[0] += 50
+        assert policy.reason(renderer) == 'age'
+        assert RecyclePolicy(rss_limit=0, clock=lambda: now[0]).reason(renderer) is None
+    finally:
+        pool.release(renderer)
+
+
+def test_timeout_kills_process(make_pool):
+    pool = make_pool(size=1, timeout=0.2, env=dict(os.environ, SLOW='5'))
+    pool(page(b'{}'))
+    process = pool.idle[0].process
+    start = time.monotonic()
+    with pytest.raises(ValueError):
+        pool(page(b'{"slow": true}'))
+    assert time.monotonic() - start < 2
+    wait_for(lambda: process.poll() is not None)
+    assert pool.stats()['timeouts'] == 1
+    wait_for(lambda: pool.stats()['idle'] == 1)
@@ -0,0 +1,74 @@
+import json
+
+
+SEARCH = '/regulome-search/?regions=rs3&genome=GRCh38&format=json'
+
+
+def test_lru_cache_evicts_oldest():
+    from encoded.response_cache import LRUCache
+    cache = LRUCache(10)
+    cache.set('a', 'a', 5)
+    cache.set('b', 'b', 5)
+    assert cache.get('a') == 'a'
+    cache.set('c', 'c', 5)
+    assert cache.get('b') is None
+    assert cache.get('a') == 'a'
+    assert not cache.set('d', 'd', 11)
+    assert cache.stats()['bytes'] == 10
+
+
+def test_lru_cache_expires():
+    from encoded.response_cache import LRUCache
+    now = [0]
+    cache = LRUCache(10, ttl=5, clock=lambda: now[0])
+    cache.set('a', 'a', 1)
+    now[0] = 4
+    assert cache.get('a') == 'a'
+    now[0] = 6
+    assert cache.get('a') is None
+    assert cache.stats()['bytes'] == 0
+
+
+def test_canonical_query_string():
+    from encoded.response_cache import canonical_query_string
+    assert canonical_query_string('b=2&a=1&b=1') == 'a=1&b=2&b=1'
+    assert canonical_query_string('b=2&a=1', ignore=('a',)) == 'b=2'
+
+
+def test_value_size_measures_decoded_response():
+    from encoded.response_cache import value_size
+    content = json.dumps({
+        'variants': [{'chrom': 'chr1', 'start': n, 'rsids': ['rs%d' % n]} for n in range(100)],
+    })
+    response = json.loads(content)
+    assert value_size(response) > len(content)
+    response['variants'].append({'chrom': 'chr2', 'start': 1, 'rsids': []})
+    assert value_size(response) > value_size(json.loads(content))
+
+
+def test_response_cache_bounds_decoded_size(make_app):
+    from encoded.response_cache import value_size
+    testapp = make_app()
+    response = testapp.get(SEARCH).json
+    cache = testapp.app.registry['regulome_cache']
+    stats = cache.stats()
+    assert stats['entries'] == 1
+    assert stats['bytes'] >= value_size(response)
+
+    testapp = make_app({'regulome_cache.max_bytes': str(value_size(response) // 2)})
+    testapp.get(SEARCH)
+    assert testapp.app.registry['regulome_cache'].stats()['entries'] == 0
+
+
+def test_cached_response_skips_upstream(data_service, testapp):
+    first = testapp.get(SEARCH).json
+    assert testapp.get(SEARCH.replace('rs3&genome=GRCh38', 'rs3&genome=hg38')).json == first
+    assert data_service.requests == 1
+    assert first['@id'] == '/regulome-search/?genome=GRCh38&regions=rs3'
+
+
+def test_cache_endpoints_setting(data_service, make_app):
+    testapp = make_app({'regulome_cache.endpoints': 'summary'})
+    testapp.get(SEARCH)
+    testapp.get(SEARCH)
+    assert data_service.requests == 2
@@ -0,0 +1,64 @@
+def test_sqlite_cache_hits_misses_and_evicts(tmp_path):
+    from encoded.shared_cache import SQLiteCache
+    cache = SQLiteCache(str(tmp_path / 'cache.sqlite'), max_bytes=10)
+    assert cache.get('a') is None
+    cache.set('a', b'12345')
+    cache.set('b', b'12345')
+    assert cache.get('a') == b'12345'
+    cache.set('c', b'12345')
+    assert [cache.get(key) for key in ('a', 'b', 'c')].count(None) == 1
+    stats = cache.stats()
+    assert stats['bytes'] <= 10
+    assert stats['hits'] >= 2
+    assert stats['misses'] >= 2
+
+
+def test_sqlite_cache_expires(tmp_path):
+    from encoded.shared_cache import SQLiteCache
+    now = [1000.0]
+    cache = SQLiteCache(str(tmp_path / 'cache.sqlite'), 1024, ttl=10, clock=lambda: now[0])
+    cache.set('a', b'value')
+    assert cache.get('a') == b'value'
+    now[0] += 11
+    assert cache.get('a') is None
+
+
+def test_memcached_cache(memcached):
+    from encoded.shared_cache import MemcachedCache
+    cache = MemcachedCache(memcached.address)
+    assert cache.get('regions=rs1') is None
+    cache.set('regions=rs1', b'{"total": 1}')
+    assert cache.get('regions=rs1') == b'{"total": 1}'
+    assert memcached.commands == ['get', 'set', 'get']
+    assert cache.stats() == {'backend': 'memcached', 'hits': 1, 'misses': 1, 'errors': 0}
+
+
+def test_memcached_cache_unreachable_is_a_miss():
+    from encoded.shared_cache import MemcachedCache
+    from .test_upstream import closed_port_url
+    cache = MemcachedCache(closed_port_url().split('//')[1].rstrip('/'))
+    assert cache.get('key') is None
+    cache.set('key', b'value')
+    assert cache.stats()['errors'] == 2
+
+
+def test_shared_cache_serves_other_workers(data_service, make_app, memcached):
+    settings = {
+        'regulome_cache.shared': 'memcached',
+        'regulome_cache.shared_servers': memcached.address,
+    }
+    first, second = make_app(settings), make_app(settings)
+    url = '/regulome-search/?regions=rs3&genome=GRCh38&format=json'
+    assert first.get(url).json == second.get(url).json
+    assert data_service.requests == 1
+
+
+def test_sqlite_cache_serves_other_workers(data_service, make_app, tmp_path):
+    settings = {
+        'regulome_cache.shared': 'sqlite',
+        'regulome_cache.shared_path': str(tmp_path / 'shared.sqlite'),
+    }
+    first, second = make_app(settings), make_app(settings)
+    url = '/regulome-summary/?regions=rs3%0D%0Ars4&genome=GRCh38&format=json'
+    assert first.get(url).json == second.get(url).json
+    assert data_service.requests == 1
@@ -0,0 +1,96 @@
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import threading
+import time
+
+
+def test_concurrent_calls_share_result():
+    from encoded.singleflight import SingleFlight
+    flights = SingleFlight(timeout=5)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {'total': 1}
+
+    def call():
+        return flights.do('key', fn)
+
+    with ThreadPoolExecutor(4) as executor:
+        leader = executor.submit(call)
+        started.wait(5)
+        followers = [executor.submit(call) for _ in range(3)]
+        while flights.stats()['coalesced'] < 3:
+            time.sleep(0.01)
+        release.set()
+    assert len(calls) == 1
+    assert all(f.result() is leader.result() for f in followers)
+    assert flights.stats() == {'in_flight': 0, 'coalesced': 3}
+
+
+def test_followers_share_exception():
+    from encoded.singleflight import SingleFlight
+    flights = SingleFlight(timeout=5)
+    started = threading.Event()
+    release = threading.Event()
+
+    def fn():
+        started.set()
+        release.wait(5)
+        raise ValueError('upstream')
+
+    with ThreadPoolExecutor(2) as executor:
+        leader = executor.submit(flights.do, 'key', fn)
+        started.wait(5)
+        follower = executor.submit(flights.do, 'key', fn)
+        while flights.stats()['coalesced'] < 1:
+            time.sleep(0.01)
+        release.set()
+    for future in (leader, follower):
+        with pytest.raises(ValueError):
+            future.result()
+
+
+def test_follower_timeout_runs_call():
+    from encoded.singleflight import SingleFlight
+    flights = SingleFlight(timeout=0.05)
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return 'leader'
+
+    with ThreadPoolExecutor(2) as executor:
+        leader = executor.submit(flights.do, 'key', slow)
+        started.wait(5)
+        assert flights.do('key', lambda: 'follower') == 'follower'
+        release.set()
+    assert leader.result() == 'leader'
+
+
+def test_sequential_calls_are_not_coalesced():
+    from encoded.singleflight import SingleFlight
+    flights = SingleFlight()
+    assert flights.do('key', lambda: 1) == 1
+    assert flights.do('key', lambda: 2) == 2
+    assert flights.stats()['coalesced'] == 0
+
+
+def test_concurrent_view_requests_make_one_upstream_call(start_data_service, make_app):
+    data_service = start_data_service(latency=0.3)
+    testapp = make_app({
+        'genomic_data_service_url': data_service.url,
+        'regulome_cache.max_bytes': '0',
+        'regulome_cache.stale_max_bytes': '0',
+    })
+    url = '/regulome-search/?regions=rs3&genome=GRCh38&format=json'
+    with ThreadPoolExecutor(4) as executor:
+        responses = list(executor.map(lambda _: testapp.get(url).json, range(4)))
+    assert all(response == responses[0] for response in responses)
+    assert data_service.requests == 1
@@ -0,0 +1,55 @@
+import pytest
+
+
+def get_stats(testapp, **environ):
+    return testapp.get('/regulome-stats/', extra_environ=environ).json
+
+
+@pytest.fixture
+def stats_app(make_app):
+    return make_app({'regulome_stats.enabled': 'true'})
+
+
+def test_stats_disabled_by_default(testapp):
+    assert get_stats(testapp, REMOTE_ADDR='127.0.0.1')['@id'] == '/regulome-notfound'
+
+
+def test_stats(stats_app, data_service):
+    stats_app.get('/regulome-search/?regions=rs3&genome=GRCh38')
+    res = stats_app.get('/regulome-stats/', extra_environ={'REMOTE_ADDR': '127.0.0.1'})
+    assert data_service.url not in res.text
+    assert res.json['genomic_data_service']['replicas'] == [
+        {'outstanding': 0, 'failures': 0, 'available': True},
+    ]
+    assert res.json['regulome_cache']['entries'] == 1
+    histograms = {
+        (histogram['name'], histogram.get('endpoint')): histogram
+        for histogram in res.json['metrics']['histograms']
+    }
+    assert histograms['upstream_seconds', 'search']['count'] == 1
+
+
+@pytest.mark.parametrize('environ', [
+    {'REMOTE_ADDR': '10.0.0.1'},
+    {'REMOTE_ADDR': '127.0.0.1', 'HTTP_X_FORWARDED_FOR': '10.0.0.1'},
+])
+def test_stats_restricted(stats_app, environ):
+    assert get_stats(stats_app, **environ)['@id'] == '/regulome-notfound'
+
+
+def test_stats_allow(make_app):
+    testapp = make_app({
+        'regulome_stats.enabled': 'true',
+        'regulome_stats.allow': '10.0.0.1',
+    })
+    assert get_stats(testapp, REMOTE_ADDR='10.0.0.1')['@id'] == '/regulome-stats/'
+    assert get_stats(testapp, REMOTE_ADDR='127.0.0.1')['@id'] == '/regulome-notfound'
+
+
+def test_server_timing(testapp):
+    res = testapp.get('/regulome-search/?regions=rs3&genome=GRCh38')
+    assert 'upstream;dur=' in res.headers['Server-Timing']
+    assert 'cache;desc="miss"' in res.headers['Server-Timing']
+    res = testapp.get('/regulome-search/?regions=rs3&genome=GRCh38')
+    assert 'upstream;dur=' not in res.headers['Server-Timing']
+    assert 'cache;desc="hit"' in res.headers['Server-Timing']
@@ -0,0 +1,91 @@
+import json
+import os
+import pytest
+import sys
+from pyramid.httpexceptions import HTTPSeeOther
+from pyramid.request import Request
+from webob import Response
+
+
+STANDIN = [sys.executable, os.path.join(os.path.dirname(__file__), 'renderer_standin.py')]
+ASSETS = {
+    'assetsByChunkName': {
+        'style': ['./css/style.0a1b.css', './css/style.0a1b.css.map'],
+        'bundle': 'bundle.2c3d.js',
+    },
+}
+
+
+@pytest.fixture
+def build_stats(tmp_path):
+    path = tmp_path / 'build-stats.json'
+    path.write_text(json.dumps(ASSETS))
+    return path
+
+
+def test_page_shell(build_stats, tmp_path):
+    from encoded.renderer_pool import PageShell
+    shell = PageShell(str(build_stats))
+    assert shell.get() == (
+        b'<!DOCTYPE html>\n'
+        b'<link rel="preload" href="/static/build/css/style.0a1b.css" as="style">'
+        b'<link rel="preload" href="/static/build/bundle.2c3d.js" as="script">\n'
+    )
+    build_stats.write_text(json.dumps({'assetsByChunkName': {'bundle': ['bundle.4e5f.js']}}))
+    assert b'bundle.4e5f.js' in shell.get()
+    build_stats.write_text('{')
+    assert shell.get() is None
+    assert PageShell(str(tmp_path / 'missing.json')).get() is None
+
+
+def test_page_body():
+    from encoded.renderer_pool import page_body
+    html = Response(body=b'<!DOCTYPE html>\n<html>page</html>', content_type='text/html')
+    assert page_body(html) == b'<html>page</html>'
+    assert page_body(HTTPSeeOther(location='/regulome-search/?a=1&b=2')) == (
+        b'<meta http-equiv="refresh" content="0; url=/regulome-search/?a=1&amp;b=2">\n')
+    error = Response(status=502, body=b'{}', content_type='application/json')
+    assert page_body(error) == b'<html><body><p>502 Bad Gateway</p></body></html>\n'
+
+
+def test_tween_streams_shell_first(build_stats, tmp_path):
+    from encoded.renderer_pool import RendererPoolTween
+    from pyramid.registry import Registry
+    registry = Registry()
+    registry.settings = {
+        'pyramid.reload_templates': True,
+        'renderer.prespawn': 'false',
+        'renderer.stream_paths': '/regulome-search',
+    }
+    tween = RendererPoolTween(
+        should_transform=lambda request, response: True,
+        should_stream=lambda request: request.params.get('format') != 'json',
+        build_stats=str(build_stats),
+        args=STANDIN,
+    )
+    calls = []
+
+    def view(request):
+        calls.append(request.path_qs)
+        return Response(body=b'{"total": 1}', content_type='application/json')
+
+    def get(url):
+        request = Request.blank(url)
+        request.registry = registry
+        return render(request)
+
+    render = tween(view, registry)
+    pool = registry['renderer_pool']
+    try:
+        response = get('/regulome-search/?regions=rs1')
+        assert response.content_type == 'text/html'
+        chunks = iter(response.app_iter)
+        assert next(chunks).startswith(b'<!DOCTYPE html>\n<link rel="preload"')
+        assert calls == []
+        assert next(chunks).endswith(b'{"total": 1}</html>')
+        assert calls == ['/regulome-search/?regions=rs1']
+        response = get('/regulome-summary/?regions=rs1')
+        assert response.body.startswith(b'<!DOCTYPE html>\n<html>')
+    finally:
+        while pool.idle:
+            pool.idle.popleft().close()
@@ -0,0 +1,69 @@
+import socket
+import time
+
+
+def closed_port_url():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return 'http://127.0.0.1:%d/' % port
+
+
+def test_upstream_get(data_service):
+    from encoded.upstream import UpstreamClient
+    client = UpstreamClient(data_service.url)
+    response = client.get(client.path('search', 'regions=rs1&genome=GRCh38'))
+    assert response.status_code == 200
+    assert response.json()['total'] == 1
+
+
+def test_upstream_balances_replicas(start_data_service):
+    from encoded.upstream import UpstreamClient
+    first, second = start_data_service(), start_data_service()
+    client = UpstreamClient([first.url, second.url], health_interval=0)
+    for n in range(10):
+        client.get(client.path('search', 'regions=rs%d' % n))
+    assert first.requests == 5
+    assert second.requests == 5
+
+
+def test_upstream_ejects_failing_replica(data_service):
+    from encoded.circuit_breaker import UpstreamError
+    from encoded.upstream import UpstreamClient
+    client = UpstreamClient(
+        [closed_port_url(), data_service.url], retries=0, max_failures=1,
+        health_interval=0)
+    failures = 0
+    for n in range(4):
+        try:
+            client.get(client.path('search', 'regions=rs%d' % n))
+        except UpstreamError:
+            failures += 1
+    assert failures == 1
+    assert [replica['available'] for replica in client.replicas.stats()] == [False, True]
+
+
+def test_upstream_hedges_slow_replica(start_data_service):
+    from encoded.upstream import UpstreamClient
+    fast, slow = start_data_service(), start_data_service(latency=1.0)
+    client = UpstreamClient(
+        [slow.url, fast.url], hedge=True, hedge_min_delay=0.05, health_interval=0)
+    client.replicas.latencies.extend([0.01] * 20)
+    for n in range(4):
+        start = time.monotonic()
+        response = client.get(client.path('search', 'regions=rs%d' % n))
+        assert response.status_code == 200
+        assert time.monotonic() - start < 0.5
+    assert client.hedges >= 1
+
+
+def test_upstream_pool_does_not_block(data_service):
+    from encoded.upstream import UpstreamClient
+    client = UpstreamClient(data_service.url, pool_size=1, read_timeout=2)
+    held = client.get(client.path('search', 'regions=rs1'), stream=True)
+    start = time.monotonic()
+    response = client.get(client.path('search', 'regions=rs3'))
+    assert response.status_code == 200
+    assert time.monotonic() - start < 1
+    held.close()
@@ -0,0 +1,403 @@
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
+from pyramid.settings import (
+    asbool,
+    aslist,
+)
+from requests.adapters import HTTPAdapter
+from .circuit_breaker import (
+    Admission,
+    CircuitBreaker,
+    CircuitOpenError,
+    OverloadedError,
+    UpstreamError,
+)
+from .stats import Metrics
+from urllib3.util.retry import Retry
+import itertools
+import logging
+import requests
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class Replica(object):
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.outstanding = 0
+        self.failures = 0
+        self.healthy = True
+        self.ejected_until = 0
+
+    def available(self, now):
+        return self.healthy and self.ejected_until <= now
+
+
+class ReplicaSet(object):
+    """ Least-outstanding-requests balancing over data service replicas.
+
+    A replica is ejected for ``eject_seconds`` after ``max_failures``
+    consecutive connection errors or 5xx responses, or until a health probe
+    succeeds after one failed. If every replica is out all of them are
+    tried rather than failing outright.
+    """
+
+    def __init__(self, base_urls, max_failures=3, eject_seconds=30,
+                 latency_samples=256, clock=time.monotonic):
+        self.replicas = [Replica(base_url) for base_url in base_urls]
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=latency_samples)
+        self.rotation = itertools.count()
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def _candidates(self, exclude):
+        now = self.clock()
+        replicas = [replica for replica in self.replicas if replica not in exclude]
+        return [replica for replica in replicas if replica.available(now)] or replicas
+
+    def peek(self):
+        with self.lock:
+            return min(self._candidates(()), key=lambda replica: replica.outstanding)
+
+    def choose(self, exclude=()):
+        with self.lock:
+            candidates = self._candidates(exclude)
+            if not candidates:
+                return None
+            least = min(replica.outstanding for replica in candidates)
+            candidates = [replica for replica in candidates if replica.outstanding == least]
+            replica = candidates[next(self.rotation) % len(candidates)]
+            replica.outstanding += 1
+            return replica
+
+    def release(self, replica, ok, latency=None):
+        with self.lock:
+            replica.outstanding -= 1
+            if ok:
+                replica.failures = 0
+                if latency is not None:
+                    self.latencies.append(latency)
+                return
+            replica.failures += 1
+            if replica.failures >= self.max_failures:
+                replica.ejected_until = self.clock() + self.eject_seconds
+                log.warning('Ejecting data service replica %s after %d failures',
+                            replica.base_url, replica.failures)
+
+    def mark(self, replica, healthy):
+        with self.lock:
+            if healthy and not replica.healthy:
+                log.info('Data service replica %s is healthy', replica.base_url)
+                replica.failures = 0
+                replica.ejected_until = 0
+            elif not healthy and replica.healthy:
+                log.warning('Data service replica %s failed its health check', replica.base_url)
+            replica.healthy = healthy
+
+    def latency_percentile(self, percentile, min_samples=20):
+        with self.lock:
+            samples = sorted(self.latencies)
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100.0))]
+
+    def stats(self):
+        now = self.clock()
+        with self.lock:
+            return [
+                {
+                    'outstanding': replica.outstanding,
+                    'failures': replica.failures,
+                    'available': replica.available(now),
+                }
+                for replica in self.replicas
+            ]
+
+
+class UpstreamClient(object):
+    """ Keep-alive HTTP client for the genomic data service.
+
+    A single connection pool is shared by every worker thread in the process
+    so connections (and their TLS sessions) are reused between requests.
+    Each thread gets its own requests.Session mounted on that shared adapter
+    as sessions themselves are not safe to share between threads. The pool
+    keeps ``pool_size`` idle connections but never blocks, concurrency is
+    bounded by the admission limit. Streamed responses, which hold their
+    connection while a client downloads them, use a pool of their own.
+
+    With several replicas configured requests go to the replica with the
+    fewest outstanding requests, replicas are probed in the background and
+    non-streaming requests can optionally be hedged: a duplicate is sent to
+    a second replica when the first has not answered within the p95
+    latency.
+
+    Every request passes the circuit breaker and the admission limit first,
+    raising CircuitOpenError or OverloadedError instead of waiting on a
+    data service that cannot keep up. Connection errors and timeouts raise
+    UpstreamError, so all of them can be answered with a stale response or
+    a 503. Each call's latency, status, size and retries are recorded in
+    ``metrics``.
+    """
+
+    def __init__(self, base_urls, pool_size=10, connect_timeout=3.05,
+                 read_timeout=30, retries=2, backoff_factor=0.1,
+                 health_path='/', health_interval=10, max_failures=3,
+                 eject_seconds=30, hedge=False, hedge_min_delay=0.05,
+                 breaker=None, admission=None, metrics=None, stream_pool_size=10):
+        if isinstance(base_urls, str):
+            base_urls = [base_urls]
+        self.replicas = ReplicaSet(base_urls, max_failures, eject_seconds)
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self.hedge = hedge and len(self.replicas) > 1
+        self.hedge_min_delay = hedge_min_delay
+        self.breaker = breaker or CircuitBreaker(min_requests=float('inf'))
+        self.admission = admission or Admission()
+        self.metrics = metrics or Metrics()
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False,
+        )
+        self.adapter = HTTPAdapter(
+            pool_connections=len(self.replicas),
+            pool_maxsize=pool_size,
+            max_retries=retry,
+        )
+        self.stream_adapter = HTTPAdapter(
+            pool_connections=len(self.replicas),
+            pool_maxsize=stream_pool_size,
+            max_retries=retry,
+        )
+        self.scope = threading.local()
+        self.prober = None
+        self.prober_lock = threading.Lock()
+        self.hedge_executor = None
+        self.hedges = 0
+        if self.hedge:
+            self.hedge_executor = ThreadPoolExecutor(
+                max_workers=pool_size * 2, thread_name_prefix='regulome-hedge')
+
+    @classmethod
+    def from_settings(cls, settings, metrics=None):
+        prefix = 'genomic_data_service.'
+        return cls(
+            aslist(settings['genomic_data_service_url']),
+            pool_size=int(settings.get(prefix + 'pool_size', 10)),
+            connect_timeout=float(settings.get(prefix + 'connect_timeout', 3.05)),
+            read_timeout=float(settings.get(prefix + 'read_timeout', 30)),
+            retries=int(settings.get(prefix + 'retries', 2)),
+            backoff_factor=float(settings.get(prefix + 'backoff_factor', 0.1)),
+            health_path=settings.get(prefix + 'health_path', '/'),
+            health_interval=float(settings.get(prefix + 'health_interval', 10)),
+            max_failures=int(settings.get(prefix + 'max_failures', 3)),
+            eject_seconds=float(settings.get(prefix + 'eject_seconds', 30)),
+            hedge=asbool(settings.get(prefix + 'hedge', False)),
+            hedge_min_delay=float(settings.get(prefix + 'hedge_min_delay', 0.05)),
+            breaker=CircuitBreaker.from_settings(settings),
+            admission=Admission.from_settings(settings),
+            metrics=metrics,
+            stream_pool_size=int(settings.get(prefix + 'stream_pool_size', 10)),
+        )
+
+    @property
+    def session(self):
+        try:
+            return self.scope.session
+        except AttributeError:
+            session = self.scope.session = self.mounted_session(self.adapter)
+            return session
+
+    @property
+    def stream_session(self):
+        try:
+            return self.scope.stream_session
+        except AttributeError:
+            session = self.scope.stream_session = self.mounted_session(self.stream_adapter)
+            return session
+
+    def mounted_session(self, adapter):
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def path(self, endpoint, query_string):
+        return '/' + endpoint + '/?' + query_string
+
+    def url(self, endpoint, query_string):
+        return self.replicas.peek().base_url + self.path(endpoint, query_string)
+
+    def hedge_delay(self):
+        p95 = self.replicas.latency_percentile(95)
+        if p95 is None:
+            return None
+        return max(p95, self.hedge_min_delay)
+
+    def admit(self, admission=None, breaker=None):
+        """ Take an admission slot and a breaker permit or raise.
+        """
+        admission = admission or self.admission
+        if not admission.acquire():
+            raise OverloadedError('Too many data service requests', admission.wait)
+        self.admitted(admission, breaker)
+
+    def admitted(self, admission=None, breaker=None):
+        breaker = breaker or self.breaker
+        if not breaker.allow():
+            (admission or self.admission).release()
+            raise CircuitOpenError('Data service circuit is open', breaker.retry_after())
+
+    def finish(self, ok, latency, admission=None, breaker=None):
+        (breaker or self.breaker).record(ok, latency)
+        (admission or self.admission).release()
+
+    def get(self, path, admission=None, breaker=None, **kw):
+        """ GET a data service path from the least loaded replica, admitted
+        by ``admission`` and ``breaker`` instead of the shared ones when
+        given.
+        """
+        kw.setdefault('timeout', self.timeout)
+        self.start_health_checks()
+        self.admit(admission, breaker)
+        start = time.monotonic()
+        response = None
+        try:
+            response = self._dispatch(path, **kw)
+            return response
+        except requests.RequestException as e:
+            raise UpstreamError('Data service request failed: %s' % e, 1) from e
+        finally:
+            latency = time.monotonic() - start
+            self.finish(
+                response is not None and response.status_code < 500, latency,
+                admission, breaker)
+            self.record(path, latency, response, kw.get('stream'))
+
+    def record(self, path, latency, response, stream=False):
+        if response is None:
+            self.metrics.record_upstream(endpoint(path), latency)
+            return
+        if stream:
+            size = response.headers.get('Content-Length')
+            size = int(size) if size and size.isdigit() else None
+        else:
+            size = len(response.content)
+        history = getattr(getattr(response.raw, 'retries', None), 'history', ())
+        self.metrics.record_upstream(
+            endpoint(path), latency, response.status_code, size, len(history))
+
+    def _dispatch(self, path, **kw):
+        if self.hedge and not kw.get('stream'):
+            delay = self.hedge_delay()
+            if delay is not None:
+                return self._hedged_get(path, delay, **kw)
+        return self._get(self.replicas.choose(), path, **kw)
+
+    def _get(self, replica, path, **kw):
+        start = time.monotonic()
+        try:
+            session = self.stream_session if kw.get('stream') else self.session
+            response = session.get(replica.base_url + path, **kw)
+        except requests.RequestException:
+            self.replicas.release(replica, False)
+            raise
+        self.replicas.release(
+            replica, response.status_code < 500, time.monotonic() - start)
+        return response
+
+    def _hedged_get(self, path, delay, **kw):
+        primary = self.replicas.choose()
+        first = self.hedge_executor.submit(self._get, primary, path, **kw)
+        done, pending = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        secondary = self.replicas.choose(exclude=(primary,))
+        if secondary is None:
+            return first.result()
+        self.hedges += 1
+        second = self.hedge_executor.submit(self._get, secondary, path, **kw)
+        futures = [first, second]
+        while True:
+            done, pending = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                futures.remove(future)
+                if future.exception() is None:
+                    for other in pending:
+                        other.add_done_callback(_close_response)
+                    return future.result()
+            if not futures:
+                raise done.pop().exception()
+
+    def start_health_checks(self):
+        if self.prober is not None or len(self.replicas) < 2 or self.health_interval <= 0:
+            return
+        with self.prober_lock:
+            if self.prober is None:
+                self.prober = threading.Thread(
+                    target=self._probe_forever, name='regulome-health', daemon=True)
+                self.prober.start()
+
+    def probe(self):
+        session = requests.Session()
+        for replica in self.replicas.replicas:
+            try:
+                response = session.get(
+                    replica.base_url + self.health_path, timeout=self.timeout)
+                healthy = response.status_code < 500
+                response.close()
+            except requests.RequestException:
+                healthy = False
+            self.replicas.mark(replica, healthy)
+        session.close()
+
+    def _probe_forever(self):
+        while True:
+            time.sleep(self.health_interval)
+            try:
+                self.probe()
+            except Exception:
+                log.exception('Data service health check failed')
+
+    def stats(self):
+        return {
+            'admission': self.admission.stats(),
+            'breaker': self.breaker.stats(),
+            'replicas': self.replicas.stats(),
+            'hedges': self.hedges,
+            'hedge_delay': self.hedge_delay(),
+        }
+
+    def close(self):
+        self.adapter.close()
+
+
+def _close_response(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+def endpoint(path):
+    """ The data service endpoint of a request path, for metric labels.
+    """
+    return path.lstrip('/').split('/', 1)[0].split('?', 1)[0]